@@ -0,0 +1,346 @@
+"""
+Memory-mapped caches of preprocessed frames for the nerual scene graph datasets.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import imageio
+import numpy as np
+import torch
+from rich.console import Console
+
+from mars.utils.neural_scene_graph_helper import (
+    colors_to_labels,
+    get_color2label,
+    get_color_lookup,
+)
+from nerfstudio.data.dataparsers.base_dataparser import Semantics
+from nerfstudio.data.utils.data_utils import (
+    get_depth_image_from_path,
+    get_semantics_and_mask_tensors_from_path,
+)
+
+CONSOLE = Console()
+
+
+def get_files_signature(filenames: Sequence[Union[str, Path]]) -> List[Tuple[str, int, int]]:
+    """Path, size and modification time of every file, to invalidate caches when the sources change.
+
+    Directories contribute every file below them, editing a file in place does not change the directory mtime.
+    """
+    signature = []
+    for filename in filenames:
+        if os.path.isdir(filename):
+            for root, dirs, files in os.walk(filename):
+                dirs.sort()
+                signature += get_files_signature([os.path.join(root, name) for name in sorted(files)])
+            continue
+        stat = os.stat(filename)
+        signature.append((str(filename), stat.st_size, stat.st_mtime_ns))
+    return signature
+
+
+def get_cache_key(*parts) -> str:
+    """Content address of a cache entry, built from the repr of everything the cached data depends on."""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def load_or_build_frame_stack(
+    cache_path: Path, num_frames: int, load_frame: Callable[[int], np.ndarray]
+) -> np.ndarray:
+    """Open a memory-mapped stack of frames, building it first if it is not cached yet.
+
+    The stack is written to a temporary file and moved into place once complete, so concurrent jobs
+    never read a partial cache.
+
+    Args:
+        cache_path: .npy file of the stack
+        num_frames: number of frames in the stack
+        load_frame: returns the i-th frame, all frames must have the same shape and dtype
+
+    Returns:
+        stack of frames [num_frames, ...], opened copy-on-write so that frames can be wrapped without copies
+    """
+    if not cache_path.exists():
+        CONSOLE.print(f"[bold green]Building frame cache {cache_path}")
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        first_frame = load_frame(0)
+        stack = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=first_frame.dtype, shape=(num_frames, *first_frame.shape)
+        )
+        for i in range(num_frames):
+            frame = first_frame if i == 0 else load_frame(i)
+            if frame.shape != first_frame.shape:
+                raise ValueError(f"Frame {i} has shape {frame.shape}, expected {first_frame.shape}")
+            stack[i] = frame
+        stack.flush()
+        del stack
+        os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode="c")
+
+
+def get_semantic_label_cache(semantics: Semantics, cache_dir: Path) -> np.ndarray:
+    """Class id maps of all semantic images, keyed by the semantic color table and the semantic files.
+
+    Colors that are not in the table get the ignored label len(semantics.classes).
+
+    Args:
+        semantics: semantics of the dataset
+        cache_dir: directory of the caches
+
+    Returns:
+        memory-mapped uint8 class ids [n_frames, H, W]
+    """
+    ignore_label = len(semantics.classes)
+    assert ignore_label < 256, "class ids are cached as uint8"
+    color2label = get_color2label(semantics)
+    color_keys, color_labels = get_color_lookup(color2label)
+    cache_key = get_cache_key(
+        "semantic_labels",
+        sorted(color2label.items()),
+        list(semantics.classes),
+        get_files_signature(semantics.filenames),
+    )
+
+    def load_frame(i: int) -> np.ndarray:
+        colors, _ = get_semantics_and_mask_tensors_from_path(
+            filepath=semantics.filenames[i], mask_indices=[], scale_factor=1.0
+        )
+        labels = colors_to_labels(colors[..., 0], color_keys, color_labels, ignore_label)
+        return labels.numpy().astype(np.uint8)
+
+    return load_or_build_frame_stack(
+        cache_dir / f"semantic_labels_{cache_key}.npy", len(semantics.filenames), load_frame
+    )
+
+
+def get_depth_cache(
+    depth_filenames: Sequence[Union[str, Path]], heights: Sequence[int], widths: Sequence[int], cache_dir: Path
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Raw depth maps resized to the camera resolution and their validity masks packed as bits.
+
+    Depth is stored as the raw uint16 values of the depth maps, the unit and dataparser scale is applied
+    when reading. Pixels without depth (65535) are masked out.
+
+    Args:
+        depth_filenames: depth maps of the dataset
+        heights: camera heights of the frames
+        widths: camera widths of the frames
+        cache_dir: directory of the caches
+
+    Returns:
+        memory-mapped uint16 depth [n_frames, H, W] and packed masks [n_frames, H, ceil(W / 8)]
+    """
+    cache_key = get_cache_key(
+        "depth", [int(h) for h in heights], [int(w) for w in widths], get_files_signature(depth_filenames)
+    )
+
+    def load_depth(i: int) -> np.ndarray:
+        depth = get_depth_image_from_path(
+            filepath=Path(depth_filenames[i]), height=int(heights[i]), width=int(widths[i]), scale_factor=1.0
+        )[..., 0].numpy()  # default interpolation cv2.INTER_NEAREST
+        if np.any(depth != np.round(depth)) or depth.min() < 0 or depth.max() > 65535:
+            raise ValueError(f"Depth map {depth_filenames[i]} is not a uint16 depth map and cannot be cached")
+        return depth.astype(np.uint16)
+
+    depth = load_or_build_frame_stack(cache_dir / f"depth_{cache_key}.npy", len(depth_filenames), load_depth)
+    depth_mask = load_or_build_frame_stack(
+        cache_dir / f"depth_mask_{cache_key}.npy",
+        len(depth_filenames),
+        lambda i: np.packbits(depth[i] != 65535, axis=-1),  # maskout no-depth input
+    )
+    return depth, depth_mask
+
+
+def get_image_store(image_filenames: Sequence[Union[str, Path]], cache_dir: Path) -> Tuple[np.ndarray, Dict[str, int]]:
+    """Compact uint8 store of the images of a sequence, a memory-mapped frame stack plus an index.
+
+    The frames are kept as uint8 and shared through the page cache by all processes reading the store,
+    they are converted to float only after pixel sampling.
+
+    Args:
+        image_filenames: images of the sequence
+        cache_dir: directory of the caches
+
+    Returns:
+        memory-mapped uint8 frames [n_frames, H, W, C] and the index mapping image filenames to frames
+    """
+    filenames = sorted(str(filename) for filename in image_filenames)
+    cache_key = get_cache_key("image_store", get_files_signature(filenames))
+    index_path = cache_dir / f"image_store_{cache_key}.json"
+
+    def load_frame(i: int) -> np.ndarray:
+        image = np.array(imageio.imread(filenames[i]))
+        return np.maximum(np.minimum(image, 255), 0).astype(np.uint8)
+
+    frames = load_or_build_frame_stack(cache_dir / f"image_store_{cache_key}.npy", len(filenames), load_frame)
+    if not index_path.exists():
+        tmp_path = index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"filenames": filenames, "shape": list(frames.shape[1:])}, f)
+        os.replace(tmp_path, index_path)
+    with open(index_path, "r", encoding="utf-8") as f:
+        index = {filename: i for i, filename in enumerate(json.load(f)["filenames"])}
+    return frames, index
+
+
+_BUNDLE_MAGIC = b"MARSSCN1"
+_BUNDLE_ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + _BUNDLE_ALIGNMENT - 1) // _BUNDLE_ALIGNMENT * _BUNDLE_ALIGNMENT
+
+
+def save_array_bundle(path: Path, arrays: Dict[str, np.ndarray], meta: Dict) -> None:
+    """Write arrays and JSON metadata into one file that can be memory-mapped.
+
+    Layout: magic, header length (uint64), JSON header, then every array aligned to 64 bytes.
+    The file is written to a temporary file and moved into place once complete.
+
+    Args:
+        path: file of the bundle
+        arrays: arrays of the bundle, stored in C order
+        meta: JSON serializable metadata
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"arrays": entries, "meta": meta}).encode("utf-8")
+    data_start = _align(len(_BUNDLE_MAGIC) + 8 + len(header))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(_BUNDLE_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_array_bundle(path: Path) -> Tuple[Dict[str, np.ndarray], Dict]:
+    """Open a bundle written by save_array_bundle, the arrays are memory-mapped copy-on-write.
+
+    Returns:
+        arrays and metadata of the bundle
+    """
+    with open(path, "rb") as f:
+        if f.read(len(_BUNDLE_MAGIC)) != _BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not a scene cache")
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _align(len(_BUNDLE_MAGIC) + 8 + header_length)
+
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        shape = tuple(entry["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=entry["dtype"])
+        else:
+            arrays[name] = np.memmap(
+                path, dtype=entry["dtype"], mode="c", offset=data_start + entry["offset"], shape=shape
+            )
+    return arrays, header["meta"]
+
+
+def load_or_build_array_bundle(
+    cache_path: Path, build: Callable[[], Tuple[Dict[str, np.ndarray], Dict]]
+) -> Tuple[Dict[str, np.ndarray], Dict]:
+    """Load a bundle from the cache, building it and writing the cache first on a cold start (e.g. a parsed scene).
+
+    Args:
+        cache_path: file of the cached bundle
+        build: builds the arrays and JSON serializable metadata of the bundle
+
+    Returns:
+        arrays and metadata of the bundle
+    """
+    if cache_path.exists():
+        CONSOLE.print(f"[bold green]Loading cache {cache_path}")
+        return load_array_bundle(cache_path)
+    arrays, meta = build()
+    save_array_bundle(cache_path, arrays, meta)
+    return arrays, meta
+
+
+# bumped when the arrays of the scene cache change
+SCENE_CACHE_VERSION = 3
+
+SCENE_CACHE_CONFIG_FIELDS = (
+    "first_frame",
+    "last_frame",
+    "box_scale",
+    "split_setting",
+    "scale_factor",
+    "use_depth",
+    "use_semantic",
+    "semantic_path",
+    "object_setting",
+    "use_object_properties",
+    "cull_invisible_objects",
+    "use_obj",
+    "render_only",
+    "bckg_only",
+    "dataset_type",
+)
+
+
+def get_scene_cache_path(cache_dir: Path, config, sources: Sequence[Union[str, Path]]) -> Path:
+    """Cache file of a parsed scene, keyed by the data path, the parser config and the source files.
+
+    Args:
+        cache_dir: directory of the caches
+        config: dataparser config
+        sources: files and directories read by the parser, the modification times of their files invalidate the cache
+    """
+    cache_key = get_cache_key(
+        "scene",
+        SCENE_CACHE_VERSION,
+        str(config.data),
+        [(name, getattr(config, name)) for name in SCENE_CACHE_CONFIG_FIELDS],
+        get_files_signature(sources),
+    )
+    return cache_dir / f"scene_{cache_key}.bin"
+
+
+def _build_car_latent_store(latents_path: Path) -> Tuple[Dict[str, np.ndarray], Dict]:
+    car_latents = torch.load(str(latents_path))
+    frame_ids = np.array([idx["fid"] for idx in car_latents["indices"]])
+    # rows sorted by frame for range queries, ties keep the order of the latent codes
+    order = np.argsort(frame_ids, kind="stable")
+    arrays = {
+        "latents": car_latents["latents"].detach().cpu().numpy(),
+        "frame_ids": frame_ids[order],
+        "track_ids": np.array([idx["oid"] for idx in car_latents["indices"]])[order],
+        "order": order,
+    }
+    return arrays, {}
+
+
+def get_car_latent_store(latents_path: Path, cache_dir: Optional[Path] = None) -> Dict[str, np.ndarray]:
+    """Car latent codes with an index sorted by frame, so that a frame window is one slice.
+
+    Args:
+        latents_path: latent codes saved by torch, {"latents": [n_codes, dim], "indices": [{"fid", "oid"}]}
+        cache_dir: directory of the caches, the store is memory-mapped from there, built in memory if None
+
+    Returns:
+        latents [n_codes, dim] in the order of the latent codes, and for every row sorted by frame its frame id,
+        track id and position in the latent codes
+    """
+    if cache_dir is None:
+        return _build_car_latent_store(latents_path)[0]
+    cache_key = get_cache_key("car_latents", get_files_signature([latents_path]))
+    cache_path = cache_dir / f"car_latents_{cache_key}.bin"
+    return load_or_build_array_bundle(cache_path, lambda: _build_car_latent_store(latents_path))[0]
@@ -3,13 +3,17 @@ Nerual scene graph kitti datamanager.
 """
 
 from dataclasses import dataclass, field
+from pathlib import Path
 from typing import Any, Dict, Generic, List, Literal, Optional, Tuple, Type, Union
 
+import torch
+
 from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.data.datamanagers.base_datamanager import (
     VanillaDataManager,
     VanillaDataManagerConfig,
 )
+from mars.data.mars_dataparser_utils import gather_object_records
 from mars.data.mars_dataset import MarsDataset
 
 
@@ -18,6 +22,8 @@ class MarsDataManagerConfig(VanillaDataManagerConfig):
     """A semantic datamanager - required to use with .setup()"""
 
     _target: Type = field(default_factory=lambda: MarsDataManager)
+    cache_dir: Optional[Path] = None
+    """Directory of the preprocessed frame caches (uint8 images, depth maps, semantic class id maps), caching is disabled if None."""
 
 
 class MarsDataManager(VanillaDataManager):  # pylint: disable=abstract-method
@@ -34,6 +40,7 @@ class MarsDataManager(VanillaDataManager):  # pylint: disable=abstract-method
             scale_factor=self.config.camera_res_scale_factor,
             use_depth=self.config.dataparser.use_depth,
             use_semantic=self.config.dataparser.use_semantic,
+            cache_dir=self.config.cache_dir,
         )
 
     def create_eval_dataset(self) -> MarsDataset:
@@ -43,15 +50,43 @@ class MarsDataManager(VanillaDataManager):  # pylint: disable=abstract-method
             scale_factor=self.config.camera_res_scale_factor,
             use_depth=self.config.dataparser.use_depth,
             use_semantic=self.config.dataparser.use_semantic,
+            cache_dir=self.config.cache_dir,
+        )
+
+    @staticmethod
+    def image_to_float(batch: Dict) -> Dict:
+        """Convert the uint8 images of the frame store to float, after sampling only the used pixels."""
+        if batch["image"].dtype == torch.uint8:
+            batch["image"] = batch["image"].float() / 255.0
+        return batch
+
+    @staticmethod
+    def get_object_rays_info(dataset: MarsDataset, image_indices: torch.Tensor, prefix: str = "") -> torch.Tensor:
+        """Object records of the images of a batch of rays, flattened to [n_rays, n_batch_objects * 5].
+
+        With prefix "sample_", the culled table of the parser is read if it has one.
+        """
+        if prefix + "obj_offsets" not in dataset.metadata:
+            prefix = ""
+        object_rays_info = gather_object_records(
+            dataset.metadata[prefix + "obj_offsets"], dataset.metadata[prefix + "obj_records"], image_indices
         )
+        return object_rays_info.reshape(object_rays_info.shape[0], -1)
 
+    @staticmethod
+    def get_image_object_rays_info(dataset: MarsDataset, image_idx: int, shape: Tuple[int, ...]) -> torch.Tensor:
+        """Object records of one image, shared by all rays of the image as an expanded view without copies."""
+        object_rays_info = gather_object_records(
+            dataset.metadata["obj_offsets"], dataset.metadata["obj_records"], torch.tensor(image_idx)
+        )
+        return object_rays_info.reshape(-1).expand(*shape, -1)
 
     def next_train(self, step: int) -> Tuple[RayBundle, Dict]:
         """Returns the next batch of data from the train dataloader."""
         self.train_count += 1
         image_batch = next(self.iter_train_image_dataloader)
         assert self.train_pixel_sampler is not None
-        batch = self.train_pixel_sampler.sample(image_batch)
+        batch = self.image_to_float(self.train_pixel_sampler.sample(image_batch))
         ray_indices = batch["indices"]
         ray_bundle = self.train_ray_generator(ray_indices)
 
@@ -59,10 +94,7 @@ class MarsDataManager(VanillaDataManager):  # pylint: disable=abstract-method
         # y = ray_indices[:, 1]  # row indices
         # x = ray_indices[:, 2]  # col indices
 
-        # PR: Adjusted to match the new tensor structure
-        object_rays_info = self.train_dataset.metadata["obj_info"][c]
-        object_rays_info = object_rays_info.reshape(object_rays_info.shape[0], -1)
-        ray_bundle.metadata["object_rays_info"] = object_rays_info.detach()
+        ray_bundle.metadata["object_rays_info"] = self.get_object_rays_info(self.train_dataset, c, prefix="sample_")
         return ray_bundle, batch
 
     def next_eval(self, step: int) -> Tuple[RayBundle, Dict]:
@@ -70,29 +102,22 @@ class MarsDataManager(VanillaDataManager):  # pylint: disable=abstract-method
         self.eval_count += 1
         image_batch = next(self.iter_eval_image_dataloader)
         assert self.eval_pixel_sampler is not None
-        batch = self.eval_pixel_sampler.sample(image_batch)
+        batch = self.image_to_float(self.eval_pixel_sampler.sample(image_batch))
         ray_indices = batch["indices"]
         ray_bundle = self.eval_ray_generator(ray_indices)
         c = ray_indices[:, 0]  # camera indices
         # y = ray_indices[:, 1]  # row indices
         # x = ray_indices[:, 2]  # col indices
 
-        # PR: Adjusted to match the new tensor structure
-        object_rays_info = self.eval_dataset.metadata["obj_info"][c]
-        object_rays_info = object_rays_info.reshape(object_rays_info.shape[0], -1)
-        ray_bundle.metadata["object_rays_info"] = object_rays_info.detach()
+        ray_bundle.metadata["object_rays_info"] = self.get_object_rays_info(self.eval_dataset, c)
         return ray_bundle, batch
 
     def next_eval_image(self, step: int) -> Tuple[int, RayBundle, Dict]:
         for camera_ray_bundle, batch in self.eval_dataloader:
             assert camera_ray_bundle.camera_indices is not None
             image_idx = int(camera_ray_bundle.camera_indices[0, 0, 0])
-            object_rays_info = self.eval_dataset.metadata["obj_info"][image_idx]
-
-            object_rays_info_view = object_rays_info.expand(camera_ray_bundle.shape[0], camera_ray_bundle.shape[1], -1, -1)
-
-            camera_ray_bundle.metadata["object_rays_info"] = object_rays_info_view.reshape(
-                camera_ray_bundle.shape[0], camera_ray_bundle.shape[1], -1
-            ).detach()
-            return image_idx, camera_ray_bundle, batch
-        raise ValueError("No more eval images")
\ No newline at end of file
+            camera_ray_bundle.metadata["object_rays_info"] = self.get_image_object_rays_info(
+                self.eval_dataset, image_idx, camera_ray_bundle.shape
+            )
+            return image_idx, camera_ray_bundle, self.image_to_float(batch)
+        raise ValueError("No more eval images")
@@ -0,0 +1,281 @@
+"""
+Object information shared by the nerual scene graph dataparsers.
+"""
+
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from rich.console import Console
+
+from mars.data.mars_cache import get_car_latent_store
+
+CONSOLE = Console(width=120)
+
+# an object record is [x, y, z, yaw, metadata row], padded slots point to the first metadata row, the row of no object
+OBJECT_RECORD_SIZE = 5
+EMPTY_OBJECT_RECORD = (-1.0, -1.0, -1.0, -1.0, 0.0)
+
+
+def get_track_rows(track_ids, row_track_ids):
+    """Rows of the object metadata of track ids, with a sorted lookup instead of a search per object.
+
+    Args:
+        track_ids: track ids of the objects, -1 for empty slots
+        row_track_ids: track id of every metadata row, -1 for the first row of the empty slots
+
+    Returns:
+        metadata rows, same shape and dtype as track_ids
+    """
+    order = np.argsort(row_track_ids, kind="stable")
+    sorted_track_ids = row_track_ids[order]
+    if np.any(sorted_track_ids[1:] == sorted_track_ids[:-1]):
+        raise ValueError("Track ids of the object metadata are not unique")
+    pos = np.minimum(np.searchsorted(sorted_track_ids, track_ids), len(sorted_track_ids) - 1)
+    found = sorted_track_ids[pos] == track_ids
+    if not np.all(found):
+        raise ValueError(f"Objects {np.unique(track_ids[~found])} have no metadata")
+    return order[pos].astype(track_ids.dtype)
+
+
+def extract_object_information(args, visible_objects, objects_meta):
+    """Get object and object network properties for the given sequence
+
+    Args:
+        args:
+            args.object_setting are experimental settings for object networks inputs, set to 0 for current version
+        visible_objects: Objects per frame + Pose and other dynamic properties + tracking ID
+        objects_meta: Metadata with additional static object information sorted by tracking ID
+
+    Retruns:
+        obj_properties [n_input_frames, n_max_objects, n_object_properties, 0]: Object properties per frame
+        add_input_rows: 2
+        obj_meta_ls: List of object metadata
+        scene_objects: List of objects per frame
+        scene_classes: List of object classes per frame
+    Notes:
+        obj_properties: x,y,z,yaw_angle,track_id, 0
+    """
+    if args.dataset_type == "vkitti":
+        # [n_frames, n_max_obj, xyz+track_id+ismoving+0]
+        obj_state = visible_objects[:, :, [7, 8, 9, 2, -1]]
+
+        obj_dir = visible_objects[:, :, 10][..., None]
+        # [..., width+height+length]
+        # obj_dim = visible_objects[:, :, 4:7]
+        sh = obj_state.shape
+    elif args.dataset_type == "waymo_od":
+        obj_state = visible_objects[:, :, [7, 8, 9, 2, -1]]
+        obj_dir = visible_objects[:, :, 10][..., None]
+        sh = obj_state.shape
+    elif args.dataset_type == "kitti":
+        obj_state = visible_objects[:, :, [7, 8, 9, 2, 3]]  # [x,y,z,track_id,class_id]
+        obj_dir = visible_objects[:, :, 10][..., None]  # yaw_angle
+        sh = obj_state.shape
+    else:
+        raise Exception("Invalid dataset name.")
+
+    # obj_state: [cam, n_obj, [x,y,z,track_id, class_id]]
+
+    # [n_frames, n_max_obj]
+    obj_track_id = obj_state[..., 3][..., None]
+    # Change track_id to row in list(objects_meta)
+    obj_meta_ls = list(objects_meta.values())  # object_id, length, height, width, class_id
+    # Add first row for no objects
+    obj_meta_ls.insert(0, np.zeros_like(obj_meta_ls[0]))
+    obj_meta_ls[0][0] = -1
+    # Build array describing the relation between metadata IDs and where its located
+    row_to_track_id = np.concatenate(
+        [
+            np.linspace(0, len(objects_meta.values()), len(objects_meta.values()) + 1)[:, None],
+            np.array(obj_meta_ls)[:, 0][:, None],
+        ],
+        axis=1,
+    ).astype(np.int32)
+    # [n_frames, n_max_obj]
+    track_row = get_track_rows(obj_track_id, row_to_track_id[:, 1])
+
+    # objects in the order of their first appearance
+    scene_ids = obj_track_id[obj_track_id >= 0]
+    scene_objects, first_appearance = np.unique(scene_ids, return_index=True)
+    scene_objects = list(scene_objects[np.argsort(first_appearance)])
+    scene_classes = list(np.unique(np.array(obj_meta_ls)[..., 4]))
+    CONSOLE.log(f"{scene_objects} in this scene.")
+
+    obj_properties = np.concatenate([obj_state[..., :3], obj_dir, track_row], axis=2)
+
+    if obj_properties.shape[-1] % 3 > 0:
+        if obj_properties.shape[-1] % 3 == 1:
+            obj_properties = np.concatenate([obj_properties, np.zeros([sh[0], sh[1], 2])], axis=2).astype(np.float32)
+        else:
+            obj_properties = np.concatenate([obj_properties, np.zeros([sh[0], sh[1], 1])], axis=2).astype(np.float32)
+
+    add_input_rows = int(obj_properties.shape[-1] / 3)
+
+    obj_meta_ls = [
+        (obj * np.array([1.0, args.box_scale, 1.0, args.box_scale, 1.0])).astype(np.float32)
+        if obj[4] != 4
+        else obj * np.array([1.0, 1.2, 1.0, 1.2, 1.0])
+        for obj in obj_meta_ls
+    ]  # [n_obj, [track_id, length * box_scale/1.2, height, width * box_scale/1.2, class_id]] 1.2 for humans, box_scale for other objects
+
+    return obj_properties, add_input_rows, obj_meta_ls, scene_objects, scene_classes
+
+
+def get_track_car_latents(latents_path: Path, selected_frames, cache_dir: Optional[Path] = None) -> Dict:
+    """Latent code of every car track in a frame window, the last code of the track in the latent codes.
+
+    Args:
+        latents_path: latent codes saved by torch
+        selected_frames: [first_frame, last_frame]
+        cache_dir: directory of the latent store cache
+
+    Returns:
+        latent code [dim] of every track id, in the order of the first code of the tracks
+    """
+    store = get_car_latent_store(latents_path, cache_dir)
+    window = slice(
+        np.searchsorted(store["frame_ids"], selected_frames[0], side="left"),
+        np.searchsorted(store["frame_ids"], selected_frames[1], side="right"),
+    )
+    # latent codes of the window in their original order
+    code_ids = np.sort(store["order"][window])
+    track_ids = store["track_ids"][window][np.argsort(store["order"][window])]
+
+    tracks, first_code = np.unique(track_ids, return_index=True)
+    _, last_code_reversed = np.unique(track_ids[::-1], return_index=True)
+    last_code = code_ids[len(code_ids) - 1 - last_code_reversed]
+    latents = torch.from_numpy(np.array(store["latents"][last_code]))
+
+    return {tracks[i].item(): latents[i] for i in np.argsort(first_code)}
+
+
+def get_visible_objects(obj_nodes, obj_metadata, poses, focal, principal_point, image_size, add_input_rows):
+    """Objects whose 3D bounding box is in the view frustum of the image, a conservative test on the box corners.
+
+    The boxes follow world2object: centered at the object position shifted by half the height along -y,
+    rotated by yaw around y.
+
+    Args:
+        obj_nodes: object nodes of every image, [n_images, n_max_objects * add_input_rows, 3]
+        obj_metadata: object metadata rows, [n_rows, [track_id, length, height, width, class_id]]
+        poses: camera to world poses of the images, [n_images, 4, 4]
+        focal: [focal_x, focal_y]
+        principal_point: [c_x, c_y] in pixels
+        image_size: [height, width]
+        add_input_rows: rows of each object in obj_nodes
+
+    Returns:
+        visible: [n_images, n_max_objects], False for empty slots
+    """
+    n_images = obj_nodes.shape[0]
+    obj_nodes = obj_nodes.reshape(n_images, -1, add_input_rows * 3)
+    position, yaw = obj_nodes[..., :3], obj_nodes[..., 3]
+    track_row = obj_nodes[..., 4].astype(np.int64)
+    dim = obj_metadata[track_row, 1:4]
+
+    # box corners in the object frame and in the world frame, [n_images, n_max_objects, 8, 3]
+    signs = np.array(np.meshgrid([-1.0, 1.0], [-1.0, 1.0], [-1.0, 1.0], indexing="ij")).reshape(3, -1).T
+    corners_o = signs * dim[..., None, :] / 2
+    cos_yaw, sin_yaw = np.cos(yaw)[..., None], np.sin(yaw)[..., None]
+    center = position - np.array([0.0, 1.0, 0.0]) * dim[..., 1:2] / 2
+    corners_w = np.stack(
+        [
+            cos_yaw * corners_o[..., 0] + sin_yaw * corners_o[..., 2],
+            corners_o[..., 1],
+            -sin_yaw * corners_o[..., 0] + cos_yaw * corners_o[..., 2],
+        ],
+        axis=-1,
+    ) + center[..., None, :]
+
+    # corners in the camera frames (x right, y up, looking along -z)
+    rotation, translation = poses[:, None, :3, :3], poses[:, None, None, :3, 3]
+    corners_c = np.matmul(corners_w - translation, rotation)
+    depth = -corners_c[..., 2]
+    in_front = depth > 1e-6
+    safe_depth = np.where(in_front, depth, 1.0)
+    u = focal[0] * corners_c[..., 0] / safe_depth + principal_point[0]
+    v = -focal[1] * corners_c[..., 1] / safe_depth + principal_point[1]
+
+    # boxes partly behind the camera have an unbounded projection and are kept
+    overlaps = (
+        (np.where(in_front, u, np.inf).min(-1) <= image_size[1])
+        & (np.where(in_front, u, -np.inf).max(-1) >= 0)
+        & (np.where(in_front, v, np.inf).min(-1) <= image_size[0])
+        & (np.where(in_front, v, -np.inf).max(-1) >= 0)
+    )
+    visible = in_front.any(-1) & (~in_front.all(-1) | overlaps)
+    return visible & (track_row != 0)
+
+
+def get_object_table(obj_nodes, add_input_rows, keep=None):
+    """Ragged object table of the images, the records of all images in one flat array indexed by offsets.
+
+    The records of image i are obj_records[obj_offsets[i] : obj_offsets[i + 1]], so the table grows with
+    the number of objects in the images instead of with the fullest image.
+
+    Args:
+        obj_nodes: object nodes of every image, [n_images, n_max_objects * add_input_rows, 3]
+        add_input_rows: rows of each object in obj_nodes
+        keep: objects to keep, [n_images, n_max_objects], all non-empty slots if None
+
+    Returns:
+        obj_offsets: first record of every image, [n_images + 1]
+        obj_records: [n_objects, 5], [x, y, z, yaw, metadata row] of every object
+    """
+    n_images = obj_nodes.shape[0]
+    obj_nodes = obj_nodes.reshape(n_images, -1, add_input_rows * 3)
+    if keep is None:
+        keep = obj_nodes[..., 4] != 0
+    obj_offsets = np.zeros(n_images + 1, dtype=np.int64)
+    np.cumsum(keep.sum(-1), out=obj_offsets[1:])
+    # boolean indexing is row major, the records of an image stay in slot order
+    obj_records = np.ascontiguousarray(obj_nodes[keep][:, :OBJECT_RECORD_SIZE])
+    return obj_offsets, obj_records
+
+
+def select_object_table(obj_offsets, obj_records, indices):
+    """Object table of a subset of the images.
+
+    Args:
+        obj_offsets: first record of every image, [n_images + 1]
+        obj_records: records of all images, [n_objects, 5]
+        indices: selected images
+
+    Returns:
+        obj_offsets and obj_records of the selected images
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    obj_offsets = np.asarray(obj_offsets)
+    starts = obj_offsets[indices]
+    counts = obj_offsets[indices + 1] - starts
+    selected_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(counts, out=selected_offsets[1:])
+    rows = np.repeat(starts - selected_offsets[:-1], counts) + np.arange(selected_offsets[-1])
+    return selected_offsets, np.asarray(obj_records)[rows]
+
+
+def gather_object_records(obj_offsets: torch.Tensor, obj_records: torch.Tensor, image_indices: torch.Tensor):
+    """Object records of the images of a batch of rays, read from the ragged object table.
+
+    The batch is padded to the object count of its fullest image only, padded slots hold the empty record.
+
+    Args:
+        obj_offsets: first record of every image, [n_images + 1]
+        obj_records: records of all images, [n_objects, 5]
+        image_indices: image of every ray, [...]
+
+    Returns:
+        object records of every ray, [..., n_batch_objects, 5]
+    """
+    image_indices = image_indices.to(obj_offsets.device).long()
+    starts = obj_offsets[image_indices]
+    counts = obj_offsets[image_indices + 1] - starts
+    n_objects = max(int(counts.max()) if counts.numel() > 0 else 0, 1)
+    empty = obj_records.new_tensor(EMPTY_OBJECT_RECORD)
+    if len(obj_records) == 0:
+        return empty.expand(*image_indices.shape, n_objects, OBJECT_RECORD_SIZE)
+    slots = torch.arange(n_objects, device=obj_offsets.device)
+    rows = torch.clamp(starts.unsqueeze(-1) + slots, max=len(obj_records) - 1)
+    return torch.where((slots < counts.unsqueeze(-1)).unsqueeze(-1), obj_records[rows], empty)
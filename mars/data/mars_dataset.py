@@ -17,12 +17,17 @@ nerual scene graph base dataset
 
 import os
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
 
 import imageio
 import numpy as np
 import torch
 
+from mars.data.mars_cache import (
+    get_depth_cache,
+    get_image_store,
+    get_semantic_label_cache,
+)
 from nerfstudio.data.dataparsers.base_dataparser import DataparserOutputs
 from nerfstudio.data.datasets.base_dataset import InputDataset
 from nerfstudio.data.utils.data_utils import (
@@ -38,6 +43,9 @@ class MarsDataset(InputDataset):
     Args:
         dataparser_outputs: description of where and how to read input images.
         scale_factor: The scaling factor for the dataparser outputs.
+        use_depth: Whether to load the depth maps.
+        use_semantic: Whether to load the semantic maps.
+        cache_dir: Directory of the preprocessed frame caches, caching is disabled if None.
 
     Returns:
         imgs: [n_frames, h, w, 3]
@@ -59,8 +67,15 @@ class MarsDataset(InputDataset):
         scale_factor: float = 1.0,
         use_depth: bool = False,
         use_semantic: bool = False,
+        cache_dir: Optional[Path] = None,
     ):
         super().__init__(dataparser_outputs, scale_factor)
+        # uint8 frames shared through the page cache, converted to float by the datamanager after sampling
+        self.image_store = None
+        if cache_dir is not None:
+            self.image_store, self.image_store_index = get_image_store(
+                self._dataparser_outputs.image_filenames, cache_dir
+            )
         assert (
             "depth_filenames" in dataparser_outputs.metadata.keys()
             and dataparser_outputs.metadata["depth_filenames"] is not None
@@ -73,11 +88,24 @@ class MarsDataset(InputDataset):
         if use_semantic:
             self.semantic_filenames = self.metadata["semantics"].filenames
             self.semantic_meta = self.metadata["semantics"]
+            # class id maps decoded once, instead of decoding and matching the colors on every access
+            self.semantic_labels = (
+                get_semantic_label_cache(self.semantic_meta, cache_dir) if cache_dir is not None else None
+            )
 
         self.use_depth = use_depth
         if use_depth:
             self.depth_filenames = self.metadata["depth_filenames"]
             self.depth_unit_scale_factor = 0.01  # VKITTI provide depth maps in centimeters
+            # raw depth at the camera resolution and packed validity masks, no decoding on access
+            self.depth_cache = None
+            if cache_dir is not None:
+                self.depth_cache = get_depth_cache(
+                    self.depth_filenames,
+                    self._dataparser_outputs.cameras.height.flatten().tolist(),
+                    self._dataparser_outputs.cameras.width.flatten().tolist(),
+                    cache_dir,
+                )
 
     def get_scene_images_tracking(self, l_image_filename):
         imgs = imageio.imread(l_image_filename)
@@ -91,7 +119,10 @@ class MarsDataset(InputDataset):
             image_idx: The image index in the dataset.
         """
         image_filename = self._dataparser_outputs.image_filenames[image_idx]
-        image = self.get_scene_images_tracking(image_filename)
+        if self.image_store is not None:
+            image = torch.from_numpy(self.image_store[self.image_store_index[str(image_filename)]])
+        else:
+            image = self.get_scene_images_tracking(image_filename)
         data = {"image_idx": image_idx}
         data["image"] = image
         metadata = self.get_metadata(data)
@@ -103,27 +134,36 @@ class MarsDataset(InputDataset):
         metadata = {}
 
         if self.use_depth:
-            filepath = self.depth_filenames[data["image_idx"]]
-            height = int(self._dataparser_outputs.cameras.height[data["image_idx"]])
-            width = int(self._dataparser_outputs.cameras.width[data["image_idx"]])
-
             # Scale depth images to meter units and also by scaling applied to cameras
             scale_factor = self.depth_unit_scale_factor * self._dataparser_outputs.dataparser_scale
-            depth_image = get_depth_image_from_path(
-                filepath=Path(filepath), height=height, width=width, scale_factor=scale_factor
-            )  # default interpolation cv2.INTER_NEAREST
-            depth_mask = torch.abs(depth_image / scale_factor - 65535) > 1e-6  # maskout no-depth input
+            if self.depth_cache is not None:
+                depth, packed_mask = self.depth_cache
+                raw_depth = depth[data["image_idx"]]
+                depth_image = torch.from_numpy(raw_depth.astype(np.float32) * scale_factor)[..., None]
+                depth_mask = np.unpackbits(packed_mask[data["image_idx"]], axis=-1, count=raw_depth.shape[-1])
+                depth_mask = torch.from_numpy(depth_mask.astype(bool))[..., None]
+            else:
+                filepath = self.depth_filenames[data["image_idx"]]
+                height = int(self._dataparser_outputs.cameras.height[data["image_idx"]])
+                width = int(self._dataparser_outputs.cameras.width[data["image_idx"]])
+                depth_image = get_depth_image_from_path(
+                    filepath=Path(filepath), height=height, width=width, scale_factor=scale_factor
+                )  # default interpolation cv2.INTER_NEAREST
+                depth_mask = torch.abs(depth_image / scale_factor - 65535) > 1e-6  # maskout no-depth input
 
             metadata["depth_image"] = depth_image
             metadata["depth_mask"] = depth_mask
 
         # semantic metadata
         if self.use_semantic:
-            filepath = self.semantic_filenames[data["image_idx"]]
-            semantics, mask = get_semantics_and_mask_tensors_from_path(
-                filepath=filepath, mask_indices=[], scale_factor=1.0
-            )
-
-            metadata["semantics"] = semantics
+            if self.semantic_labels is not None:
+                metadata["semantic_labels"] = torch.from_numpy(self.semantic_labels[data["image_idx"]])[..., None]
+            else:
+                filepath = self.semantic_filenames[data["image_idx"]]
+                semantics, mask = get_semantics_and_mask_tensors_from_path(
+                    filepath=filepath, mask_indices=[], scale_factor=1.0
+                )
+
+                metadata["semantics"] = semantics
 
         return metadata
@@ -15,6 +15,7 @@
 from __future__ import annotations
 
 import os
+import re
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Optional, Type
@@ -26,6 +27,14 @@ import torch
 from cv2 import sort
 from rich.console import Console
 
+from mars.data.mars_cache import get_scene_cache_path, load_or_build_array_bundle
+from mars.data.mars_dataparser_utils import (
+    extract_object_information,
+    get_object_table,
+    get_track_car_latents,
+    get_visible_objects,
+    select_object_table,
+)
 from mars.utils.neural_scene_graph_helper import box_pts
 from nerfstudio.cameras import camera_utils
 from nerfstudio.cameras.cameras import Cameras, CameraType
@@ -50,17 +59,24 @@ def kitti_string_to_float(str):
 
 
 def get_rotation(roll, pitch, heading):
+    """Rotation matrices [..., 3, 3] from roll, pitch and heading, given as scalars or arrays of the same shape"""
+
+    def stack_matrix(rows):
+        return np.stack([np.stack(row, axis=-1) for row in rows], axis=-2)
+
     s_heading = np.sin(heading)
     c_heading = np.cos(heading)
-    rot_z = np.array([[c_heading, -s_heading, 0], [s_heading, c_heading, 0], [0, 0, 1]])
+    zeros = np.zeros_like(c_heading)
+    ones = np.ones_like(c_heading)
+    rot_z = stack_matrix([[c_heading, -s_heading, zeros], [s_heading, c_heading, zeros], [zeros, zeros, ones]])
 
     s_pitch = np.sin(pitch)
     c_pitch = np.cos(pitch)
-    rot_y = np.array([[c_pitch, 0, s_pitch], [0, 1, 0], [-s_pitch, 0, c_pitch]])
+    rot_y = stack_matrix([[c_pitch, zeros, s_pitch], [zeros, ones, zeros], [-s_pitch, zeros, c_pitch]])
 
     s_roll = np.sin(roll)
     c_roll = np.cos(roll)
-    rot_x = np.array([[1, 0, 0], [0, c_roll, -s_roll], [0, s_roll, c_roll]])
+    rot_x = stack_matrix([[ones, zeros, zeros], [zeros, c_roll, -s_roll], [zeros, s_roll, c_roll]])
 
     rot = np.matmul(rot_z, np.matmul(rot_y, rot_x))
 
@@ -237,7 +253,6 @@ def get_poses_calibration(basedir, oxts_path_tracking=None, selected_frames=None
 
         In the KITTI dataset, the OXTS data is stored as plain text files with each line corresponding to a timestamp. Each line in the file contains the aforementioned measurements, which are used to compute the ground truth trajectory and 6-DoF motion of the vehicle. This information can be further used for calibration, data synchronization, and performance evaluation of various algorithms.
         """
-        poses = []
 
         def latlon_to_mercator(lat, lon, s):
             """
@@ -248,8 +263,8 @@ def get_poses_calibration(basedir, oxts_path_tracking=None, selected_frames=None
             This function uses the scale factor 's' to control the amount of distortion in the projection.
 
             Args:
-                lat (float): Latitude in degrees, range: -90 to 90.
-                lon (float): Longitude in degrees, range: -180 to 180.
+                lat (float or np.array): Latitude in degrees, range: -90 to 90.
+                lon (float or np.array): Longitude in degrees, range: -180 to 180.
                 s (float): Scale factor, typically the cosine of the reference latitude.
 
             Returns:
@@ -279,33 +294,28 @@ def get_poses_calibration(basedir, oxts_path_tracking=None, selected_frames=None
             pose_i[:3, :] = np.concatenate([rotation, translation[:, None]], axis=1)
             pose_0_inv = invert_transformation(pose_i[:3, :3], pose_i[:3, 3])
 
-        # Iterate through the OXTS data and compute the corresponding pose matrices
-        for oxts_val in oxts:
-            pose_i = np.zeros([4, 4])
-            pose_i[3, 3] = 1
-
-            [x, y] = latlon_to_mercator(oxts_val[0], oxts_val[1], scale)
-            z = oxts_val[2]
-            translation = np.array([x, y, z])
-
-            roll = oxts_val[3]
-            pitch = oxts_val[4]
-            heading = oxts_val[5]
-            rotation = get_rotation(roll, pitch, heading)  # (3,3)
-
-            pose_i[:3, :] = np.concatenate([rotation, translation[:, None]], axis=1)  # (4, 4)
-            if pose_0_inv is None:
-                pose_0_inv = invert_transformation(pose_i[:3, :3], pose_i[:3, 3])
-
-            pose_i = np.matmul(pose_0_inv, pose_i)
-            poses.append(pose_i)
+        # Compute the pose matrices of all OXTS rows at once
+        oxts = np.asarray(oxts)
+        [x, y] = latlon_to_mercator(oxts[:, 0], oxts[:, 1], scale)
+        z = oxts[:, 2]
+        poses = np.tile(np.eye(4), [len(oxts), 1, 1])
+        poses[:, :3, :3] = get_rotation(oxts[:, 3], oxts[:, 4], oxts[:, 5])  # roll, pitch, heading
+        poses[:, :3, 3] = np.stack([x, y, z], axis=-1)
+        if pose_0_inv is None:
+            pose_0_inv = invert_transformation(poses[0, :3, :3], poses[0, :3, 3])
 
-        return np.array(poses)
+        # Poses relative to the first (or the selected) frame (n_frames, 4, 4)
+        return np.matmul(pose_0_inv, poses)
 
     # If there is no tracking path specified, use the default path
     if oxts_path_tracking is None:
         oxts_path = os.path.join(basedir, "oxts/data")
-        oxts = np.array([np.loadtxt(os.path.join(oxts_path, file)) for file in sorted(os.listdir(oxts_path))])
+        oxts_lines = []
+        for file in sorted(os.listdir(oxts_path)):
+            with open(os.path.join(oxts_path, file), "r") as f:
+                oxts_lines.append(f.read().strip())
+        # one frame per file, parsed in a single bulk read
+        oxts = np.loadtxt(oxts_lines, ndmin=2)
         calibration_path = os.path.dirname(basedir)
 
         calibrations = calib_from_txt(calibration_path)
@@ -448,127 +458,96 @@ def get_obj_pose_tracking(tracklet_path, poses_imu_tracking, calibrations, selec
                 4: object type (as a float)
     """
 
-    # Helper function to generate a rotation matrix around the y-axis
-    def roty_matrix(roty):
-        c = np.cos(roty)
-        s = np.sin(roty)
-        return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
-
     # Extract calibration data
     velo2cam = calibrations["Tr_velo2cam"]
     imu2velo = calibrations["Tr_imu2velo"]
     cam2velo = invert_transformation(velo2cam[:3, :3], velo2cam[:3, 3])
     velo2imu = invert_transformation(imu2velo[:3, :3], imu2velo[:3, 3])
 
-    # Initialize dictionaries and lists to store object metadata and tracklets
-    objects_meta_kitti = {}
-    objects_meta = {}
-    tracklets_ls = []
-
     start_frame = selected_frames[0]
     end_frame = selected_frames[1]
 
-    # Read tracklets from file
-    f = open(tracklet_path)
-    tracklets_str = f.read().splitlines()
-
-    # Total number of frames in the scene
-    n_scene_frames = len(poses_imu_tracking)
-    # Initialize an array to count the number of objects in each frame
-    n_obj_in_frame = np.zeros(n_scene_frames)
-
-    # Extract metadata for all objects in the scene
-    for tracklet in tracklets_str:
-        tracklet = tracklet.split()
-        if float(tracklet[1]) < 0:
-            continue
-        id = tracklet[1]
-        if tracklet[2] in _sem2label:
-            type = _sem2label[tracklet[2]]
-            if not int(id) in objects_meta_kitti:
-                length = float(tracklet[12])
-                height = float(tracklet[10])
-                width = float(tracklet[11])
-                # length = float(tracklet[12])
-                # height = float(tracklet[10])
-                # width = float(tracklet[11])
-                objects_meta_kitti[int(id)] = np.array([float(id), type, length, height, width])
-
-            """
-            The first two elements (frame number and object ID) as float64.
-            The object type (converted from the semantic label) as a float.
-            The remaining elements of the tracklet (3D position, rotation, and dimensions) as float64.
-            """
-            tr_array = np.concatenate(
-                [np.array(tracklet[:2]).astype(np.float64), np.array([type]), np.array(tracklet[3:]).astype(np.float64)]
-            )
-            tracklets_ls.append(tr_array)
-            n_obj_in_frame[int(tracklet[0])] += 1
+    # Read tracklets from file in one call, keeping the tracked objects of the known classes
+    # round_trip parses the floats exactly like float()
+    tracklets = pd.read_csv(tracklet_path, sep=r"\s+", header=None, float_precision="round_trip")
+    tracklets = tracklets[(tracklets[1] >= 0) & tracklets[2].isin(list(_sem2label))]
+    frame_no = tracklets[0].to_numpy(np.int64)
+    track_id = tracklets[1].to_numpy(np.int64)
 
-    # Convert tracklets to a numpy array
-    tracklets_array = np.array(tracklets_ls)
+    # Metadata of all objects in the scene from their first tracklet: [object ID, type, length, height, width]
+    object_ids, first_tracklet, object_row = np.unique(track_id, return_index=True, return_inverse=True)
+    objects_meta_kitti = np.stack(
+        [
+            object_ids.astype(np.float64),
+            tracklets[2].map(_sem2label).to_numpy(np.float64)[first_tracklet],
+            tracklets[12].to_numpy(np.float64)[first_tracklet],
+            tracklets[10].to_numpy(np.float64)[first_tracklet],
+            tracklets[11].to_numpy(np.float64)[first_tracklet],
+        ],
+        axis=-1,
+    )
 
     # Find the maximum number of objects in a frame for the selected frames
+    n_obj_in_frame = np.bincount(frame_no, minlength=len(poses_imu_tracking))
     max_obj_per_frame = int(n_obj_in_frame[start_frame : end_frame + 1].max())
     # Initialize an array to store visible objects with dimensions [2*(end_frame-start_frame+1), max_obj_per_frame, 14]
     visible_objects = np.ones([(end_frame - start_frame + 1) * 2, max_obj_per_frame, 14]) * -1.0
 
-    # Iterate through the tracklets and process object data
-    for tracklet in tracklets_array:
-        frame_no = tracklet[0]
-        if start_frame <= frame_no <= end_frame:
-            obj_id = tracklet[1]
-            frame_id = np.array([frame_no])
-            id_int = int(obj_id)
-            obj_type = np.array([objects_meta_kitti[id_int][1]])
-            dim = objects_meta_kitti[id_int][-3:].astype(np.float32)
-
-            if id_int not in objects_meta:
-                objects_meta[id_int] = np.concatenate(
-                    [
-                        np.array([id_int]).astype(np.float32),
-                        objects_meta_kitti[id_int][2:].astype(np.float64),
-                        np.array([objects_meta_kitti[id_int][1]]).astype(np.float64),
-                    ]
-                )
-
-            # Extract object pose data from tracklet
-            pose = tracklet[-4:]
-
-            # Initialize a 4x4 identity matrix for object pose in camera coordinates
-            obj_pose_c = np.eye(4)
-            obj_pose_c[:3, 3] = pose[:3]
-            roty = pose[3]
-            obj_pose_c[:3, :3] = roty_matrix(roty)
-
-            # Transform object pose from camera coordinates to IMU coordinates
-            obj_pose_imu = np.matmul(velo2imu, np.matmul(cam2velo, obj_pose_c))
-
-            # Get the IMU pose for the corresponding frame
-            pose_imu_w_frame_i = poses_imu_tracking[int(frame_id)]
-
-            # Calculate the world pose of the object
-            pose_obj_w_i = np.matmul(pose_imu_w_frame_i, obj_pose_imu)
-            pose_obj_w_i = np.matmul(transform_matrix, pose_obj_w_i)
-            # pose_obj_w_i[:, 3] *= scale_factor
-
-            # Calculate the approximate yaw angle of the object in the world frame
-            yaw_aprox = -np.arctan2(pose_obj_w_i[1, 0], pose_obj_w_i[0, 0])
-
-            # TODO: Change if necessary
-            is_moving = 1.0
-
-            # Create a 7-element array representing the 3D pose of the object
-            pose_3d = np.array([pose_obj_w_i[0, 3], pose_obj_w_i[1, 3], pose_obj_w_i[2, 3], yaw_aprox, 0, 0, is_moving])
-
-            # Iterate through the available cameras
-            for j, cam in enumerate(camera_ls):
-                cam = np.array(cam).astype(np.float32)[None]
-                # Create an array representing the object data for this camera view
-                obj = np.concatenate([frame_id, cam, np.array([obj_id]), obj_type, dim, pose_3d])
-                frame_cam_id = (int(frame_no) - start_frame) + j * (end_frame + 1 - start_frame)
-                obj_column = np.argwhere(visible_objects[frame_cam_id, :, 0] < 0).min()
-                visible_objects[frame_cam_id, obj_column] = obj
+    selected = (start_frame <= frame_no) & (frame_no <= end_frame)
+    frame_no = frame_no[selected]
+    object_row = object_row[selected]
+    # Extract object pose data from tracklets: x, y, z and rotation around the y-axis in camera coordinates
+    pose = tracklets.iloc[:, -4:].to_numpy(np.float64)[selected]
+
+    # Objects of the selected frames, in the order of their first appearance
+    _, first_appearance = np.unique(object_row, return_index=True)
+    objects_meta = {}
+    for row in object_row[np.sort(first_appearance)]:
+        id_int = int(objects_meta_kitti[row, 0])
+        objects_meta[id_int] = np.concatenate(
+            [
+                np.array([id_int]).astype(np.float32),
+                objects_meta_kitti[row, 2:].astype(np.float64),
+                np.array([objects_meta_kitti[row, 1]]).astype(np.float64),
+            ]
+        )
+
+    # Object poses in camera coordinates [n_tracklets, 4, 4]
+    cos_roty = np.cos(pose[:, 3])
+    sin_roty = np.sin(pose[:, 3])
+    obj_pose_c = np.tile(np.eye(4), [len(pose), 1, 1])
+    obj_pose_c[:, :3, 3] = pose[:, :3]
+    obj_pose_c[:, 0, 0] = cos_roty
+    obj_pose_c[:, 0, 2] = sin_roty
+    obj_pose_c[:, 2, 0] = -sin_roty
+    obj_pose_c[:, 2, 2] = cos_roty
+
+    # Transform object poses from camera coordinates to IMU coordinates and then to the world,
+    # batched with the same association as the per tracklet transforms
+    obj_pose_imu = np.matmul(velo2imu, np.matmul(cam2velo, obj_pose_c))
+    pose_obj_w = np.matmul(np.asarray(poses_imu_tracking)[frame_no], obj_pose_imu)
+    pose_obj_w = np.matmul(transform_matrix, pose_obj_w)
+
+    # Calculate the approximate yaw angle of the objects in the world frame
+    yaw_aprox = -np.arctan2(pose_obj_w[:, 1, 0], pose_obj_w[:, 0, 0])
+
+    # [frame, camera, object ID, type, length, height, width, x, y, z, yaw, 0, 0, is_moving]
+    # TODO: Change is_moving if necessary
+    obj = np.zeros([len(pose), 14])
+    obj[:, 0] = frame_no
+    obj[:, 2] = objects_meta_kitti[object_row, 0]
+    obj[:, 3] = objects_meta_kitti[object_row, 1]
+    obj[:, 4:7] = objects_meta_kitti[object_row, 2:].astype(np.float32)
+    obj[:, 7:10] = pose_obj_w[:, :3, 3]
+    obj[:, 10] = yaw_aprox
+    obj[:, 13] = 1.0
+
+    # Objects fill the free slots of their frame in the order of the tracklets
+    obj_column = pd.Series(frame_no).groupby(frame_no).cumcount().to_numpy()
+    for j, cam in enumerate(camera_ls):
+        obj[:, 1] = np.array(cam).astype(np.float32)
+        frame_cam_id = (frame_no - start_frame) + j * (end_frame + 1 - start_frame)
+        visible_objects[frame_cam_id, obj_column] = obj
 
     # # Remove not moving objects
     # print("Removing non moving objects")
@@ -593,48 +572,67 @@ def get_obj_pose_tracking(tracklet_path, poses_imu_tracking, calibrations, selec
     return visible_objects, objects_meta
 
 
+def get_frame_index(frame_dir):
+    """Map the frame numbers parsed from the filenames of a directory to their paths, scanning it only once."""
+    frame_index = {}
+    for frame in os.listdir(frame_dir):
+        frame_no = re.findall(r"\d+", os.path.splitext(frame)[0])
+        if not frame_no:
+            raise ValueError(f"Cannot parse a frame number from {os.path.join(frame_dir, frame)}")
+        frame_no = int(frame_no[-1])
+        if frame_no in frame_index:
+            raise ValueError(f"Frame {frame_no} appears twice in {frame_dir}")
+        frame_index[frame_no] = os.path.join(frame_dir, frame)
+    return frame_index
+
+
+def get_stereo_frame_indices(left_dir, right_dir):
+    """Frame indices of the left and right cameras, checking that both cameras have the same frames."""
+    left_index = get_frame_index(left_dir)
+    right_index = get_frame_index(right_dir)
+    if left_index.keys() != right_index.keys():
+        raise ValueError(
+            f"Left and right cameras have different frames: {len(left_index)} frames in {left_dir}, "
+            f"{len(right_index)} frames in {right_dir}"
+        )
+    return [left_index, right_index]
+
+
+def select_frames(frame_index, start_frame, end_frame):
+    """Paths of the frames in [start_frame, end_frame] present in a frame index, in frame order."""
+    return [frame_index[frame_no] for frame_no in sorted(frame_index) if start_frame <= frame_no <= end_frame]
+
+
 def get_scene_images_tracking(
     tracking_path, sequence, selected_frames, use_depth=False, use_semantic=False, semantic_path=None
 ):
     [start_frame, end_frame] = selected_frames
-    # imgs = []
     img_name = []
     depth_name = []
     semantic_name = []
 
+    # every directory is scanned once, the images, depth and semantics lookups share the frame indices
     left_img_path = os.path.join(os.path.join(tracking_path, "image_02"), sequence)
     right_img_path = os.path.join(os.path.join(tracking_path, "image_03"), sequence)
+    img_indices = get_stereo_frame_indices(left_img_path, right_img_path)
+    for frame_index in img_indices:
+        img_name += select_frames(frame_index, start_frame, end_frame)
 
     if use_depth:
         left_depth_path = os.path.join(os.path.join(tracking_path, "completion_02"), sequence)
         right_depth_path = os.path.join(os.path.join(tracking_path, "completion_03"), sequence)
-
-    for frame_dir in [left_img_path, right_img_path]:
-        for frame_no in range(len(os.listdir(left_img_path))):
-            if start_frame <= frame_no <= end_frame:
-                frame = sorted(os.listdir(frame_dir))[frame_no]
-                fname = os.path.join(frame_dir, frame)
-                # imgs.append(imageio.imread(fname))
-                img_name.append(fname)
-
-    if use_depth:
-        for frame_dir in [left_depth_path, right_depth_path]:
-            for frame_no in range(len(os.listdir(left_depth_path))):
-                if start_frame <= frame_no <= end_frame:
-                    frame = sorted(os.listdir(frame_dir))[frame_no]
-                    fname = os.path.join(frame_dir, frame)
-                    depth_name.append(fname)
+        for frame_index in get_stereo_frame_indices(left_depth_path, right_depth_path):
+            depth_name += select_frames(frame_index, start_frame, end_frame)
+        if len(depth_name) != len(img_name):
+            raise ValueError(f"Found {len(depth_name)} depth maps for {len(img_name)} images of sequence {sequence}")
 
     if use_semantic:
         frame_dir = os.path.join(semantic_path, "train", sequence)
+        semantic_index = get_frame_index(frame_dir)
+        # the semantic maps of the left camera are used for both cameras
         for _ in range(2):
-            for frame_no in range(len(os.listdir(frame_dir))):
-                if start_frame <= frame_no <= end_frame:
-                    frame = sorted(os.listdir(frame_dir))[frame_no]
-                    fname = os.path.join(frame_dir, frame)
-                    semantic_name.append(fname)
+            semantic_name += select_frames(semantic_index, start_frame, end_frame)
 
-    # imgs = (np.maximum(np.minimum(np.array(imgs), 255), 0) / 255.0).astype(np.float32)
     return img_name, depth_name, semantic_name
 
 
@@ -776,92 +774,6 @@ def get_all_ray_3dbox_intersection(rays_rgb, obj_meta_tensor, chunk, local=False
     return rays_on_obj, rays_to_remove, box_points_insters
 
 
-def extract_object_information(args, visible_objects, objects_meta):
-    """Get object and object network properties for the given sequence
-
-    Args:
-        args:
-            args.object_setting are experimental settings for object networks inputs, set to 0 for current version
-        visible_objects: Objects per frame + Pose and other dynamic properties + tracking ID
-        objects_meta: Metadata with additional static object information sorted by tracking ID
-
-    Retruns:
-        obj_properties [n_input_frames, n_max_objects, n_object_properties, 0]: Object properties per frame
-        add_input_rows: 2
-        obj_meta_ls: List of object metadata
-        scene_objects: List of objects per frame
-        scene_classes: List of object classes per frame
-    Notes:
-        obj_properties: x,y,z,yaw_angle,track_id, 0
-    """
-    if args.dataset_type == "vkitti":
-        # [n_frames, n_max_obj, xyz+track_id+ismoving+0]
-        obj_state = visible_objects[:, :, [7, 8, 9, 2, -1]]
-
-        obj_dir = visible_objects[:, :, 10][..., None]
-        # [..., width+height+length]
-        # obj_dim = visible_objects[:, :, 4:7]
-        sh = obj_state.shape
-    elif args.dataset_type == "waymo_od":
-        obj_state = visible_objects[:, :, [7, 8, 9, 2, -1]]
-        obj_dir = visible_objects[:, :, 10][..., None]
-        sh = obj_state.shape
-    elif args.dataset_type == "kitti":
-        obj_state = visible_objects[:, :, [7, 8, 9, 2, 3]]  # [x,y,z,track_id,class_id]
-        obj_dir = visible_objects[:, :, 10][..., None]  # yaw_angle
-        sh = obj_state.shape
-
-    # obj_state: [cam, n_obj, [x,y,z,track_id, class_id]]
-
-    # [n_frames, n_max_obj]
-    obj_track_id = obj_state[..., 3][..., None]
-    obj_class_id = obj_state[..., 4][..., None]
-    # Change track_id to row in list(objects_meta)
-    obj_meta_ls = list(objects_meta.values())  # object_id, length, height, width, class_id
-    # Add first row for no objects
-    obj_meta_ls.insert(0, np.zeros_like(obj_meta_ls[0]))
-    obj_meta_ls[0][0] = -1
-    # Build array describing the relation between metadata IDs and where its located
-    row_to_track_id = np.concatenate(
-        [
-            np.linspace(0, len(objects_meta.values()), len(objects_meta.values()) + 1)[:, None],
-            np.array(obj_meta_ls)[:, 0][:, None],
-        ],
-        axis=1,
-    ).astype(np.int32)
-    # [n_frames, n_max_obj]
-    track_row = np.zeros_like(obj_track_id)
-
-    scene_objects = []
-    scene_classes = list(np.unique(np.array(obj_meta_ls)[..., 4]))
-    for i, frame_objects in enumerate(obj_track_id):
-        for j, camera_objects in enumerate(frame_objects):
-            track_row[i, j] = np.argwhere(row_to_track_id[:, 1] == camera_objects)
-            if camera_objects >= 0 and not camera_objects in scene_objects:
-                # print(camera_objects, "in this scene")
-                scene_objects.append(camera_objects)
-    CONSOLE.log(f"{scene_objects} in this scene.")
-
-    obj_properties = np.concatenate([obj_state[..., :3], obj_dir, track_row], axis=2)
-
-    if obj_properties.shape[-1] % 3 > 0:
-        if obj_properties.shape[-1] % 3 == 1:
-            obj_properties = np.concatenate([obj_properties, np.zeros([sh[0], sh[1], 2])], axis=2).astype(np.float32)
-        else:
-            obj_properties = np.concatenate([obj_properties, np.zeros([sh[0], sh[1], 1])], axis=2).astype(np.float32)
-
-    add_input_rows = int(obj_properties.shape[-1] / 3)
-
-    obj_meta_ls = [
-        (obj * np.array([1.0, args.box_scale, 1.0, args.box_scale, 1.0])).astype(np.float32)
-        if obj[4] != 4
-        else obj * np.array([1.0, 1.2, 1.0, 1.2, 1.0])
-        for obj in obj_meta_ls
-    ]  # [n_obj, [track_id, length * box_scale/1.2, height, width * box_scale/1.2, class_id]] 1.2 for humans, box_scale for other objects
-
-    return obj_properties, add_input_rows, obj_meta_ls, scene_objects, scene_classes
-
-
 @dataclass
 class MarsKittiDataParserConfig(DataParserConfig):
     """nerual scene graph dataset parser config"""
@@ -921,6 +833,11 @@ class MarsKittiDataParserConfig(DataParserConfig):
     """path of semantic inputs"""
     semantic_mask_classes: List[str] = field(default_factory=lambda: [])
     """semantic classes that do not generate gradient to the background model"""
+    cull_invisible_objects: bool = True
+    """Build a second object table with only the objects in the view frustum of each image, read for the training
+    rays. Rendering and evaluation keep the full table."""
+    cache_dir: Optional[Path] = None
+    """Directory of the parsed scene and car latent caches, caching is disabled if None."""
 
 
 @dataclass
@@ -956,22 +873,36 @@ class MarsKittiParser(DataParser):
         self.use_semantic = config.use_semantic
         self.semantic_path = config.semantic_path
 
-    def _generate_dataparser_outputs(self, split="train"):
+    def _get_scene_paths(self):
+        basedir = str(self.data)
+        scene_id = basedir[-4:]  # check
+        tracking_path = basedir[:-13]  # check
+        return basedir, scene_id, tracking_path
+
+    def _get_scene_sources(self):
+        """Files and directories read by _parse_scene"""
+        _, scene_id, tracking_path = self._get_scene_paths()
+        sources = [os.path.join(tracking_path, source, scene_id + ".txt") for source in ["calib", "oxts", "label_02"]]
+        frame_dirs = ["image_02", "image_03"] + (["completion_02", "completion_03"] if self.config.use_depth else [])
+        sources += [os.path.join(tracking_path, frame_dir, scene_id) for frame_dir in frame_dirs]
+        if self.use_semantic:
+            sources.append(os.path.join(self.semantic_path, "train", scene_id))
+        return sources
+
+    def _parse_scene(self):
+        """Parse the split independent part of the scene: poses, intrinsics, object nodes and metadata, file lists
+
+        Returns:
+            arrays and JSON serializable metadata of the scene, the layout of the parsed scene cache
+        """
         visible_objects_ls = []
         objects_meta_ls = []
-        semantic_meta = []
         kitti2vkitti = np.array(
             [[1.0, 0.0, 0.0, 0.0], [0.0, 0.0, -1.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 0.0, 1.0]]
         )
-        if self.alpha_color is not None:
-            alpha_color_tensor = get_color(self.alpha_color)
-        else:
-            alpha_color_tensor = None
 
-        basedir = str(self.data)
-        scene_id = basedir[-4:]  # check
+        basedir, scene_id, tracking_path = self._get_scene_paths()
         kitti_scene_no = int(scene_id)
-        tracking_path = basedir[:-13]  # check
         calibration_path = os.path.join(os.path.join(tracking_path, "calib"), scene_id + ".txt")
         oxts_path_tracking = os.path.join(os.path.join(tracking_path, "oxts"), scene_id + ".txt")
         tracklet_path = os.path.join(os.path.join(tracking_path, "label_02"), scene_id + ".txt")
@@ -985,21 +916,6 @@ class MarsKittiParser(DataParser):
         tr_velo2imu = invert_transformation(tr_imu2velo[:3, :3], tr_imu2velo[:3, 3])
         poses_velo_w_tracking = np.matmul(poses_imu_w_tracking, tr_velo2imu)  # (n_frames, 4, 4) velodyne pose
 
-        if self.use_semantic:
-            semantics = pd.read_csv(
-                os.path.join(self.semantic_path, "colors", scene_id + ".txt"),
-                sep=" ",
-                index_col=False,
-            )
-
-        if self.use_semantic:
-            semantics = semantics.loc[~semantics["Category"].isin(self.config.semantic_mask_classes)]
-            semantic_meta = Semantics(
-                filenames=[],
-                classes=semantics["Category"].tolist(),
-                colors=torch.tensor(semantics.iloc[:, 1:].values),
-                mask_classes=self.config.semantic_mask_classes,
-            )
         # Get camera Poses   camare id: 02, 03
         for cam_i in range(2):
             transformation = np.eye(4)
@@ -1183,7 +1099,6 @@ class MarsKittiParser(DataParser):
 
         test_load_image = imageio.imread(image_filenames[0])
         image_height, image_width = test_load_image.shape[:2]
-        cx, cy = image_width / 2.0, image_height / 2.0
 
         # Extract objects positions and labels
         if self.use_object_properties or self.bckg_only:
@@ -1194,11 +1109,99 @@ class MarsKittiParser(DataParser):
             n_input_frames = obj_nodes.shape[0]
             obj_nodes[..., :3] *= self.scale_factor
             obj_nodes = np.reshape(obj_nodes, [n_input_frames, self.max_input_objects * add_input_rows, 3])
-        obj_meta_tensor = torch.from_numpy(np.array(obj_meta_ls, dtype="float32"))  # TODO
+        obj_metadata = np.array(obj_meta_ls, dtype="float32")  # TODO
 
-        obj_meta_tensor[..., 1:4] *= self.scale_factor
+        obj_metadata[..., 1:4] *= self.scale_factor
         poses[..., :3, 3] *= self.scale_factor
 
+        # principal point of the cameras built for every split
+        cx, cy = image_width / 2.0, image_height / 2.0
+        obj_offsets, obj_records = get_object_table(obj_nodes, add_input_rows)
+        self.config.max_input_objects = self.max_input_objects = int(np.diff(obj_offsets).max(initial=0))
+
+        arrays = {
+            "poses": poses,
+            "obj_offsets": obj_offsets,
+            "obj_records": obj_records,
+            "obj_metadata": obj_metadata,
+            "i_train": i_train,
+            "i_test": i_test,
+        }
+        if self.config.cull_invisible_objects and len(obj_nodes) == len(poses):
+            # table of the visible objects of every image for the training rays, fewer object slots to test per ray
+            visible = get_visible_objects(
+                obj_nodes,
+                obj_metadata,
+                poses,
+                [focal_X, focal_Y],
+                [cx, cy],
+                [image_height, image_width],
+                add_input_rows,
+            )
+            arrays["sample_obj_offsets"], arrays["sample_obj_records"] = get_object_table(
+                obj_nodes, add_input_rows, visible
+            )
+
+        meta = {
+            "image_filenames": image_filenames,
+            "depth_filenames": depth_name,
+            "semantic_filenames": semantic_name,
+            "focal": [float(focal_X), float(focal_Y)],
+            "image_size": [int(image_height), int(image_width)],
+            "principal_point": [float(cx), float(cy)],
+            "add_input_rows": int(add_input_rows),
+            "max_input_objects": int(self.max_input_objects),
+            "scene_objects": [float(obj) for obj in scene_objects],
+            "scene_classes": [float(obj_class) for obj_class in scene_classes],
+        }
+        return arrays, meta
+
+    def _generate_dataparser_outputs(self, split="train"):
+        semantic_meta = []
+        if self.alpha_color is not None:
+            alpha_color_tensor = get_color(self.alpha_color)
+        else:
+            alpha_color_tensor = None
+
+        _, scene_id, _ = self._get_scene_paths()
+        if self.use_semantic:
+            semantics = pd.read_csv(
+                os.path.join(self.semantic_path, "colors", scene_id + ".txt"),
+                sep=" ",
+                index_col=False,
+            )
+
+        if self.use_semantic:
+            semantics = semantics.loc[~semantics["Category"].isin(self.config.semantic_mask_classes)]
+            semantic_meta = Semantics(
+                filenames=[],
+                classes=semantics["Category"].tolist(),
+                colors=torch.tensor(semantics.iloc[:, 1:].values),
+                mask_classes=self.config.semantic_mask_classes,
+            )
+
+        # the split independent parse is cached, a warm start skips parsing
+        if self.config.cache_dir is not None:
+            cache_path = get_scene_cache_path(self.config.cache_dir, self.config, self._get_scene_sources())
+            arrays, meta = load_or_build_array_bundle(cache_path, self._parse_scene)
+        else:
+            arrays, meta = self._parse_scene()
+        poses = arrays["poses"]
+        i_train = arrays["i_train"]
+        i_test = arrays["i_test"]
+        obj_meta_tensor = torch.from_numpy(np.array(arrays["obj_metadata"]))
+        image_filenames = meta["image_filenames"]
+        depth_name = meta["depth_filenames"]
+        semantic_name = meta["semantic_filenames"]
+        focal_X, focal_Y = meta["focal"]
+        image_height, image_width = meta["image_size"]
+        cx, cy = meta["principal_point"]
+        add_input_rows = meta["add_input_rows"]
+        scene_objects = meta["scene_objects"]
+        scene_classes = meta["scene_classes"]
+        sequ_frames = self.selected_frames
+        self.config.max_input_objects = self.max_input_objects = meta["max_input_objects"]
+
         self.config.add_input_rows = add_input_rows
         if split == "train":
             indices = i_train
@@ -1222,36 +1225,22 @@ class MarsKittiParser(DataParser):
 
         # print("adding object nodes to each ray")
         # rays_rgb_env = rays_rgb
-        input_size = 0
-
-        obj_nodes_tensor = torch.from_numpy(obj_nodes)
-        # if self.config.fast_loading:
-        #     obj_nodes_tensor = obj_nodes_tensor.cuda()
-        
-        obj_nodes_tensor = obj_nodes_tensor.unsqueeze(1).unsqueeze(1)
-
-        obj_size = self.max_input_objects * add_input_rows
-        input_size += obj_size
-        # [N, ro+rd+rgb+obj_nodes, H, W, 3]
-        # rays_rgb_env = np.concatenate([rays_rgb_env, obj_nodes], 1)
-
-        # [N, H, W, ro+rd+rgb+obj_nodes*max_obj, 3]
-        # with obj_nodes [(x+y+z)*max_obj + (obj_id+is_training+0)*max_obj]
-        
-        obj_info = obj_nodes_tensor[indices, ...]
-
         # """
-        # obj_info: n_images * image height * image width * (rays_o, rays_d, rgb, add_input_rows * n_max_obj) * 3
-        # add_input_rows = 2 for kitti:
-        #     the object info is represented as a 6-dim vector (~2*3, add_input_rows=2):
+        # ragged object table of the split, the objects of image i are obj_records[obj_offsets[i] : obj_offsets[i + 1]]
+        # each object record is a 5-dim vector:
         #     0~2. x, y, z position of the object
         #     3. yaw angle of the object
         #     4. object id: not track id. track_id = obj_meta[object_id][0]
-        #     5. 0 (no use, empty digit)
         # """
-        # obj_info = torch.from_numpy(
-        #     np.reshape(rays_rgb, [image_n, image_height, image_width, 3 + input_size, 3])[:, :, :, 3:, :]
-        # )
+        obj_offsets, obj_records = select_object_table(arrays["obj_offsets"], arrays["obj_records"], indices)
+        object_tables = {"obj_offsets": torch.from_numpy(obj_offsets), "obj_records": torch.from_numpy(obj_records)}
+        if "sample_obj_offsets" in arrays:
+            # culled table of the training rays, rendering and evaluation keep every object
+            sample_offsets, sample_records = select_object_table(
+                arrays["sample_obj_offsets"], arrays["sample_obj_records"], indices
+            )
+            object_tables["sample_obj_offsets"] = torch.from_numpy(sample_offsets)
+            object_tables["sample_obj_records"] = torch.from_numpy(sample_records)
 
         image_filenames = [image_filenames[i] for i in indices]
         depth_filenames = [depth_name[i] for i in indices] if self.config.use_depth else None
@@ -1263,22 +1252,9 @@ class MarsKittiParser(DataParser):
             if not self.config.car_object_latents_path.exists():
                 CONSOLE.print("[yello]Error: latents not exist")
                 exit()
-            car_latents = torch.load(str(self.config.car_object_latents_path))
-            track_car_latents = {}
-            track_car_latents_mean = {}
-            for k, idx in enumerate(car_latents["indices"]):
-                if sequ_frames[0] <= idx["fid"] <= sequ_frames[1]:
-                    if idx["oid"] in track_car_latents.keys():
-                        track_car_latents[idx["oid"]] = torch.cat(
-                            [track_car_latents[idx["oid"]], car_latents["latents"][k].unsqueeze(-1)], dim=-1
-                        )
-                    else:
-                        track_car_latents[idx["oid"]] = car_latents["latents"][k].unsqueeze(-1)
-            for k in track_car_latents.keys():
-                track_car_latents_mean[k] = track_car_latents[k][..., -1]
-
-        else:
-            car_latents = None
+            track_car_latents_mean = get_track_car_latents(
+                self.config.car_object_latents_path, sequ_frames, self.config.cache_dir
+            )
 
         aabb_scale = self.config.scene_scale
         scene_box = SceneBox(
@@ -1310,7 +1286,7 @@ class MarsKittiParser(DataParser):
                 "obj_metadata": obj_meta_tensor if len(obj_meta_tensor) > 0 else None,
                 "obj_class": scene_classes if len(scene_classes) > 0 else None,
                 "scene_obj": scene_objects if len(scene_objects) > 0 else None,
-                "obj_info": obj_info if len(obj_info) > 0 else None,
+                **object_tables,
                 "scale_factor": self.scale_factor,
                 "semantics": semantic_meta,
             },
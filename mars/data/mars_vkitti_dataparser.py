@@ -26,6 +26,14 @@ import torch
 from PIL import Image
 from rich.console import Console
 
+from mars.data.mars_cache import get_scene_cache_path, load_or_build_array_bundle
+from mars.data.mars_dataparser_utils import (
+    extract_object_information,
+    get_object_table,
+    get_track_car_latents,
+    get_visible_objects,
+    select_object_table,
+)
 from nerfstudio.cameras.cameras import Cameras, CameraType
 from nerfstudio.data.dataparsers.base_dataparser import (
     DataParser,
@@ -43,93 +51,6 @@ _sem2label = {"Misc": -1, "Car": 0, "Van": 0, "Truck": 2, "Tram": 3, "Pedestrian
 camera_ls = [2, 3]
 
 
-def extract_object_information(args, visible_objects, objects_meta):
-    """Get object and object network properties for the given sequence
-
-    Args:
-        args:
-            args.object_setting are experimental settings for object networks inputs, set to 0 for current version
-        visible_objects: Objects per frame + Pose and other dynamic properties + tracking ID
-        objects_meta: Metadata with additional static object information sorted by tracking ID
-
-    Retruns:
-        obj_properties [n_input_frames, n_max_objects, n_object_properties, 0]: Object properties per frame
-        add_input_rows: 2
-        obj_meta_ls: List of object metadata
-        scene_objects: List of objects per frame
-        scene_classes: List of object classes per frame
-    Notes:
-        obj_properties: x,y,z,yaw_angle,track_id, 0
-    """
-    if args.dataset_type == "vkitti":
-        # [n_frames, n_max_obj, xyz+track_id+ismoving+0]
-        obj_state = visible_objects[:, :, [7, 8, 9, 2, -1]]
-
-        obj_dir = visible_objects[:, :, 10][..., None]
-        # [..., width+height+length]
-        # obj_dim = visible_objects[:, :, 4:7]
-        sh = obj_state.shape
-    elif args.dataset_type == "waymo_od":
-        obj_state = visible_objects[:, :, [7, 8, 9, 2, -1]]
-        obj_dir = visible_objects[:, :, 10][..., None]
-        sh = obj_state.shape
-    elif args.dataset_type == "kitti":
-        obj_state = visible_objects[:, :, [7, 8, 9, 2, 3]]  # [x,y,z,track_id,class_id]
-        obj_dir = visible_objects[:, :, 10][..., None]  # yaw_angle
-        sh = obj_state.shape
-    else:
-        raise Exception("Invalid dataset name.")
-
-    # obj_state: [cam, n_obj, [x,y,z,track_id, class_id]]
-
-    # [n_frames, n_max_obj]
-    obj_track_id = obj_state[..., 3][..., None]
-    obj_class_id = obj_state[..., 4][..., None]
-    # Change track_id to row in list(objects_meta)
-    obj_meta_ls = list(objects_meta.values())  # object_id, length, height, width, class_id
-    # Add first row for no objects
-    obj_meta_ls.insert(0, np.zeros_like(obj_meta_ls[0]))
-    obj_meta_ls[0][0] = -1
-    # Build array describing the relation between metadata IDs and where its located
-    row_to_track_id = np.concatenate(
-        [
-            np.linspace(0, len(objects_meta.values()), len(objects_meta.values()) + 1)[:, None],
-            np.array(obj_meta_ls)[:, 0][:, None],
-        ],
-        axis=1,
-    ).astype(np.int32)
-    # [n_frames, n_max_obj]
-    track_row = np.zeros_like(obj_track_id)
-
-    scene_objects = []
-    scene_classes = list(np.unique(np.array(obj_meta_ls)[..., 4]))
-    for i, frame_objects in enumerate(obj_track_id):
-        for j, camera_objects in enumerate(frame_objects):
-            track_row[i, j] = np.argwhere(row_to_track_id[:, 1] == camera_objects)
-            if camera_objects >= 0 and not camera_objects in scene_objects:
-                scene_objects.append(camera_objects)
-    CONSOLE.print(f"{scene_objects} in this scene")
-
-    obj_properties = np.concatenate([obj_state[..., :3], obj_dir, track_row], axis=2)
-
-    if obj_properties.shape[-1] % 3 > 0:
-        if obj_properties.shape[-1] % 3 == 1:
-            obj_properties = np.concatenate([obj_properties, np.zeros([sh[0], sh[1], 2])], axis=2).astype(np.float32)
-        else:
-            obj_properties = np.concatenate([obj_properties, np.zeros([sh[0], sh[1], 1])], axis=2).astype(np.float32)
-
-    add_input_rows = int(obj_properties.shape[-1] / 3)
-
-    obj_meta_ls = [
-        (obj * np.array([1.0, args.box_scale, 1.0, args.box_scale, 1.0])).astype(np.float32)
-        if obj[4] != 4
-        else obj * np.array([1.0, 1.2, 1.0, 1.2, 1.0])
-        for obj in obj_meta_ls
-    ]  # [n_obj, [track_id, length * box_scale/1.2, height, width * box_scale/1.2, class_id]] 1.2 for humans, box_scale for other objects
-
-    return obj_properties, add_input_rows, obj_meta_ls, scene_objects, scene_classes
-
-
 def _get_objects_by_frame(object_pose, object_meta, max_obj, n_cam, selected_frames, row_id):
     """
 
@@ -145,54 +66,46 @@ def _get_objects_by_frame(object_pose, object_meta, max_obj, n_cam, selected_fra
         visible_objects: all objects in the selected sequence of frames
         max_obj: Maximum number of objects in the selected sequence of frames
     """
-    visible_objects = []
-    frame_objects = []
-    max_in_frames = 0
-    const_pad = (0, 0)
+    const_pad = -1 if row_id else 0
 
     #### DEBUG
     ### TODO: Later specify ignored objects as arg
     ignore_objs = [16.0, 17.0, 18.0, 19.0]  # [12.]
 
-    if row_id:
-        const_pad = (-1, -1)
-
-    for cam in range(n_cam):
-        for obj_pose in object_pose:
-            if obj_pose[2] not in ignore_objs:
-                if obj_pose[1] == cam:
-                    if selected_frames[0] <= obj_pose[0] <= selected_frames[1]:
-                        if frame_objects:
-                            if not all(frame_objects[-1][:2] == obj_pose[:2]):
-                                max_in_frames = (
-                                    len(frame_objects) if max_in_frames < len(frame_objects) else max_in_frames
-                                )
-                                frame_objects = np.pad(
-                                    np.array(frame_objects),
-                                    ((0, max_obj - len(frame_objects)), (0, 0)),
-                                    "constant",
-                                    constant_values=const_pad,
-                                )
-                                visible_objects.append(frame_objects)
-                                frame_objects = []
-
-                        label = object_meta[obj_pose[2]][1:4]
-                        obj_pose = np.concatenate((obj_pose, label))
-
-                        frame_objects.append(obj_pose)
-
-    max_in_frames = len(frame_objects) if max_in_frames < len(frame_objects) else max_in_frames
-    frame_objects = np.pad(
-        np.array(frame_objects), ((0, max_obj - len(frame_objects)), (0, 0)), "constant", constant_values=const_pad
+    selected = (
+        ~np.isin(object_pose[:, 2], ignore_objs)
+        & np.isin(object_pose[:, 1], np.arange(n_cam))
+        & (selected_frames[0] <= object_pose[:, 0])
+        & (object_pose[:, 0] <= selected_frames[1])
     )
-    visible_objects.append(frame_objects)
+    # objects of camera 0 first, then camera 1, ... in the order of object_pose
+    object_pose = object_pose[selected]
+    object_pose = object_pose[np.argsort(object_pose[:, 1], kind="stable")]
+
+    # append the dimensions of the objects
+    track_ids, object_row = np.unique(object_pose[:, 2], return_inverse=True)
+    labels = np.array([object_meta[track_id][1:4] for track_id in track_ids]).reshape(-1, 3)
+    object_pose = np.concatenate((object_pose, labels[object_row.reshape(-1)]), axis=1)
+
+    # every run of objects with the same frame and camera is one frame, objects are put in order into its slots
+    new_frame = np.ones(len(object_pose), dtype=bool)
+    new_frame[1:] = np.any(object_pose[1:, :2] != object_pose[:-1, :2], axis=1)
+    frame_idx = np.cumsum(new_frame) - 1
+    frame_start = np.flatnonzero(new_frame)
+    obj_column = np.arange(len(object_pose)) - frame_start[frame_idx]
+
+    max_in_frames = int(obj_column.max()) + 1 if len(object_pose) > 0 else 0
+    if max_in_frames > max_obj:
+        raise ValueError(f"Found {max_in_frames} objects in a frame, more than the maximum of {max_obj} objects")
+    visible_objects = np.full([len(frame_start), max_obj, object_pose.shape[1]], const_pad, dtype=object_pose.dtype)
+    visible_objects[frame_idx, obj_column] = object_pose
 
     if max_in_frames < max_obj:
         max_obj = max_in_frames
 
     # Remove all non existent objects from meta:
     object_meta_seq = {}
-    for track_id in np.unique(np.array(visible_objects)[:, :, 2]):
+    for track_id in np.unique(visible_objects[:, :, 2]):
         if track_id in object_meta:
             object_meta_seq[track_id] = object_meta[track_id]
 
@@ -273,36 +186,55 @@ def _get_scene_objects(basedir):
     # TODO: Use if moving information to decide if an Object is static or dynamic across the whole scene!!
     object_pose = np.column_stack((object_pose, bbox[:, -1]))
 
-    # Store 2D bounding boxes of frames
-    bboxes_by_frame = []
+    # Store 2D bounding boxes of frames, [n_boxes, 1, left+right+top+bottom] for every camera and frame
     last_frame = bbox[-1, 0].astype(np.int32)
-    for cam in range(2):
-        for i in range(last_frame + 1):
-            bbox_at_i = np.squeeze(bbox[np.argwhere(bbox[:, 0] == i), :7])
-            bboxes_by_frame.append(bbox_at_i[np.argwhere(bbox_at_i[:, 1] == cam), 3:7])
+    n_frames = last_frame + 1
+    frame_cam_id = bbox[:, 1] * n_frames + bbox[:, 0]
+    valid = np.isin(bbox[:, 1], [0, 1]) & np.isin(bbox[:, 0], np.arange(n_frames))
+    frame_cam_id = frame_cam_id[valid].astype(np.int64)
+    order = np.argsort(frame_cam_id, kind="stable")
+    n_boxes = np.bincount(frame_cam_id, minlength=2 * n_frames)
+    bboxes_by_frame = np.split(bbox[valid][order][:, None, 3:7], np.cumsum(n_boxes)[:-1])
 
     return object_pose, vehicles_meta, max_obj, bboxes_by_frame
 
 
-def _convert_to_float(val):
-    try:
-        v = float(val)
-        return v
-    except:
-        if val == "True":
-            return 1
-        elif val == "False":
-            return 0
-        else:
-            ValueError("Is neither float nor boolean: " + val)
+def _read_information(path):
+    # C parser, round_trip parses the floats exactly like float()
+    information = pd.read_csv(
+        path,
+        sep=" ",
+        skiprows=1,
+        header=None,
+        true_values=["True"],
+        false_values=["False"],
+        float_precision="round_trip",
+    )
+    return information.to_numpy(dtype=np.float64)
 
 
 def get_information(path):
-    f = open(path, "r")
-    c = f.read()
-    c = c.split("\n", 1)[1]
+    """Numeric table of a vkitti text file without its header, True and False are read as 1 and 0.
+
+    The table is cached as .npy next to the text file and rebuilt when the text file is newer.
+    """
+    cache_path = path + ".npy"
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(path):
+            return np.load(cache_path)
+    except (OSError, ValueError):
+        pass
 
-    return np.array([[_convert_to_float(j) for j in i.split(" ")] for i in c.splitlines()])
+    information = _read_information(path)
+    try:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, information)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # read-only datasets are parsed on every run
+        pass
+    return information
 
 
 def get_semantic_information(path):
@@ -371,6 +303,11 @@ class MarsVKittiDataParserConfig(DataParserConfig):
     """path of semantic inputs"""
     semantic_mask_classes: List[str] = field(default_factory=lambda: [])
     """semantic classes that do not generate gradient to the background model"""
+    cull_invisible_objects: bool = True
+    """Build a second object table with only the objects in the view frustum of each image, read for the training
+    rays. Rendering and evaluation keep the full table."""
+    cache_dir: Optional[Path] = None
+    """Directory of the parsed scene and car latent caches, caching is disabled if None."""
 
 
 @dataclass
@@ -407,17 +344,24 @@ class MarsVKittiParser(DataParser):
         self.semantic_path = config.semantic_path
         self.use_semantic = config.use_semantic
 
-    def _generate_dataparser_outputs(self, split="train"):
-        if self.alpha_color is not None:
-            alpha_color_tensor = get_color(self.alpha_color)
-        else:
-            alpha_color_tensor = None
+    def _get_scene_sources(self):
+        """Files and directories read by _parse_scene"""
+        basedir = str(self.data)
+        sources = [os.path.join(basedir, name) for name in ["extrinsic.txt", "intrinsic.txt", "info.txt"]]
+        sources += [os.path.join(basedir, name) for name in ["pose.txt", "bbox.txt"]]
+        rgb_dir = os.path.join(basedir, "frames/rgb")
+        sources += [os.path.join(rgb_dir, camera) for camera in sorted(next(os.walk(rgb_dir))[1])]
+        return sources
 
+    def _parse_scene(self):
+        """Parse the split independent part of the scene: poses, intrinsics, object nodes and metadata, file lists
+
+        Returns:
+            arrays and JSON serializable metadata of the scene, the layout of the parsed scene cache
+        """
         basedir = str(self.data)
         extrinsic = get_information(os.path.join(basedir, "extrinsic.txt"))
         intrinsic = get_information(os.path.join(basedir, "intrinsic.txt"))
-        if self.use_semantic:
-            semantics = get_semantic_information(os.path.join(basedir, "colors.txt"))
         object_pose, object_meta, max_objects_per_frame, bboxes = _get_scene_objects(basedir)
 
         if self.object_setting == 0 or self.object_setting == 1:
@@ -443,18 +387,6 @@ class MarsVKittiParser(DataParser):
         if self.selected_frames == -1:
             self.selected_frames = [0, extrinsic.shape[0] - 1]
 
-        # semantic metadata
-        semantic_meta = None
-        if self.use_semantic:
-            semantics = semantics.loc[~semantics["Category"].isin(self.config.semantic_mask_classes)]
-            semantics.loc[len(semantics.index)] = ["Undefined", 0, 0, 0]
-            semantic_meta = Semantics(
-                filenames=[],
-                classes=semantics["Category"].tolist(),
-                colors=torch.tensor(semantics.iloc[:, 1:].values),
-                mask_classes=self.config.semantic_mask_classes,
-            )
-
         for camera in sorted(next(os.walk(rgb_dir))[1]):
             frame_dir = os.path.join(rgb_dir, camera)
             instance_frame_dir = os.path.join(instance_dir, camera)
@@ -565,7 +497,6 @@ class MarsVKittiParser(DataParser):
 
         test_load_image = imageio.imread(imgs_name[0])
         image_height, image_width = test_load_image.shape[:2]
-        cx, cy = image_width / 2.0, image_height / 2.0
 
         # Extract objects positions and labels
         if self.use_object_properties or self.bckg_only:
@@ -576,10 +507,99 @@ class MarsVKittiParser(DataParser):
             n_input_frames = obj_nodes.shape[0]
             obj_nodes[..., :3] = obj_nodes[..., :3] * self.scale_factor
             obj_nodes = np.reshape(obj_nodes, [n_input_frames, self.max_input_objects * add_input_rows, 3])
-        obj_meta_tensor = torch.from_numpy(np.array(obj_meta_ls, dtype="float32"))  # TODO
+        obj_metadata = np.array(obj_meta_ls, dtype="float32")  # TODO
         poses[..., :3, 3] *= self.scale_factor
 
-        obj_meta_tensor[..., 1:4] = obj_meta_tensor[..., 1:4] * self.scale_factor
+        obj_metadata[..., 1:4] = obj_metadata[..., 1:4] * self.scale_factor
+
+        focal_X = focal_Y = intrinsic[0, 2]
+
+        # principal point of the cameras built for every split
+        cx, cy = image_width / 2.0, image_height / 2.0
+        obj_offsets, obj_records = get_object_table(obj_nodes, add_input_rows)
+        self.config.max_input_objects = self.max_input_objects = int(np.diff(obj_offsets).max(initial=0))
+
+        arrays = {
+            "poses": poses,
+            "obj_offsets": obj_offsets,
+            "obj_records": obj_records,
+            "obj_metadata": obj_metadata,
+            "i_train": i_train,
+            "i_test": i_test,
+        }
+        if self.config.cull_invisible_objects and len(obj_nodes) == len(poses):
+            # table of the visible objects of every image for the training rays, fewer object slots to test per ray
+            visible = get_visible_objects(
+                obj_nodes,
+                obj_metadata,
+                poses,
+                [focal_X, focal_Y],
+                [cx, cy],
+                [image_height, image_width],
+                add_input_rows,
+            )
+            arrays["sample_obj_offsets"], arrays["sample_obj_records"] = get_object_table(
+                obj_nodes, add_input_rows, visible
+            )
+
+        meta = {
+            "image_filenames": imgs_name,
+            "instance_filenames": instance_name,
+            "depth_filenames": depth_name,
+            "semantic_filenames": semantic_name,
+            "focal": [float(focal_X), float(focal_Y)],
+            "image_size": [int(image_height), int(image_width)],
+            "principal_point": [float(cx), float(cy)],
+            "add_input_rows": int(add_input_rows),
+            "max_input_objects": int(self.max_input_objects),
+            "scene_objects": [float(obj) for obj in scene_objects],
+            "scene_classes": [float(obj_class) for obj_class in scene_classes],
+        }
+        return arrays, meta
+
+    def _generate_dataparser_outputs(self, split="train"):
+        if self.alpha_color is not None:
+            alpha_color_tensor = get_color(self.alpha_color)
+        else:
+            alpha_color_tensor = None
+
+        basedir = str(self.data)
+        if self.use_semantic:
+            semantics = get_semantic_information(os.path.join(basedir, "colors.txt"))
+
+        # semantic metadata
+        semantic_meta = None
+        if self.use_semantic:
+            semantics = semantics.loc[~semantics["Category"].isin(self.config.semantic_mask_classes)]
+            semantics.loc[len(semantics.index)] = ["Undefined", 0, 0, 0]
+            semantic_meta = Semantics(
+                filenames=[],
+                classes=semantics["Category"].tolist(),
+                colors=torch.tensor(semantics.iloc[:, 1:].values),
+                mask_classes=self.config.semantic_mask_classes,
+            )
+
+        # the split independent parse is cached, a warm start skips parsing
+        if self.config.cache_dir is not None:
+            cache_path = get_scene_cache_path(self.config.cache_dir, self.config, self._get_scene_sources())
+            arrays, meta = load_or_build_array_bundle(cache_path, self._parse_scene)
+        else:
+            arrays, meta = self._parse_scene()
+        poses = arrays["poses"]
+        i_train = arrays["i_train"]
+        i_test = arrays["i_test"]
+        obj_meta_tensor = torch.from_numpy(np.array(arrays["obj_metadata"]))
+        imgs_name = meta["image_filenames"]
+        instance_name = meta["instance_filenames"]
+        depth_name = meta["depth_filenames"]
+        semantic_name = meta["semantic_filenames"]
+        focal_X, focal_Y = meta["focal"]
+        image_height, image_width = meta["image_size"]
+        cx, cy = meta["principal_point"]
+        add_input_rows = meta["add_input_rows"]
+        scene_objects = meta["scene_objects"]
+        scene_classes = meta["scene_classes"]
+        self.config.max_input_objects = self.max_input_objects = meta["max_input_objects"]
 
         self.config.add_input_rows = add_input_rows
         if split == "train":
@@ -592,22 +612,16 @@ class MarsVKittiParser(DataParser):
         else:
             raise ValueError(f"Unknown dataparser split {split}")
 
-        input_size = 0
-
-        obj_nodes_tensor = torch.from_numpy(obj_nodes)
-        # obj_nodes_tensor = torch.from_numpy(obj_nodes).cuda()
-
-        obj_nodes_tensor = obj_nodes_tensor.unsqueeze(1).unsqueeze(1)
-
-        obj_size = self.max_input_objects * add_input_rows
-        input_size += obj_size
-        # [N, ro+rd+rgb+obj_nodes, H, W, 3]
-        # rays_rgb_env = np.concatenate([rays_rgb_env, obj_nodes], 1)
-
-        # [N, H, W, ro+rd+rgb+obj_nodes*max_obj, 3]
-        # with obj_nodes [(x+y+z)*max_obj + (obj_id+is_training+0)*max_obj]
-        
-        obj_info = obj_nodes_tensor[indices, ...]
+        # ragged object table of the split, [x, y, z, yaw, metadata row] of every object of every image
+        obj_offsets, obj_records = select_object_table(arrays["obj_offsets"], arrays["obj_records"], indices)
+        object_tables = {"obj_offsets": torch.from_numpy(obj_offsets), "obj_records": torch.from_numpy(obj_records)}
+        if "sample_obj_offsets" in arrays:
+            # culled table of the training rays, rendering and evaluation keep every object
+            sample_offsets, sample_records = select_object_table(
+                arrays["sample_obj_offsets"], arrays["sample_obj_records"], indices
+            )
+            object_tables["sample_obj_offsets"] = torch.from_numpy(sample_offsets)
+            object_tables["sample_obj_records"] = torch.from_numpy(sample_records)
 
         image_filenames = [imgs_name[i] for i in indices]
         instance_filenames = [instance_name[i] for i in indices]
@@ -620,22 +634,9 @@ class MarsVKittiParser(DataParser):
             if not self.config.car_object_latents_path.exists():
                 CONSOLE.print("[yello]Error: latents not exist")
                 exit()
-            car_latents = torch.load(str(self.config.car_object_latents_path))
-            track_car_latents = {}
-            track_car_latents_mean = {}
-            for k, idx in enumerate(car_latents["indices"]):
-                if self.selected_frames[0] <= idx["fid"] <= self.selected_frames[1]:
-                    if idx["oid"] in track_car_latents.keys():
-                        track_car_latents[idx["oid"]] = torch.cat(
-                            [track_car_latents[idx["oid"]], car_latents["latents"][k].unsqueeze(-1)], dim=-1
-                        )
-                    else:
-                        track_car_latents[idx["oid"]] = car_latents["latents"][k].unsqueeze(-1)
-            for k in track_car_latents.keys():
-                track_car_latents_mean[k] = track_car_latents[k][..., -1]
-
-        else:
-            car_latents = None
+            track_car_latents_mean = get_track_car_latents(
+                self.config.car_object_latents_path, self.selected_frames, self.config.cache_dir
+            )
 
         aabb_scale = self.config.scene_scale
         scene_box = SceneBox(
@@ -644,8 +645,6 @@ class MarsVKittiParser(DataParser):
             )
         )
 
-        focal_X = focal_Y = intrinsic[0, 2]
-
         cameras = Cameras(
             camera_to_worlds=torch.from_numpy(poses[:, :3, :4]),
             fx=focal_X,
@@ -669,7 +668,7 @@ class MarsVKittiParser(DataParser):
                 "obj_metadata": obj_meta_tensor if len(obj_meta_tensor) > 0 else None,
                 "obj_class": scene_classes if len(scene_classes) > 0 else None,
                 "scene_obj": scene_objects if len(scene_objects) > 0 else None,
-                "obj_info": obj_info if len(obj_info) > 0 else None,
+                **object_tables,
                 "scale_factor": self.scale_factor,
                 "semantics": semantic_meta,
             },
@@ -81,6 +81,7 @@ class Decoder(nn.Module):
 
         self.skips = skips
         self.z_dim = z_dim
+        self.hidden_size = hidden_size
 
         self.n_blocks = n_blocks
         self.n_blocks_view = n_blocks_view
@@ -102,6 +103,7 @@ class Decoder(nn.Module):
 
         self.blocks = nn.ModuleList([nn.Linear(hidden_size, hidden_size) for i in range(n_blocks - 1)])
         n_skips = sum([i in skips for i in range(n_blocks - 1)])
+        self.n_skips = n_skips
 
         if n_skips > 0:
             self.fc_z_skips = nn.ModuleList([nn.Linear(z_dim, hidden_size) for i in range(n_skips)])
@@ -129,21 +131,37 @@ class Decoder(nn.Module):
 
         return p
 
-    def forward(self, p_in, ray_d, latent, covs=None):
+    def project_latents(self, latent):
+        """
+        Latent conditioning of the density and feature layers, computed once per object.
+        :param latent (B, 512)
+        :return (B, (2 + n_skips) * hidden_size) outputs of fc_z, fc_z_skips and fc_z_view
+        """
         z_shape = self.fc_shape(latent)  # B x 128
         z_app = self.fc_app(latent)  # B x 128
 
-        B, N, _ = p_in.shape  # B x (2048 * 64)
+        projections = [self.fc_z(z_shape)]
+        if self.n_skips > 0:
+            projections += [fc_z_skip(z_shape) for fc_z_skip in self.fc_z_skips]
+        projections.append(self.fc_z_view(z_app))
+        return torch.cat(projections, dim=-1)  # B x ((2 + n_skips) * 256)
 
-        z_shape = z_shape[:, None, :].repeat(1, N, 1)  # B x (2048 * 64) x 128
-        z_app = z_app[:, None, :].repeat(1, N, 1)  # B x (2048 * 64) x 128
+    def forward(self, p_in, ray_d, latent=None, covs=None, latent_ids=None, latent_projections=None):
+        if latent_projections is None:
+            latent_projections = self.project_latents(latent)
 
-        p = self.switch_positional_encoding(p_in, covs)  # B x (2046 * 64) x 3 -> 96
+        def expand(z):
+            if latent_ids is not None:
+                # every sample picks the projection of its own latent, latent_ids: B x (2048 * 64)
+                return z[latent_ids]  # B x (2048 * 64) x 256
+            return z[:, None, :]  # B x 1 x 256, broadcast over the samples
 
-        net = self.fc_in(p)  # B x (2048 * 64) x 128
+        z_in, *z_skips, z_view = latent_projections.split(self.hidden_size, dim=-1)
 
-        if z_shape is not None:
-            net = net + self.fc_z(z_shape)
+        p = self.switch_positional_encoding(p_in, covs)  # B x (2046 * 64) x 3 -> 96
+
+        net = self.fc_in(p)  # B x (2048 * 64) x 256
+        net = net + expand(z_in)
 
         net = F.relu(net)
 
@@ -151,13 +169,13 @@ class Decoder(nn.Module):
         for idx, layer in enumerate(self.blocks):
             net = F.relu(layer(net))
             if (idx + 1) in self.skips and (idx < len(self.blocks) - 1):
-                net = net + self.fc_z_skips[skip_idx](z_shape)
+                net = net + expand(z_skips[skip_idx])
                 net = net + self.fc_p_skips[skip_idx](p)
                 skip_idx += 1
         sigma_out = self.sigma_out(net)
 
         net = self.feat_view(net)
-        net = net + self.fc_z_view(z_app)
+        net = net + expand(z_view)
 
         ray_d = ray_d / torch.norm(ray_d, dim=-1, keepdim=True)
         ray_d = self.switch_positional_encoding(ray_d, views=True)
@@ -173,26 +191,53 @@ class Decoder(nn.Module):
 
 
 class CarNeRF_Field(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, use_encoder=False):
         super().__init__()
 
-        self.encoder = ImageEncoder()
+        # the decoder runs on stored latents, the image encoder is only needed to encode new images
+        self.encoder = ImageEncoder() if use_encoder else None
         self.decoder = Decoder()
 
-    # def encode(self, images):
-    # return self.encoder(images)
+    def encode(self, images):
+        """
+        Encode images into latents, the encoder is built on first use.
+        :param images (B, 3, H, W)
+        :return (B, 512) latents
+        """
+        if self.encoder is None:
+            self.encoder = ImageEncoder().to(images.device)
+        return self.encoder(images)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.encoder is None:
+            # pretrained checkpoints contain the encoder, skip it when it is not built
+            for key in [key for key in state_dict.keys() if key.startswith(prefix + "encoder.")]:
+                state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_latents(self, latent):
+        """
+        Precompute the latent conditioning of the decoder, which is shared by all points of an object.
+        :param latent (SB, 512)
+        :return (SB, D) projections to pass as latent_projections
+        """
+        return self.decoder.project_latents(latent)
 
-    def forward(self, xyz, latent, viewdirs=None, covs=None):
+    def forward(self, xyz, latent=None, viewdirs=None, covs=None, latent_ids=None, latent_projections=None):
         """
         Predict (r, g, b, sigma) at world space points xyz.
         :param xyz (SB, B, 3)
         SB is batch of objects
         B is batch of points (in rays)
         NS is number of input views
+        :param latent_ids (SB, B) optional row of latent for every point, to mix objects in one batch
+        :param latent_projections (SB, D) optional output of project_latents, replaces latent
         :return (SB, B, 4) r g b sigma
         """
 
-        rgb, sigma = self.decoder(xyz, viewdirs, latent, covs)
+        rgb, sigma = self.decoder(
+            xyz, viewdirs, latent, covs, latent_ids=latent_ids, latent_projections=latent_projections
+        )
 
         outputs = {FieldHeadNames.DENSITY: F.softplus(sigma), FieldHeadNames.RGB: torch.sigmoid(rgb)}
         return outputs
@@ -84,10 +84,6 @@ class MarsPipeline(Pipeline):
         self.datamanager.to(device)
         # TODO(ethan): get rid of scene_bounds from the model
         assert self.datamanager.train_dataset is not None, "Missing input dataset"
-        self.config.model.max_num_obj = self.config.datamanager.dataparser.max_input_objects
-        self.config.model.ray_add_input_rows = self.config.datamanager.dataparser.add_input_rows
-        self.train_obj_info = self.datamanager.train_dataset.metadata["obj_info"]
-        self.eval_obj_info = self.datamanager.eval_dataset.metadata["obj_info"]
 
         use_car_latents = "car_latents" in self.datamanager.train_dataset.metadata
         self._model = config.model.setup(
@@ -214,14 +210,11 @@ class MarsPipeline(Pipeline):
             for camera_ray_bundle, batch in self.datamanager.fixed_indices_eval_dataloader:
                 # time this the following line
                 inner_start = time()
+                batch = self.datamanager.image_to_float(batch)
 
-                object_rays_info = self.datamanager.eval_dataset.metadata["obj_info"][batch["image_idx"]]
-
-                object_rays_info_view = object_rays_info.expand(camera_ray_bundle.shape[0], camera_ray_bundle.shape[1], -1, -1)
-
-                camera_ray_bundle.metadata["object_rays_info"] = object_rays_info_view.reshape(
-                    camera_ray_bundle.shape[0], camera_ray_bundle.shape[1], -1
-                ).detach()
+                camera_ray_bundle.metadata["object_rays_info"] = self.datamanager.get_image_object_rays_info(
+                    self.datamanager.eval_dataset, int(batch["image_idx"]), camera_ray_bundle.shape
+                )
                 height, width = camera_ray_bundle.shape
                 num_rays = height * width
                 outputs = self.model.get_outputs_for_camera_ray_bundle(camera_ray_bundle)
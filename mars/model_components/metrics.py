@@ -0,0 +1,37 @@
+"""
+Image metrics of the models.
+"""
+
+from typing import Optional, Union
+
+import torch
+from torchmetrics import PeakSignalNoiseRatio
+from torchmetrics.functional import structural_similarity_index_measure
+from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
+
+
+class ImageMetrics:
+    """PSNR, SSIM and LPIPS of a model, each metric is created on its first use.
+
+    This is a plain object, so the metrics are neither registered as submodules of the model holding it nor stored in
+    its checkpoints, and the LPIPS backbone is only loaded by models that evaluate images.
+    """
+
+    def __init__(self) -> None:
+        self._psnr: Optional[PeakSignalNoiseRatio] = None
+        self._lpips: Optional[LearnedPerceptualImagePatchSimilarity] = None
+        self.ssim = structural_similarity_index_measure
+
+    def psnr(self, device: Union[torch.device, str]) -> PeakSignalNoiseRatio:
+        """Get the PSNR metric on a device"""
+        if self._psnr is None:
+            self._psnr = PeakSignalNoiseRatio(data_range=1.0)
+        self._psnr = self._psnr.to(device)
+        return self._psnr
+
+    def lpips(self, device: Union[torch.device, str]) -> LearnedPerceptualImagePatchSimilarity:
+        """Get the LPIPS metric on a device"""
+        if self._lpips is None:
+            self._lpips = LearnedPerceptualImagePatchSimilarity(normalize=True)
+        self._lpips = self._lpips.to(device)
+        return self._lpips
@@ -19,16 +19,14 @@ Car NeRF for object models
 from __future__ import annotations
 
 from dataclasses import dataclass, field
+from pathlib import Path
 from typing import Dict, Optional, Tuple, Type
 
 import torch
 from torch import nn
-from torchmetrics import PeakSignalNoiseRatio
-from torchmetrics.functional import structural_similarity_index_measure
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 
 from mars.fields.car_nerf_field import CarNeRF_Field
-from nerfstudio.cameras.rays import RayBundle
+from nerfstudio.cameras.rays import RayBundle, RaySamples
 from nerfstudio.field_components.field_heads import FieldHeadNames
 from nerfstudio.model_components.losses import MSELoss
 from nerfstudio.model_components.ray_samplers import PDFSampler, UniformSampler
@@ -42,6 +40,14 @@ from nerfstudio.model_components.shaders import NormalsShader
 from nerfstudio.models.base_model import Model, ModelConfig
 
 
+def build_car_nerf_field(state_dict_path: Optional[Path] = None) -> CarNeRF_Field:
+    """Build a CarNeRF field, initialized from the pretrained state dict if a path is given."""
+    car_nerf_field = CarNeRF_Field()
+    if state_dict_path is not None:
+        car_nerf_field.load_state_dict(torch.load(state_dict_path))
+    return car_nerf_field
+
+
 @dataclass
 class CarNeRFModelConfig(ModelConfig):
     """CarNeRF Model Config"""
@@ -78,9 +84,13 @@ class CarNeRF(Model):
                 self.car_latents[idx], requires_grad=self.training and self.config.optimize_latents
             )
 
-        self.fields = CarNeRF_Field()
-        if "car_nerf_state_dict_path" in self.kwargs:
-            self.fields.load_state_dict(torch.load(self.kwargs["car_nerf_state_dict_path"]))
+        self.latent_projection_cache = {}
+
+        # the nodes of a scene graph share one field, registered (and checkpointed) once by the scene graph, and get it
+        # through this getter. A node without it registers its own field
+        self._get_shared_field = self.kwargs.get("get_shared_field", None)
+        if self.owns_fields:
+            self.fields = build_car_nerf_field(self.kwargs.get("car_nerf_state_dict_path", None))
 
         self.sampler_uniform = UniformSampler(num_samples=self.config.num_coarse_samples)
         self.sampler_pdf = PDFSampler(num_samples=self.config.num_fine_samples, include_original=False)
@@ -97,19 +107,31 @@ class CarNeRF(Model):
         # losses
         self.rgb_loss = MSELoss()
 
-        # metrics
-        self.psnr = PeakSignalNoiseRatio(data_range=1.0)
-        self.ssim = structural_similarity_index_measure
-        self.lpips = LearnedPerceptualImagePatchSimilarity(normalize=True)
+    @property
+    def owns_fields(self) -> bool:
+        """Whether the node has its own field instead of the shared one"""
+        return self._get_shared_field is None
+
+    @property
+    def car_nerf_field(self) -> CarNeRF_Field:
+        """The field of the node, its own one or the one shared by the scene graph"""
+        return self.fields if self.owns_fields else self._get_shared_field()
+
+    def use_own_field(self, car_nerf_field: CarNeRF_Field) -> None:
+        """Register an own field instead of the shared one, e.g. for checkpoints with one field per node"""
+        self._get_shared_field = None
+        self.fields = car_nerf_field
+        self.latent_projection_cache = {}
 
     def num_sample_points(self) -> int:
         return self.config.num_coarse_samples + self.config.num_fine_samples + 1
 
     def get_param_groups(self):
         param_groups = []
-        if self.fields is None:
+        if self.car_nerf_field is None:
             raise ValueError("populate_fields() must be called before get_param_groups")
-        param_groups += list(self.fields.parameters())
+        if self.owns_fields:
+            param_groups += list(self.car_nerf_field.parameters())
         if self.config.optimize_latents:
             param_groups += list(self.car_latents.values())
         return param_groups
@@ -169,166 +191,131 @@ class CarNeRF(Model):
     #         "field_outputs": [field_outputs_coares, field_outputs_fine],
     #     }
 
-    def inference_without_render(self, ray_bundle: RayBundle):
-        """
-        inference without render
-        """
-        if self.fields is None:
-            raise ValueError("populate_fields() must be called before get_outputs")
-
-        obj_ids = ray_bundle.metadata["obj_ids"]
-        unique_obj_ids = torch.unique(obj_ids)
+    def train(self, mode: bool = True):
+        # the decoder and the latents change while training, so the cached projections become stale
+        self.latent_projection_cache = {}
+        return super().train(mode)
 
-        # generate empty ray samples
-        weights_coarse_raw = torch.zeros(
-            (*ray_bundle.shape, self.config.num_coarse_samples, 1), device=ray_bundle.camera_indices.device
-        )
+    def _apply(self, fn, *args, **kwargs):
+        # moving or casting the module leaves the cached projections on the old device and dtype
+        self.latent_projection_cache = {}
+        return super()._apply(fn, *args, **kwargs)
 
-        field_outputs_fine_raw = {
-            FieldHeadNames.DENSITY: torch.zeros(
-                (*ray_bundle.shape, self.config.num_fine_samples, 1), device=ray_bundle.camera_indices.device
-            ),
-            FieldHeadNames.RGB: torch.zeros(
-                (*ray_bundle.shape, self.config.num_fine_samples, 3), device=ray_bundle.camera_indices.device
-            ),
-        }
+    def _load_from_state_dict(self, *args, **kwargs):
+        # loaded weights replace the decoder and the latents the projections were computed from
+        self.latent_projection_cache = {}
+        return super()._load_from_state_dict(*args, **kwargs)
 
-        for obj_id in unique_obj_ids:
-            obj_msk = (obj_ids == obj_id).squeeze(-1)
-            # uniform sampling
-            ray_samples_uniform = self.sampler_uniform(ray_bundle[obj_msk])
+    def get_latent_projections(self, obj_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Project the latents of the objects in obj_ids and index every ray into the projections.
 
-            # First pass:
-            gaussian_samples = ray_samples_uniform.frustums.get_gaussian_blob()
+        The projections are cached per object while the latents are frozen and the model is not training.
 
-            field_outputs_coarse = self.fields(
-                gaussian_samples.mean.view(1, -1, 3),
-                self.car_latents[int(obj_id)].view(1, -1).to(obj_id.device),
-                viewdirs=ray_samples_uniform.frustums.directions.reshape(1, -1, 3),
-                covs=torch.diagonal(gaussian_samples.cov, dim1=-2, dim2=-1).view(1, -1, 3),
-            )
+        Args:
+            obj_ids: track ids of the rays, (n_rays, 1)
 
-            for it in [FieldHeadNames.DENSITY, FieldHeadNames.RGB]:
-                field_outputs_coarse[it] = field_outputs_coarse[it].reshape((*gaussian_samples.mean.shape[:-1], -1))
+        Returns:
+            latent projections of the unique objects, (n_objects, D), and their row for every ray, (n_rays, )
+        """
+        unique_obj_ids, latent_ids = torch.unique(obj_ids.reshape(-1), return_inverse=True)
+        unique_obj_ids = [int(obj_id) for obj_id in unique_obj_ids.tolist()]
+
+        if self.training or self.config.optimize_latents:
+            latents = torch.stack([self.car_latents[obj_id].reshape(-1) for obj_id in unique_obj_ids])
+            return self.car_nerf_field.project_latents(latents.to(obj_ids.device)), latent_ids
+
+        missing_obj_ids = [obj_id for obj_id in unique_obj_ids if obj_id not in self.latent_projection_cache]
+        if len(missing_obj_ids) > 0:
+            latents = torch.stack([self.car_latents[obj_id].reshape(-1) for obj_id in missing_obj_ids])
+            projections = self.car_nerf_field.project_latents(latents.to(obj_ids.device)).detach()
+            self.latent_projection_cache.update(zip(missing_obj_ids, projections))
+        latent_projections = torch.stack([self.latent_projection_cache[obj_id] for obj_id in unique_obj_ids])
+        return latent_projections, latent_ids
+
+    def query_fields(self, ray_samples: RaySamples, latent_projections: torch.Tensor, latent_ids: torch.Tensor):
+        """Evaluate the field for the samples of all rays at once, each ray conditioned on its own latent."""
+        gaussian_samples = ray_samples.frustums.get_gaussian_blob()
+        n_rays, n_samples = gaussian_samples.mean.shape[:2]
+
+        field_outputs = self.car_nerf_field(
+            gaussian_samples.mean.view(1, -1, 3),
+            viewdirs=ray_samples.frustums.directions.reshape(1, -1, 3),
+            covs=torch.diagonal(gaussian_samples.cov, dim1=-2, dim2=-1).view(1, -1, 3),
+            latent_ids=latent_ids[:, None].expand(n_rays, n_samples).reshape(1, -1),
+            latent_projections=latent_projections,
+        )
 
-            weights_coarse = ray_samples_uniform.get_weights(field_outputs_coarse[FieldHeadNames.DENSITY])
+        for it in [FieldHeadNames.DENSITY, FieldHeadNames.RGB]:
+            field_outputs[it] = field_outputs[it].reshape((*gaussian_samples.mean.shape[:-1], -1))
+        return field_outputs
 
-            # pdf sampling
-            ray_samples_pdf = self.sampler_pdf(ray_bundle[obj_msk], ray_samples_uniform, weights_coarse)
+    def inference_without_render(self, ray_bundle: RayBundle):
+        """
+        inference without render
+        """
+        if self.car_nerf_field is None:
+            raise ValueError("populate_fields() must be called before get_outputs")
 
-            # second pass
-            gaussian_samples_fine = ray_samples_pdf.frustums.get_gaussian_blob()
+        latent_projections, latent_ids = self.get_latent_projections(ray_bundle.metadata["obj_ids"])
 
-            field_outputs_fine = self.fields(
-                gaussian_samples_fine.mean.view(1, -1, 3),
-                self.car_latents[int(obj_id)].view(1, -1).to(obj_id.device),
-                viewdirs=ray_samples_pdf.frustums.directions.reshape(1, -1, 3),
-                covs=torch.diagonal(gaussian_samples_fine.cov, dim1=-2, dim2=-1).view(1, -1, 3),
-            )
+        # uniform sampling
+        ray_samples_uniform = self.sampler_uniform(ray_bundle)
 
-            for it in [FieldHeadNames.DENSITY, FieldHeadNames.RGB]:
-                field_outputs_fine[it] = field_outputs_fine[it].reshape((*gaussian_samples_fine.mean.shape[:-1], -1))
-                field_outputs_fine_raw[it][obj_msk] = field_outputs_fine[it]
+        # First pass:
+        field_outputs_coarse = self.query_fields(ray_samples_uniform, latent_projections, latent_ids)
+        weights_coarse = ray_samples_uniform.get_weights(field_outputs_coarse[FieldHeadNames.DENSITY])
 
-            weights_coarse_raw[obj_msk] = weights_coarse
+        # pdf sampling
+        ray_samples_pdf = self.sampler_pdf(ray_bundle, ray_samples_uniform, weights_coarse)
 
-        # Redundant operations because the TensorDate cannot set by indices
-        ray_samples_uniform_raw = self.sampler_uniform(ray_bundle)
-        ray_samples_pdf_raw = self.sampler_pdf(ray_bundle, ray_samples_uniform_raw, weights_coarse_raw)
+        # second pass
+        field_outputs_fine = self.query_fields(ray_samples_pdf, latent_projections, latent_ids)
 
         # the car nerf is learned in BGR mode
-        rgb_fine = field_outputs_fine_raw[FieldHeadNames.RGB][..., [2, 1, 0]]
-
-        field_outputs_fine_raw[FieldHeadNames.RGB] = rgb_fine
+        field_outputs_fine[FieldHeadNames.RGB] = field_outputs_fine[FieldHeadNames.RGB][..., [2, 1, 0]]
 
         outputs = {
-            "ray_samples_list": [ray_samples_uniform_raw, ray_samples_pdf_raw],
-            "field_outputs": field_outputs_fine_raw,
+            "ray_samples_list": [ray_samples_uniform, ray_samples_pdf],
+            "field_outputs": field_outputs_fine,
         }
         return outputs
 
     def get_outputs(self, ray_bundle: RayBundle):
-        if self.fields is None:
+        if self.car_nerf_field is None:
             raise ValueError("populate_fields() must be called before get_outputs")
 
-        obj_ids = ray_bundle.metadata["obj_ids"]
-        unique_obj_ids = torch.unique(obj_ids)
-
-        rgb_coarse_raw = torch.zeros((*ray_bundle.shape, 3), device=ray_bundle.camera_indices.device)
-        rgb_fine_raw = torch.zeros((*ray_bundle.shape, 3), device=ray_bundle.camera_indices.device)
-        accumulation_coarse_raw = torch.zeros((*ray_bundle.shape, 1), device=ray_bundle.camera_indices.device)
-        accumulation_fine_raw = torch.zeros((*ray_bundle.shape, 1), device=ray_bundle.camera_indices.device)
-        depth_coarse_raw = torch.zeros((*ray_bundle.shape, 1), device=ray_bundle.camera_indices.device)
-        depth_fine_raw = torch.zeros((*ray_bundle.shape, 1), device=ray_bundle.camera_indices.device)
-        ray_samples_uniform_raw = torch.zeros(
-            (*ray_bundle.shape, self.config.num_coarse_samples), device=ray_bundle.camera_indices.device
-        )
-        ray_samples_pdf_raw = torch.zeros(
-            (*ray_bundle.shape, self.config.num_fine_samples), device=ray_bundle.camera_indices.device
-        )
-
-        for obj_id in unique_obj_ids:
-            obj_msk = (obj_ids == obj_id).squeeze(-1)
-            # uniform sampling
-            ray_samples_uniform = self.sampler_uniform(ray_bundle[obj_msk])
-
-            # First pass:
-            gaussian_samples = ray_samples_uniform.frustums.get_gaussian_blob()
-
-            field_outputs_coarse = self.fields(
-                gaussian_samples.mean.view(1, -1, 3),
-                self.car_latents[int(obj_id)].view(1, -1),
-                viewdirs=ray_samples_uniform.frustums.directions.reshape(1, -1, 3),
-                covs=torch.diagonal(gaussian_samples.cov, dim1=-2, dim2=-1).view(1, -1, 3),
-            )
-
-            for it in [FieldHeadNames.DENSITY, FieldHeadNames.RGB]:
-                field_outputs_coarse[it] = field_outputs_coarse[it].reshape((*gaussian_samples.mean.shape[:-1], -1))
-
-            weights_coarse = ray_samples_uniform.get_weights(field_outputs_coarse[FieldHeadNames.DENSITY])
+        latent_projections, latent_ids = self.get_latent_projections(ray_bundle.metadata["obj_ids"])
 
-            rgb_coarse = self.renderer_rgb(rgb=field_outputs_coarse[FieldHeadNames.RGB], weights=weights_coarse)
-            accumulation_coarse = self.renderer_accumulation(weights_coarse)
-            depth_coarse = self.renderer_depth(weights_coarse, ray_samples_uniform)
+        # uniform sampling
+        ray_samples_uniform = self.sampler_uniform(ray_bundle)
 
-            # pdf sampling
-            ray_samples_pdf = self.sampler_pdf(ray_bundle[obj_msk], ray_samples_uniform, weights_coarse)
+        # First pass:
+        field_outputs_coarse = self.query_fields(ray_samples_uniform, latent_projections, latent_ids)
+        weights_coarse = ray_samples_uniform.get_weights(field_outputs_coarse[FieldHeadNames.DENSITY])
 
-            # second pass
-            gaussian_samples_fine = ray_samples_pdf.frustums.get_gaussian_blob()
-
-            field_outputs_fine = self.fields(
-                gaussian_samples_fine.mean.view(1, -1, 3),
-                self.car_latents[int(obj_id)].view(1, -1),
-                viewdirs=ray_samples_pdf.frustums.directions.reshape(1, -1, 3),
-                covs=torch.diagonal(gaussian_samples_fine.cov, dim1=-2, dim2=-1).view(1, -1, 3),
-            )
+        rgb_coarse = self.renderer_rgb(rgb=field_outputs_coarse[FieldHeadNames.RGB], weights=weights_coarse)
+        accumulation_coarse = self.renderer_accumulation(weights_coarse)
+        depth_coarse = self.renderer_depth(weights_coarse, ray_samples_uniform)
 
-            for it in [FieldHeadNames.DENSITY, FieldHeadNames.RGB]:
-                field_outputs_fine[it] = field_outputs_fine[it].reshape((*gaussian_samples.mean.shape[:-1], -1))
+        # pdf sampling
+        ray_samples_pdf = self.sampler_pdf(ray_bundle, ray_samples_uniform, weights_coarse)
 
-            weights_fine = ray_samples_pdf.get_weights(field_outputs_fine[FieldHeadNames.DENSITY])
-            rgb_fine = self.renderer_rgb(rgb=field_outputs_fine[FieldHeadNames.RGB], weights=weights_fine)
-            accumulation_fine = self.renderer_accumulation(weights_fine)
-            depth_fine = self.renderer_depth(weights_fine, ray_samples_pdf)
+        # second pass
+        field_outputs_fine = self.query_fields(ray_samples_pdf, latent_projections, latent_ids)
+        weights_fine = ray_samples_pdf.get_weights(field_outputs_fine[FieldHeadNames.DENSITY])
 
-            rgb_coarse_raw[obj_msk] = rgb_coarse
-            rgb_fine_raw[obj_msk] = rgb_fine
-            accumulation_coarse_raw[obj_msk] = accumulation_coarse
-            accumulation_fine_raw[obj_msk] = accumulation_fine
-            depth_coarse_raw[obj_msk] = depth_coarse
-            depth_fine_raw[obj_msk] = depth_fine
-            ray_samples_uniform_raw[obj_msk] = ray_samples_uniform
-            ray_samples_pdf_raw[obj_msk] = ray_samples_pdf
+        rgb_fine = self.renderer_rgb(rgb=field_outputs_fine[FieldHeadNames.RGB], weights=weights_fine)
+        accumulation_fine = self.renderer_accumulation(weights_fine)
+        depth_fine = self.renderer_depth(weights_fine, ray_samples_pdf)
 
         outputs = {
-            "rgb_coarse": rgb_coarse_raw,
-            "rgb_fine": rgb_fine_raw,
-            "accumulation_coarse": accumulation_coarse_raw,
-            "accumulation_fine": accumulation_fine_raw,
-            "depth_coarse": depth_coarse_raw,
-            "depth_fine": depth_fine_raw,
-            "ray_samples_list": [ray_samples_uniform_raw, ray_samples_pdf_raw],
+            "rgb_coarse": rgb_coarse,
+            "rgb_fine": rgb_fine,
+            "accumulation_coarse": accumulation_coarse,
+            "accumulation_fine": accumulation_fine,
+            "depth_coarse": depth_coarse,
+            "depth_fine": depth_fine,
+            "ray_samples_list": [ray_samples_uniform, ray_samples_pdf],
         }
         return outputs
 
@@ -21,10 +21,8 @@ from typing import Dict, List, Tuple
 
 import torch
 from torch.nn import Parameter
-from torchmetrics import PeakSignalNoiseRatio
-from torchmetrics.functional import structural_similarity_index_measure
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 
+from mars.model_components.metrics import ImageMetrics
 from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.field_components.encodings import NeRFEncoding
 from nerfstudio.field_components.field_heads import FieldHeadNames
@@ -83,10 +81,8 @@ class MipNerfModel(Model):
         # losses
         self.rgb_loss = MSELoss()
 
-        # metrics
-        self.psnr = PeakSignalNoiseRatio(data_range=1.0)
-        self.ssim = structural_similarity_index_measure
-        self.lpips = LearnedPerceptualImagePatchSimilarity(normalize=True)
+        # metrics, created on first use
+        self.image_metrics = ImageMetrics()
 
     def num_sample_points(self) -> int:
         return self.config.num_importance_samples + 1
@@ -195,10 +191,10 @@ class MipNerfModel(Model):
         rgb_coarse = torch.clip(rgb_coarse, min=0, max=1)
         rgb_fine = torch.clip(rgb_fine, min=0, max=1)
 
-        coarse_psnr = self.psnr(image, rgb_coarse)
-        fine_psnr = self.psnr(image, rgb_fine)
-        fine_ssim = self.ssim(image, rgb_fine)
-        fine_lpips = self.lpips(image, rgb_fine)
+        coarse_psnr = self.image_metrics.psnr(self.device)(image, rgb_coarse)
+        fine_psnr = self.image_metrics.psnr(self.device)(image, rgb_fine)
+        fine_ssim = self.image_metrics.ssim(image, rgb_fine)
+        fine_lpips = self.image_metrics.lpips(self.device)(image, rgb_fine)
 
         metrics_dict = {
             "psnr": float(fine_psnr.item()),
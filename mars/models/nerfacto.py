@@ -24,9 +24,6 @@ from typing import Dict, List, Literal, Optional, Tuple, Type
 import numpy as np
 import torch
 from torch.nn import Parameter
-from torchmetrics import PeakSignalNoiseRatio
-from torchmetrics.functional import structural_similarity_index_measure
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 
 from mars.fields.nerfacto_field import NerfactoField
 from nerfstudio.cameras.rays import RayBundle, RaySamples
@@ -250,11 +247,6 @@ class NerfactoModel(Model):
         # losses
         self.rgb_loss = MSELoss()
 
-        # metrics
-        self.psnr = PeakSignalNoiseRatio(data_range=1.0)
-        self.ssim = structural_similarity_index_measure
-        self.lpips = LearnedPerceptualImagePatchSimilarity(normalize=True)
-
     def num_sample_points(self) -> int:
         return self.config.num_nerf_samples_per_ray
 
@@ -27,16 +27,16 @@ import torch
 from rich.console import Console
 from torch.nn.functional import binary_cross_entropy
 from torch.nn.parameter import Parameter
-from torchmetrics import PeakSignalNoiseRatio
-from torchmetrics.functional import structural_similarity_index_measure
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 from typing_extensions import Literal
 
+from mars.data.mars_dataparser_utils import OBJECT_RECORD_SIZE
 from mars.model_components.losses import monosdf_depth_loss
+from mars.model_components.metrics import ImageMetrics
+from mars.models.car_nerf import CarNeRFModelConfig, build_car_nerf_field
 from mars.models.nerfacto import NerfactoModel, NerfactoModelConfig
 from mars.models.semantic_nerfw import SemanticNerfWModel
 from mars.models.sky_model import SkyModelConfig
-from mars.utils.neural_scene_graph_helper import box_pts, combine_z, world2object
+from mars.utils.neural_scene_graph_helper import BOX_GRID_MIN_OBJECTS, box_pts, combine_z
 from nerfstudio.cameras.rays import Frustums, RayBundle, RaySamples
 from nerfstudio.data.dataparsers.base_dataparser import Semantics
 from nerfstudio.data.scene_box import SceneBox
@@ -81,8 +81,6 @@ class SceneGraphModelConfig(ModelConfig):
     background_model: ModelConfig = NerfactoModelConfig()
     object_model_template: ModelConfig = NerfactoModelConfig()
 
-    max_num_obj: int = -1
-    ray_add_input_rows: int = -1
     near_plane: float = 0.05
     """How far along the ray to start sampling."""
     far_plane: float = 1000.0
@@ -131,6 +129,8 @@ class SceneGraphModelConfig(ModelConfig):
     """whether to use sky model"""
     sky_model: Optional[SkyModelConfig] = SkyModelConfig()
     """sky model config"""
+    box_grid_min_objects: int = BOX_GRID_MIN_OBJECTS
+    """Number of objects per ray from which the ray-box tests use a uniform grid over the boxes."""
 
 
 class SceneGraphModel(Model):
@@ -200,6 +200,12 @@ class SceneGraphModel(Model):
             use_sky_model=self.use_sky_model,
         )
 
+        # CarNeRF nodes only differ in their latents, so they all use one field registered (and stored) once here
+        if isinstance(self.config.object_model_template, CarNeRFModelConfig):
+            self.object_field = build_car_nerf_field(self.car_nerf_state_dict_path)
+        else:
+            self.object_field = None
+
         # TODO(noted by Tianyu LIU): modify various categories of cars
         # TODO (wuzr): unifing all configurations
         object_models = {
@@ -210,10 +216,15 @@ class SceneGraphModel(Model):
                 obj_feat_dim=self.config.latent_size if self.use_object_latent_code else 0,
                 car_latents=self.car_latents,
                 car_nerf_state_dict_path=self.car_nerf_state_dict_path,
+                get_shared_field=(lambda: self.object_field) if self.object_field is not None else None,
             )
             for key in object_model_key
         }
         self.object_models = torch.nn.ModuleDict(object_models)
+        if self.object_field is not None:
+            # get_outputs evaluates all object rays through one node, which needs every node to see the same latents
+            if any(model.car_latents is not self.car_latents for model in self.object_models.values()):
+                raise ValueError("CarNeRF object nodes sharing a field must share the car latents")
 
         # Collider
         self.collider = NearFarCollider(near_plane=self.config.near_plane, far_plane=self.config.far_plane)
@@ -237,10 +248,8 @@ class SceneGraphModel(Model):
                 reduction="mean", ignore_index=self.background_model.semantic_num
             )
 
-        # metrics
-        self.psnr = PeakSignalNoiseRatio(data_range=1.0)
-        self.ssim = structural_similarity_index_measure
-        self.lpips = LearnedPerceptualImagePatchSimilarity(normalize=True)
+        # metrics, created on first use
+        self.image_metrics = ImageMetrics()
 
         self.step = 0
 
@@ -256,11 +265,49 @@ class SceneGraphModel(Model):
             param_groups["sky_model"] = self.sky_model.get_param_groups()
         param_groups["background_model"] = self.background_model.get_param_groups()
         obj_param_group = []
+        if self.object_field is not None:
+            obj_param_group += list(self.object_field.parameters())
         for key in self.object_model_key:
             obj_param_group += self.object_models[key].get_param_groups()
+        # the CarNeRF nodes all return the shared latents, the optimizer gets each parameter once
+        obj_param_group = list({id(param): param for param in obj_param_group}.values())
         param_groups[f"object_model"] = obj_param_group
         return param_groups
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store the image metrics of every model, they are not part of the models anymore
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix) and {"psnr", "lpips"} & set(key[len(prefix) :].split(".")):
+                state_dict.pop(key)
+        node_field_keys = [key for key in state_dict if key.startswith(prefix + "object_models.") and ".fields." in key]
+        if self.object_field is not None and len(node_field_keys) > 0:
+            # checkpoints with one field per object node
+            node_fields = {}
+            for key in node_field_keys:
+                node, name = key[len(prefix + "object_models.") :].split(".fields.", 1)
+                node_fields.setdefault(node, {})[name] = state_dict[key]
+            first_field = next(iter(node_fields.values()))
+            if all(
+                field.keys() == first_field.keys()
+                and all(torch.equal(value, first_field[name]) for name, value in field.items())
+                for field in node_fields.values()
+            ):
+                # the copies are equal, load them into the shared field
+                for key in node_field_keys:
+                    state_dict.pop(key)
+                for name, value in first_field.items():
+                    state_dict.setdefault(prefix + "object_field." + name, value)
+            else:
+                # the copies were trained independently, every node keeps its own field
+                CONSOLE.print(
+                    "[yellow]The checkpoint has a different CarNeRF field for each object node, "
+                    "the nodes use their own fields instead of the shared one"
+                )
+                for model in self.object_models.values():
+                    model.use_own_field(build_car_nerf_field().to(self.device))
+                self.object_field = None
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def get_training_callbacks(
         self, training_callback_attributes: TrainingCallbackAttributes
     ) -> List[TrainingCallback]:
@@ -330,6 +377,7 @@ class SceneGraphModel(Model):
             return self.get_background_outputs(ray_bundle)
 
         obj_pose = self.batchify_object_pose(ray_bundle).to(self.device)
+        n_batch_obj = obj_pose.shape[1]
         # [x, y, z, yaw, track_id, length, width, height, class_id]
 
         # compute intersections of ray and object bounding box.
@@ -352,13 +400,13 @@ class SceneGraphModel(Model):
             obj_pose[..., 3],
             dim=obj_pose[..., 5:8],
             one_intersec_per_ray=False,
+            grid_min_objects=self.config.box_grid_min_objects,
         )
 
         # No intersection with object bounding boxes, use only the background node
         if intersection_map is None:
             return self.get_background_outputs(ray_bundle)
 
-        ray_o_o = ray_o_o[intersection_map[:, 0], intersection_map[:, 1]]
         # only keep the intersected object poses
         obj_pose = obj_pose[intersection_map[:, 0], intersection_map[:, 1], :]
         # intersected rays
@@ -414,35 +462,46 @@ class SceneGraphModel(Model):
             type_list, temp_class_idx = torch.unique(track_idx.reshape(-1), return_inverse=True)
             ray_class_id = temp_class_idx.reshape(-1)  # (n_intersects,)
 
-        output_obj = []
-        z_vals_obj_w = torch.zeros((n_intersects, n_samples)).to(self.device)
-        for class_id, type_id in enumerate(type_list):
-            if type_id == -1:
-                continue
-            # mask for rays that intersect with the object of this class, (n_intersects, )
-            mask = ray_class_id == class_id
-            # ray indices that intersect with the object of this class, (n_class_intersects,)
-            typed_ray_ids = intersection_map[mask, 0]
-            n_class_intersects = typed_ray_ids.shape[0]
-            if n_class_intersects == 0:
-                output_obj.append(None)
-                continue
-            ray_obj = RayBundle(
-                origins=ray_o_o[mask],
-                directions=viewdirs_box_o[mask],
-                pixel_area=ray_bundle.pixel_area[typed_ray_ids],
-                camera_indices=ray_bundle.camera_indices[typed_ray_ids],
-                nears=z_vals_in_o[mask, None],
-                fars=z_vals_out_o[mask, None],
-                metadata={
-                    "directions_norm": ray_bundle.metadata["directions_norm"][typed_ray_ids],
-                    "obj_ids": track_idx[mask].unsqueeze(-1),
-                    "obj_position": obj_pose[mask][..., :3],
-                },
-            )
+        # pack the intersections of all objects into flat tensors, sorted by object model so that
+        # the rays of every model form one contiguous slice of the packed ray bundle
+        type_list = type_list.tolist()
+        valid_class = torch.tensor([type_id != -1 for type_id in type_list], device=self.device)
+        packed_idx = torch.nonzero(valid_class[ray_class_id])[:, 0]  # (n_packed, )
+        packed_idx = packed_idx[torch.sort(ray_class_id[packed_idx], stable=True)[1]]
+        packed_class_id = ray_class_id[packed_idx]
+        packed_counts = torch.bincount(packed_class_id, minlength=len(type_list)).tolist()
+        packed_ray_ids = intersection_map[packed_idx, 0]
+        packed_obj_pose = obj_pose[packed_idx]
+        n_packed = packed_idx.shape[0]
+
+        ray_obj = RayBundle(
+            origins=ray_o_o[packed_idx],
+            directions=viewdirs_box_o[packed_idx],
+            pixel_area=ray_bundle.pixel_area[packed_ray_ids],
+            camera_indices=ray_bundle.camera_indices[packed_ray_ids],
+            nears=z_vals_in_o[packed_idx, None],
+            fars=z_vals_out_o[packed_idx, None],
+            metadata={
+                "directions_norm": ray_bundle.metadata["directions_norm"][packed_ray_ids],
+                "obj_ids": packed_obj_pose[..., 4].unsqueeze(-1),
+                "obj_position": packed_obj_pose[..., :3],
+            },
+        )
 
-            model = (self.object_models[self.get_object_model_name(type_id)]).to(self.device)
-            result = model.inference_without_render(ray_obj)
+        # evaluate every object model once on its slice of the packed rays. Models with their own weights (object-wise
+        # or class-wise NeRF, MipNeRF and Nerfacto templates) still cost one field call per model in the batch, only
+        # the latent-conditioned CarNeRF nodes share a field and run as a single call, flat in the number of actors
+        model_slices = [(type_list[class_id], count) for class_id, count in enumerate(packed_counts) if count > 0]
+        if self.object_field is not None and len(model_slices) > 1:
+            # the object nodes share the field and the latents (checked in populate_modules), so one node evaluates
+            # all packed rays
+            model_slices = [(model_slices[0][0], n_packed)]
+        output_obj = []
+        start = 0
+        for type_id, count in model_slices:
+            model = self.object_models[self.get_object_model_name(type_id)]
+            result = model.inference_without_render(ray_obj[start : start + count])
+            start += count
 
             interlevel_obj = (
                 interlevel_loss(result["weights_list"], result["ray_samples_list"])
@@ -450,52 +509,65 @@ class SceneGraphModel(Model):
                 else 0.0
             )
             interlevels.append(interlevel_obj)
+            output_obj.append(result)
+
+        z_vals_obj_w = torch.zeros((n_intersects, n_samples)).to(self.device)
+        if n_packed > 0:
+            obj_densities = torch.cat([result["field_outputs"][FieldHeadNames.DENSITY] for result in output_obj])
+            obj_rgbs = torch.cat([result["field_outputs"][FieldHeadNames.RGB] for result in output_obj])
 
             # calculate the z_vals in world frame for each ray
-            # sampled point coordinate in the object coordinate (n_class_intersects, n_samples, 3)
-            pts_box_samples_o = result["ray_samples_list"][-1].frustums.get_positions()
-            obj_pose_transform = torch.reshape(
-                obj_pose[mask].unsqueeze(-2).repeat_interleave(n_samples, dim=1), [-1, obj_pose.shape[-1]]
+            # the object frame is an affine transform of the world frame and the object ray starts at the world ray
+            # origin, so the world distance of a sample is its distance along the object ray times a per ray scale
+            t_box_samples_o = torch.cat(
+                [
+                    (result["ray_samples_list"][-1].frustums.starts + result["ray_samples_list"][-1].frustums.ends)
+                    / 2
+                    for result in output_obj
+                ]
+            )[..., 0]  # (n_packed, n_samples)
+            o2w_scale = (
+                z_vals_out_w[packed_idx]
+                * torch.linalg.norm(rays_d[packed_ray_ids], dim=-1)
+                / z_vals_out_o[packed_idx]
             )
-            pts_box_samples_w, _ = world2object(
-                torch.reshape(pts_box_samples_o, [-1, 3]),
-                None,
-                obj_pose_transform[..., :3],
-                obj_pose_transform[..., 3],
-                dim=obj_pose_transform[..., 5:8] if obj_pose.shape[-1] > 5 else None,
-                inverse=True,
-            )
-            pts_box_samples_w = pts_box_samples_w.reshape([-1, n_samples, 3])
-            z_vals_obj_w_i = torch.linalg.norm(pts_box_samples_w - rays_o[typed_ray_ids, :].unsqueeze(-2), dim=-1)
-            z_vals_obj_w[mask] += z_vals_obj_w_i
-
-            output_obj.append(result)
-
-        z_vals_bckg = output_background["ray_samples_list"][-1].spacing_starts[..., 0]
-        z_vals_bckg = output_background["ray_samples_list"][-1].spacing_to_euclidean_fn(z_vals_bckg)
+            z_vals_obj_w[packed_idx] = torch.abs(t_box_samples_o) * o2w_scale.unsqueeze(-1)
+
+        # only the rays that hit a box are composited, the other rays are rendered from the background weights.
+        # the ray sample depth loss needs the composited samples of every ray, it keeps the dense path
+        composite_all = self.training and self.use_depth_loss and self.config.depth_loss_mult > 1e-8
+        composite_idx = torch.ones_like(insec_idx) if composite_all else insec_idx
+        hit_rays = torch.nonzero(composite_idx)[:, 0]
+        miss_rays = torch.nonzero(~composite_idx)[:, 0]
+        N_hit = hit_rays.shape[0]
+        hit_row = torch.full((N_rays,), -1, dtype=torch.int64, device=hit_rays.device)
+        hit_row[hit_rays] = torch.arange(N_hit, device=hit_rays.device)
+        hit_map = torch.stack([hit_row[intersection_map[:, 0]], intersection_map[:, 1]], dim=-1)
+
+        bg_samples = output_background["ray_samples_list"][-1]
+        bg_field_outputs = output_background["field_outputs"]
+        z_vals_bckg = bg_samples.spacing_to_euclidean_fn(bg_samples.spacing_starts[hit_rays, :, 0])
         z_vals, id_z_vals_bckg, id_z_vals_obj = combine_z(
-            z_vals_bckg, z_vals_obj_w, intersection_map, N_rays, n_samples, self.config.max_num_obj, n_samples
+            z_vals_bckg, z_vals_obj_w, hit_map, N_hit, n_samples, n_batch_obj, n_samples
         )
         delta = torch.cat([z_vals[:, 1:] - z_vals[:, :-1], torch.ones_like(z_vals[:, :1])], dim=-1)
 
         if self.config.object_ray_sample_strategy == "warmup" and self.step < self.config.object_warmup_steps:
-            output_background["field_outputs"][FieldHeadNames.DENSITY][insec_idx, ...] = 0
+            bg_field_outputs[FieldHeadNames.DENSITY][insec_idx, ...] = 0
 
         # aggregate
         densities = torch.zeros((z_vals.size(0), z_vals.size(1), 1)).to(z_vals.device)
         rgbs = torch.zeros((densities.size(0), densities.size(1), 3)).to(densities.device)
-        densities[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], 0] = output_background["field_outputs"][
-            FieldHeadNames.DENSITY
-        ][..., 0]
-        rgbs[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], :] = output_background["field_outputs"][
-            FieldHeadNames.RGB
-        ][..., :]
+        densities[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], 0] = bg_field_outputs[FieldHeadNames.DENSITY][
+            hit_rays, :, 0
+        ]
+        rgbs[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], :] = bg_field_outputs[FieldHeadNames.RGB][hit_rays]
         if self.use_semantic:
             num_semantics = len(self.object_meta["semantics"].classes)
             semantics = torch.zeros((densities.size(0), densities.size(1), num_semantics)).to(densities.device)
-            semantics[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], :] = output_background["field_outputs"][
-                FieldHeadNames.SEMANTICS
-            ][..., :]
+            semantics[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], :] = bg_field_outputs[FieldHeadNames.SEMANTICS][
+                hit_rays
+            ]
 
         # generate debug figure
         if not self.training and self.config.debug_object_pose:
@@ -504,42 +576,42 @@ class SceneGraphModel(Model):
             # debug_density[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], 0] = 0
             # debug_rgb[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], :] = 0
 
-        # put object densities and rgbs into the aggregation tensor
-        for class_id, type_id in enumerate(type_list):
-            type_id = int(type_id)
-            if type_id == -1 or output_obj[class_id] is None:
-                continue
-            mask = ray_class_id == class_id
-            index = id_z_vals_obj[intersection_map[mask, 0], intersection_map[mask, 1], :, :]
-            densities[index[..., 0], index[..., 1], 0] = output_obj[class_id]["field_outputs"][FieldHeadNames.DENSITY][
-                ..., 0
-            ]
-            rgbs[index[..., 0], index[..., 1], :] = output_obj[class_id]["field_outputs"][FieldHeadNames.RGB][..., :]
+        # put object densities and rgbs into the aggregation tensor in a single scatter
+        if n_packed > 0:
+            index = id_z_vals_obj[hit_row[packed_ray_ids], intersection_map[packed_idx, 1], :, :]
+            densities[index[..., 0], index[..., 1], 0] = obj_densities[..., 0]
+            rgbs[index[..., 0], index[..., 1], :] = obj_rgbs
             if self.use_semantic:
-                semantics[index[..., 0], index[..., 1], self.background_model.str2semantic[_type2str[type_id]]] = 1.0
+                obj_class_ids = packed_obj_pose[..., 8].long()
+                semantic_ids = torch.zeros(int(obj_class_ids.max()) + 1, dtype=torch.long, device=self.device)
+                for obj_class_id in torch.unique(obj_class_ids).tolist():
+                    semantic_ids[obj_class_id] = self.background_model.str2semantic[_type2str[obj_class_id]]
+                semantics[index[..., 0], index[..., 1], semantic_ids[obj_class_ids].unsqueeze(-1)] = 1.0
 
             if not self.training and self.config.debug_object_pose:
+                packed_type_id = torch.tensor(type_list, device=self.device)[packed_class_id].unsqueeze(-1)
                 debug_density[index[..., 0], index[..., 1], 0] = 1
-                debug_rgb[index[..., 0], index[..., 1], 0] = 25 * (class_id + 1) / 255.0
-                debug_rgb[index[..., 0], index[..., 1], 1] = 25 * (type_id + 1) / 255.0
-                debug_rgb[index[..., 0], index[..., 1], 2] = 25 * (class_id + 1) / 255.0
+                debug_rgb[index[..., 0], index[..., 1], 0] = 25 * (packed_class_id.unsqueeze(-1) + 1) / 255.0
+                debug_rgb[index[..., 0], index[..., 1], 1] = 25 * (packed_type_id + 1) / 255.0
+                debug_rgb[index[..., 0], index[..., 1], 2] = 25 * (packed_class_id.unsqueeze(-1) + 1) / 255.0
 
+        hit_bundle = ray_bundle[hit_rays]
         frustums = Frustums(
-            origins=rays_o[:, None, :].expand([z_vals.size(0), z_vals.size(1), 3]),
-            directions=rays_d[:, None, :].expand([z_vals.size(0), z_vals.size(1), 3]),
+            origins=hit_bundle.origins[:, None, :].expand([z_vals.size(0), z_vals.size(1), 3]),
+            directions=hit_bundle.directions[:, None, :].expand([z_vals.size(0), z_vals.size(1), 3]),
             starts=z_vals[:, :, None],
             ends=(z_vals + delta)[:, :, None],
-            pixel_area=ray_bundle.pixel_area[:, None, :].expand([z_vals.size(0), z_vals.size(1), 1]),
+            pixel_area=hit_bundle.pixel_area[:, None, :].expand([z_vals.size(0), z_vals.size(1), 1]),
         )
 
         ray_samples = RaySamples(
             frustums=frustums,
-            camera_indices=ray_bundle.camera_indices[:, None, :].expand([z_vals.size(0), z_vals.size(1), 1]),
+            camera_indices=hit_bundle.camera_indices[:, None, :].expand([z_vals.size(0), z_vals.size(1), 1]),
             deltas=delta[:, :, None],
-            spacing_starts=torch.clamp_min((z_vals - ray_bundle.nears) / (ray_bundle.fars - ray_bundle.nears), 0)[
+            spacing_starts=torch.clamp_min((z_vals - hit_bundle.nears) / (hit_bundle.fars - hit_bundle.nears), 0)[
                 :, :, None
             ],
-            spacing_ends=torch.clamp_min((z_vals + delta - ray_bundle.nears) / (ray_bundle.fars - ray_bundle.nears), 0)[
+            spacing_ends=torch.clamp_min((z_vals + delta - hit_bundle.nears) / (hit_bundle.fars - hit_bundle.nears), 0)[
                 :, :, None
             ],
         )
@@ -559,17 +631,33 @@ class SceneGraphModel(Model):
             weights = torch.nan_to_num(weights)
             return weights
 
+        def scatter_rays(hit_value, miss_value):
+            # put the outputs of the composited and of the background only rays back in ray order
+            value = hit_value.new_zeros((N_rays, *hit_value.shape[1:]))
+            value[hit_rays] = hit_value
+            value[miss_rays] = miss_value
+            return value
+
         weights = calc_weights(delta, densities)
+        miss_weights = output_background["weights_list"][-1][miss_rays]
+        miss_samples = bg_samples[miss_rays]
 
         outputs = {}
 
-        raw_rgb = self.renderer_rgb(rgb=rgbs, weights=weights)
-        depth = self.renderer_depth(weights=weights, ray_samples=ray_samples)
-        accumulation = self.renderer_accumulation(weights=weights)
+        raw_rgb = scatter_rays(
+            self.renderer_rgb(rgb=rgbs, weights=weights),
+            self.renderer_rgb(rgb=bg_field_outputs[FieldHeadNames.RGB][miss_rays], weights=miss_weights),
+        )
+        depth = scatter_rays(
+            self.renderer_depth(weights=weights, ray_samples=ray_samples),
+            self.renderer_depth(weights=miss_weights, ray_samples=miss_samples),
+        )
+        accumulation = scatter_rays(
+            self.renderer_accumulation(weights=weights), self.renderer_accumulation(weights=miss_weights)
+        )
         assert ray_bundle.metadata is not None and "directions_norm" in ray_bundle.metadata
         if self.use_sky_model:
             sky_rgb = self.sky_model.inference_without_render(ray_bundle)["rgb"]
-            raw_rgb = self.renderer_rgb(rgb=rgbs, weights=weights)
             rgb = raw_rgb + sky_rgb * (1 - accumulation)
             outputs["sky_rgb"] = sky_rgb
         else:
@@ -585,16 +673,20 @@ class SceneGraphModel(Model):
         )
 
         if self.use_semantic:
-            outputs["semantics"] = self.renderer_semantics(semantics, weights=weights)
+            outputs["semantics"] = scatter_rays(
+                self.renderer_semantics(semantics, weights=weights),
+                self.renderer_semantics(bg_field_outputs[FieldHeadNames.SEMANTICS][miss_rays], weights=miss_weights),
+            )
 
-        if self.training:
+        if composite_all:
+            # like every other output, the weights and samples hold one row per ray, for the ray sample depth loss
             outputs["weights_list"] = [weights]
             outputs["ray_samples_list"] = [ray_samples]
 
         if not self.training and self.config.debug_object_pose:
             debug_weights = calc_weights(delta, debug_density)
             debug_rgb_out = self.renderer_rgb(rgb=debug_rgb, weights=debug_weights)
-            outputs["debug_rgb"] = debug_rgb_out
+            outputs["debug_rgb"] = scatter_rays(debug_rgb_out, 0.0)
 
         if not self.training:
             outputs["background"] = background_rgb
@@ -602,8 +694,10 @@ class SceneGraphModel(Model):
             densities[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], 0] = 0
             rgbs[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1], :] = 0
             new_weights = calc_weights(delta, densities)
-            outputs["objects_rgb"] = self.renderer_rgb(rgb=rgbs, weights=new_weights)
-            outputs["objects_depth"] = self.renderer_depth(weights=new_weights, ray_samples=ray_samples)
+            outputs["objects_rgb"] = scatter_rays(self.renderer_rgb(rgb=rgbs, weights=new_weights), 0.0)
+            outputs["objects_depth"] = scatter_rays(
+                self.renderer_depth(weights=new_weights, ray_samples=ray_samples), 0.0
+            )
 
         if self.config.predict_normals:
             normals = self.renderer_normals(normals=field_outputs[FieldHeadNames.NORMALS], weights=weights)
@@ -633,11 +727,8 @@ class SceneGraphModel(Model):
 
     def batchify_object_pose(self, ray_bundle):
         N_rays = int(ray_bundle.origins.shape[0])
-        batch_obj_rays = ray_bundle.metadata["object_rays_info"].reshape(
-            N_rays, int(ray_bundle.metadata["object_rays_info"].shape[1] / 3), 3
-        )
-        # n_rays * n_obj * 6: [x,y,z,yaw,obj_id, 0]
-        batch_obj_dyn = batch_obj_rays.view(N_rays, self.config.max_num_obj, self.config.ray_add_input_rows * 3)
+        # n_rays * n_obj * 5: [x,y,z,yaw,obj_id], n_obj is the object count of the fullest image of the batch
+        batch_obj_dyn = ray_bundle.metadata["object_rays_info"].reshape(N_rays, -1, OBJECT_RECORD_SIZE)
         batch_obj = batch_obj_dyn[..., :4]  # n_rays * n_obj * 4: [x,y,z,yaw]
         obj_idx = batch_obj_dyn[..., 4].type(torch.int64)
         obj_meta_tensor = self.object_meta["obj_metadata"]
@@ -654,7 +745,7 @@ class SceneGraphModel(Model):
     def get_metrics_dict(self, outputs, batch):
         metrics_dict = {}
         image = batch["image"].to(self.device)
-        metrics_dict["psnr"] = self.psnr(outputs["rgb"], image)
+        metrics_dict["psnr"] = self.image_metrics.psnr(self.device)(outputs["rgb"], image)
         # metrics_dict["depth_mse"] = torch.mean((outputs["depth"] - batch["depth_image"].to(self.device)) ** 2)
         return metrics_dict
 
@@ -668,13 +759,11 @@ class SceneGraphModel(Model):
 
         # semantic loss
         if self.use_semantic:
-            semantics_gt = batch["semantics"][..., 0]
-
-            semantics_label = [
-                self.background_model.color2label.get(tuple(pixel.tolist()), self.background_model.semantic_num)
-                for pixel in semantics_gt
-            ]
-            semantics_label = torch.tensor(semantics_label, device=semantics_gt.device)
+            if "semantic_labels" in batch:
+                semantics_label = batch["semantic_labels"][..., 0].to(self.device).long()
+            else:
+                semantics_gt = batch["semantics"][..., 0].to(self.device)
+                semantics_label = self.background_model.colors_to_labels(semantics_gt)
 
             loss_dict["semantics_loss"] = self.config.semantic_loss_mult * self.cross_entropy_loss(
                 outputs["semantics"], semantics_label
@@ -786,18 +875,24 @@ class SceneGraphModel(Model):
 
         # semantics
         if self.use_semantic:
-            semantic_gt = batch["semantics"].to(self.device)[..., 0]
+            colormap = self.background_model.colormap.to(self.device)
+            if "semantic_labels" in batch:
+                # ignored labels are shown in black
+                colormap_gt = torch.cat([colormap, torch.zeros_like(colormap[:1])], dim=0)
+                semantic_gt = colormap_gt[batch["semantic_labels"].to(self.device)[..., 0].long()]
+            else:
+                semantic_gt = batch["semantics"].to(self.device)[..., 0]
             semantic_labels = torch.argmax(torch.nn.functional.softmax(outputs["semantics"], dim=-1), dim=-1)
-            semantic_colormap = self.background_model.colormap.to(self.device)[semantic_labels]
+            semantic_colormap = colormap[semantic_labels]
             combined_semantic_colormap = torch.cat([semantic_gt, semantic_colormap], dim=0) / 255.0
 
         # Switch images from [H, W, C] to [1, C, H, W] for metrics computations
         image = torch.moveaxis(image, -1, 0)[None, ...]
         rgb = torch.moveaxis(rgb, -1, 0)[None, ...].clamp(0.0, 1.0)
 
-        psnr = self.psnr(image, rgb)
-        ssim = self.ssim(image, rgb)
-        lpips = self.lpips(image, rgb)
+        psnr = self.image_metrics.psnr(self.device)(image, rgb)
+        ssim = self.image_metrics.ssim(image, rgb)
+        lpips = self.image_metrics.lpips(self.device)(image, rgb)
 
         # all of these metrics will be logged as scalars
         metrics_dict = {"psnr": float(psnr.item()), "ssim": float(ssim)}  # type: ignore
@@ -24,9 +24,6 @@ from typing import Dict, List, Optional, Tuple, Type
 import numpy as np
 import torch
 from torch.nn import Parameter
-from torchmetrics import PeakSignalNoiseRatio
-from torchmetrics.functional import structural_similarity_index_measure
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 
 from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.data.dataparsers.base_dataparser import Semantics
@@ -51,6 +48,11 @@ from nerfstudio.model_components.scene_colliders import NearFarCollider
 from nerfstudio.models.base_model import Model
 from mars.fields.nerfacto_field import NerfactoField
 from mars.models.nerfacto import NerfactoModelConfig
+from mars.utils.neural_scene_graph_helper import (
+    colors_to_labels,
+    get_color2label,
+    get_color_lookup,
+)
 
 
 @dataclass
@@ -79,12 +81,11 @@ class SemanticNerfWModel(Model):
         self.semantic_num = len(object_meta["semantics"].classes)
         super().__init__(config=config, **kwargs)
         self.colormap = self.semantics.colors.clone().detach().to(self.device)
-        self.color2label = {tuple(color.tolist()): i for i, color in enumerate(self.colormap)}
-        # map Van to Car
-        for i, sem_class in enumerate(self.semantics.classes):
-            if sem_class == "Car":
-                self.color2label[(0, 139, 139)] = i
+        self.color2label = get_color2label(self.semantics)
         self.str2semantic = {label: i for i, label in enumerate(self.semantics.classes)}
+        color_keys, color_labels = get_color_lookup(self.color2label)
+        self.register_buffer("color_keys", color_keys.to(self.device), persistent=False)
+        self.register_buffer("color_labels", color_labels.to(self.device), persistent=False)
 
     def populate_modules(self):
         """Set the fields and modules."""
@@ -144,10 +145,9 @@ class SemanticNerfWModel(Model):
         self.rgb_loss = MSELoss()
         self.cross_entropy_loss = torch.nn.CrossEntropyLoss(reduction="mean", ignore_index=self.semantic_num)
 
-        # metrics
-        self.psnr = PeakSignalNoiseRatio(data_range=1.0)
-        self.ssim = structural_similarity_index_measure
-        self.lpips = LearnedPerceptualImagePatchSimilarity(normalize=True)
+    def colors_to_labels(self, colors: torch.Tensor) -> torch.Tensor:
+        """Map semantic colors (..., 3) to labels, unknown colors get the ignored label semantic_num."""
+        return colors_to_labels(colors, self.color_keys, self.color_labels, self.semantic_num)
 
     def get_param_groups(self) -> Dict[str, List[Parameter]]:
         param_groups = []
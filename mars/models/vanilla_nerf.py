@@ -23,11 +23,9 @@ from typing import Any, Dict, List, Tuple, Type
 
 import torch
 from torch.nn import Parameter
-from torchmetrics import PeakSignalNoiseRatio
-from torchmetrics.functional import structural_similarity_index_measure
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 
 from mars.fields.vanilla_nerf_field import NeRFField
+from mars.model_components.metrics import ImageMetrics
 from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.configs.config_utils import to_immutable_dict
 from nerfstudio.field_components.encodings import NeRFEncoding
@@ -132,10 +130,8 @@ class NeRFModel(Model):
         # losses
         self.rgb_loss = MSELoss()
 
-        # metrics
-        self.psnr = PeakSignalNoiseRatio(data_range=1.0)
-        self.ssim = structural_similarity_index_measure
-        self.lpips = LearnedPerceptualImagePatchSimilarity(normalize=True)
+        # metrics, created on first use
+        self.image_metrics = ImageMetrics()
 
         if getattr(self.config, "enable_temporal_distortion", False):
             params = self.config.temporal_distortion_params
@@ -268,10 +264,10 @@ class NeRFModel(Model):
         rgb_coarse = torch.moveaxis(rgb_coarse, -1, 0)[None, ...]
         rgb_fine = torch.moveaxis(rgb_fine, -1, 0)[None, ...]
 
-        coarse_psnr = self.psnr(image, rgb_coarse)
-        fine_psnr = self.psnr(image, rgb_fine)
-        fine_ssim = self.ssim(image, rgb_fine)
-        fine_lpips = self.lpips(image, rgb_fine)
+        coarse_psnr = self.image_metrics.psnr(self.device)(image, rgb_coarse)
+        fine_psnr = self.image_metrics.psnr(self.device)(image, rgb_fine)
+        fine_ssim = self.image_metrics.ssim(image, rgb_fine)
+        fine_lpips = self.image_metrics.lpips(self.device)(image, rgb_fine)
 
         metrics_dict = {
             "psnr": float(fine_psnr.item()),
@@ -1,5 +1,7 @@
 # import tensorflow as tf
 import json
+import math
+from typing import Optional
 
 import imageio
 import numpy as np
@@ -8,6 +10,10 @@ import torch.nn.functional as F
 from matplotlib import pyplot as plt
 from torch import nn
 
+# box_pts tests the rays against a uniform grid over the boxes from this number of objects per ray on, below it the
+# brute force slab test is faster (see scripts/benchmark_box_pts.py)
+BOX_GRID_MIN_OBJECTS = 96
+
 # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # device = torch.device("cpu")
 
@@ -39,6 +45,69 @@ def latentReg(z, reg):
 # def latentReg(z, reg): return tf.reduce_sum([1/reg * torch.linalg.norm(latent_i) for latent_i in z])
 
 
+def pack_colors(colors):
+    """Packs RGB colors into 24-bit integer keys
+
+    Args:
+        colors: integer RGB colors [..., 3]
+
+    Returns:
+        keys: [...]
+    """
+    colors = colors.long()
+    return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+
+
+def get_color2label(semantics):
+    """Maps the colors of the semantic classes to their labels, Van colors are labeled as Car
+
+    Args:
+        semantics: nerfstudio Semantics with classes and colors
+
+    Returns:
+        color2label: dict mapping RGB tuples to labels
+    """
+    color2label = {tuple(color.tolist()): i for i, color in enumerate(semantics.colors)}
+    # map Van to Car
+    for i, sem_class in enumerate(semantics.classes):
+        if sem_class == "Car":
+            color2label[(0, 139, 139)] = i
+    return color2label
+
+
+def get_color_lookup(color2label):
+    """Builds a sorted lookup table from a color to label dict
+
+    Args:
+        color2label: dict mapping RGB tuples to labels
+
+    Returns:
+        color_keys: sorted packed colors [N_colors]
+        color_labels: label of each packed color [N_colors]
+    """
+    color_keys = pack_colors(torch.tensor(list(color2label.keys()), dtype=torch.long).reshape(-1, 3))
+    color_labels = torch.tensor(list(color2label.values()), dtype=torch.long)
+    color_keys, order = torch.sort(color_keys)
+    return color_keys, color_labels[order]
+
+
+def colors_to_labels(colors, color_keys, color_labels, ignore_label):
+    """Maps RGB colors to labels with a sorted lookup table, on the device of the colors
+
+    Args:
+        colors: integer RGB colors [..., 3]
+        color_keys: sorted packed colors [N_colors]
+        color_labels: label of each packed color [N_colors]
+        ignore_label: label of colors that are not in the table
+
+    Returns:
+        labels: [...]
+    """
+    keys = pack_colors(colors)
+    idx = torch.searchsorted(color_keys, keys.reshape(-1)).clamp(max=color_keys.shape[0] - 1).reshape(keys.shape)
+    return torch.where(color_keys[idx] == keys, color_labels[idx], torch.full_like(keys, ignore_label))
+
+
 # Positional encoding
 class Embedder:
     def __init__(self, **kwargs):
@@ -709,7 +778,232 @@ def ray_box_intersection(ray_o, ray_d, aabb_min=None, aabb_max=None):
     return z_ray_in, z_ray_out, intersection_map
 
 
-def box_pts(rays, pose, theta_y, dim=None, one_intersec_per_ray=False):
+@torch.jit.script
+def ray_box_slab_test(rays_o, rays_d, pose, theta_y, dim):
+    """Slab test of every ray against every object bounding box, without replicating the rays for each box
+
+    The rays are transformed into the scaled box frames by broadcasting, the same transform as world2object,
+    and only the hits are gathered into compact per-intersection lists.
+
+    Args:
+        rays_o: ray origins in world frame, [N_rays, 3]
+        rays_d: ray directions in world frame, [N_rays, 3]
+        pose: object positions in world frame for each ray, [N_rays, N_obj, 3]
+        theta_y: rotation of objects around world y axis, [N_rays, N_obj]
+        dim: object bounding box dimensions [N_rays, N_obj, 3]
+
+    Returns:
+        intersection_map: ray and object of each intersection, [n_intersects, 2]
+        z_ray_in_o: entry distance along the unit ray direction in the object frame, 0 for rays starting inside the
+            box, [n_intersects]
+        z_ray_out_o: exit distance along the unit ray direction in the object frame, [n_intersects]
+        rays_o_o: ray origins in the object frame, [n_intersects, 3]
+        dirs_o: unit ray directions in the object frame, [n_intersects, 3]
+        dirs_o_norm: length of the world ray direction in the object frame, [n_intersects]
+    """
+    cos_y = torch.cos(theta_y)
+    sin_y = torch.sin(theta_y)
+    # the object reference point is shifted to the middle of the bbox, the box is scaled to [-1, 1]
+    rel_x = rays_o[:, 0:1] - pose[..., 0]
+    rel_y = rays_o[:, 1:2] - pose[..., 1] + dim[..., 1] / 2
+    rel_z = rays_o[:, 2:3] - pose[..., 2]
+    scale_x = 1 / (dim[..., 0] / 2 + 1e-9)
+    scale_y = 1 / (dim[..., 1] / 2 + 1e-9)
+    scale_z = 1 / (dim[..., 2] / 2 + 1e-9)
+    o_x = (cos_y * rel_x - sin_y * rel_z) * scale_x
+    o_y = rel_y * scale_y
+    o_z = (sin_y * rel_x + cos_y * rel_z) * scale_z
+    d_x = (cos_y * rays_d[:, 0:1] - sin_y * rays_d[:, 2:3]) * scale_x
+    d_y = rays_d[:, 1:2] * scale_y
+    d_z = (sin_y * rays_d[:, 0:1] + cos_y * rays_d[:, 2:3]) * scale_z
+    d_norm = torch.sqrt(d_x * d_x + d_y * d_y + d_z * d_z)
+    d_x = d_x / d_norm
+    d_y = d_y / d_norm
+    d_z = d_z / d_norm
+
+    # slab test against the box [-1, 1]^3
+    inv_x = torch.reciprocal(d_x)
+    inv_y = torch.reciprocal(d_y)
+    inv_z = torch.reciprocal(d_z)
+    t_x0 = (-1.0 - o_x) * inv_x
+    t_x1 = (1.0 - o_x) * inv_x
+    t_y0 = (-1.0 - o_y) * inv_y
+    t_y1 = (1.0 - o_y) * inv_y
+    t_z0 = (-1.0 - o_z) * inv_z
+    t_z1 = (1.0 - o_z) * inv_z
+    t_near = torch.maximum(
+        torch.maximum(torch.minimum(t_x0, t_x1), torch.minimum(t_y0, t_y1)), torch.minimum(t_z0, t_z1)
+    )
+    t_far = torch.minimum(
+        torch.minimum(torch.maximum(t_x0, t_x1), torch.maximum(t_y0, t_y1)), torch.maximum(t_z0, t_z1)
+    )
+    # boxes hit by the ray and in front of the ray origin
+    intersection_map = torch.nonzero((t_far > t_near) & (t_far > 0))
+    ray_ids = intersection_map[:, 0]
+    obj_ids = intersection_map[:, 1]
+    rays_o_o = torch.stack([o_x[ray_ids, obj_ids], o_y[ray_ids, obj_ids], o_z[ray_ids, obj_ids]], dim=-1)
+    dirs_o = torch.stack([d_x[ray_ids, obj_ids], d_y[ray_ids, obj_ids], d_z[ray_ids, obj_ids]], dim=-1)
+    # rays starting inside a box enter it at their origin, the object samples then stay in front of the origin and
+    # increase along the ray, as combine_z expects
+    return (
+        intersection_map,
+        torch.clamp(t_near[ray_ids, obj_ids], min=0.0),
+        t_far[ray_ids, obj_ids],
+        rays_o_o,
+        dirs_o,
+        d_norm[ray_ids, obj_ids],
+    )
+
+
+def get_box_grid_candidates(rays_o, rays_d, pose, theta_y, dim, grid_size: Optional[int] = None):
+    """Ray-box pairs that can intersect, found with a uniform grid over the boxes of every object set
+
+    The rays that share the same objects (usually the rays of one image) form an object set. A grid over the ground
+    plane (x, z) is built for every set, each box is registered in the cells covered by its world aabb and every ray
+    only tests the boxes of the cells it crosses. All sets are traversed together in batch.
+
+    Args:
+        rays_o: ray origins in world frame, [N_rays, 3]
+        rays_d: ray directions in world frame, [N_rays, 3]
+        pose: object positions in world frame for each ray, [N_rays, N_obj, 3]
+        theta_y: rotation of objects around world y axis, [N_rays, N_obj]
+        dim: object bounding box dimensions [N_rays, N_obj, 3]
+        grid_size: cells along each axis of the grid, 2 * sqrt(N_obj) if None
+
+    Returns:
+        ray_ids: ray of every candidate pair, sorted by ray and object, [n_candidates]
+        obj_ids: object of every candidate pair, [n_candidates]
+    """
+    device = rays_o.device
+    N_rays, N_obj = theta_y.shape
+    if grid_size is None:
+        grid_size = max(int(math.ceil(2 * math.sqrt(N_obj))), 1)
+    n_cells = grid_size * grid_size
+
+    # object sets, the rays are grouped by a hash of their objects and the grouping is checked to be exact
+    hash_weights = torch.sqrt(torch.arange(2, 7 * N_obj + 2, device=device, dtype=pose.dtype))
+    ray_hash = (
+        pose.reshape(N_rays, 3 * N_obj) @ hash_weights[: 3 * N_obj]
+        + theta_y @ hash_weights[3 * N_obj : 4 * N_obj]
+        + dim.reshape(N_rays, 3 * N_obj) @ hash_weights[4 * N_obj :]
+    )
+    set_hash, ray_set = torch.unique(ray_hash, return_inverse=True)
+    set_rays = torch.full_like(set_hash, N_rays, dtype=torch.long)
+    set_rays = set_rays.scatter_reduce(0, ray_set, torch.arange(N_rays, device=device), reduce="amin")
+    set_pose, set_theta, set_dim = pose[set_rays], theta_y[set_rays], dim[set_rays]
+    if not (
+        torch.equal(set_pose.index_select(0, ray_set), pose)
+        and torch.equal(set_theta.index_select(0, ray_set), theta_y)
+        and torch.equal(set_dim.index_select(0, ray_set), dim)
+    ):
+        obj_table = torch.cat([pose.reshape(N_rays, -1), theta_y, dim.reshape(N_rays, -1)], dim=-1)
+        obj_sets, ray_set = torch.unique(obj_table, dim=0, return_inverse=True)
+        set_pose = obj_sets[:, : 3 * N_obj].reshape(-1, N_obj, 3)
+        set_theta = obj_sets[:, 3 * N_obj : 4 * N_obj]
+        set_dim = obj_sets[:, 4 * N_obj :].reshape(-1, N_obj, 3)
+    n_sets = set_theta.shape[0]
+
+    # world aabbs of the yawed boxes on the ground plane, with a margin against rounding at the cell borders
+    half_x = torch.abs(set_dim[..., 0]) / 2
+    half_z = torch.abs(set_dim[..., 2]) / 2
+    cos_y = torch.abs(torch.cos(set_theta))
+    sin_y = torch.abs(torch.sin(set_theta))
+    extent_x = cos_y * half_x + sin_y * half_z
+    extent_z = sin_y * half_x + cos_y * half_z
+    box_min_x, box_max_x = set_pose[..., 0] - extent_x, set_pose[..., 0] + extent_x
+    box_min_z, box_max_z = set_pose[..., 2] - extent_z, set_pose[..., 2] + extent_z
+    grid_min_x, grid_max_x = box_min_x.min(dim=1)[0], box_max_x.max(dim=1)[0]
+    grid_min_z, grid_max_z = box_min_z.min(dim=1)[0], box_max_z.max(dim=1)[0]
+    cell_x = torch.clamp((grid_max_x - grid_min_x) / grid_size, min=1e-6)
+    cell_z = torch.clamp((grid_max_z - grid_min_z) / grid_size, min=1e-6)
+    margin_x, margin_z = 1e-3 * cell_x.unsqueeze(-1), 1e-3 * cell_z.unsqueeze(-1)
+
+    def cell_index(value, grid_min, cell):
+        return torch.clamp(torch.floor((value - grid_min) / cell), 0, grid_size - 1).long()
+
+    # cells of every box, as a CSR list of the boxes of every cell
+    ix0 = cell_index(box_min_x - margin_x, grid_min_x.unsqueeze(-1), cell_x.unsqueeze(-1)).reshape(-1)
+    ix1 = cell_index(box_max_x + margin_x, grid_min_x.unsqueeze(-1), cell_x.unsqueeze(-1)).reshape(-1)
+    iz0 = cell_index(box_min_z - margin_z, grid_min_z.unsqueeze(-1), cell_z.unsqueeze(-1)).reshape(-1)
+    iz1 = cell_index(box_max_z + margin_z, grid_min_z.unsqueeze(-1), cell_z.unsqueeze(-1)).reshape(-1)
+    n_box_cells_z = iz1 - iz0 + 1
+    n_box_cells = (ix1 - ix0 + 1) * n_box_cells_z
+    entry_box = torch.repeat_interleave(torch.arange(n_sets * N_obj, device=device), n_box_cells)
+    entry_local = torch.arange(entry_box.shape[0], device=device) - torch.repeat_interleave(
+        torch.cumsum(n_box_cells, dim=0) - n_box_cells, n_box_cells
+    )
+    entry_cell = (
+        (entry_box // N_obj) * n_cells
+        + (ix0[entry_box] + entry_local // n_box_cells_z[entry_box]) * grid_size
+        + iz0[entry_box]
+        + entry_local % n_box_cells_z[entry_box]
+    )
+    entry_cell, entry_order = torch.sort(entry_cell, stable=True)
+    cell_obj = entry_box[entry_order] % N_obj
+    cell_count = torch.bincount(entry_cell, minlength=n_sets * n_cells)
+    cell_start = torch.cumsum(cell_count, dim=0) - cell_count
+
+    # clip the rays to the grid of their object set
+    ray_min_x, ray_cell_x = grid_min_x[ray_set].unsqueeze(-1), cell_x[ray_set].unsqueeze(-1)
+    ray_min_z, ray_cell_z = grid_min_z[ray_set].unsqueeze(-1), cell_z[ray_set].unsqueeze(-1)
+    o_x, o_z = rays_o[:, 0:1], rays_o[:, 2:3]
+    d_x, d_z = rays_d[:, 0:1], rays_d[:, 2:3]
+    t_z0 = torch.nan_to_num((ray_min_z - o_z) / d_z, nan=-float("inf"))
+    t_z1 = torch.nan_to_num((ray_min_z + ray_cell_z * grid_size - o_z) / d_z, nan=float("inf"))
+    t_enter = torch.clamp(torch.minimum(t_z0, t_z1), min=0)
+    t_exit = torch.maximum(t_z0, t_z1)
+
+    # a ray crosses a run of consecutive cells in each column of the grid, the cells are bounded by the ray
+    # parameters at the column borders
+    col = torch.arange(grid_size, device=device)
+    col_x0 = ray_min_x + col * ray_cell_x
+    t_x0, t_x1 = (col_x0 - o_x) / d_x, (col_x0 + ray_cell_x - o_x) / d_x
+    in_col = (col_x0 <= o_x) & (o_x <= col_x0 + ray_cell_x)
+    t_in = torch.where(d_x != 0, torch.minimum(t_x0, t_x1), torch.where(in_col, -float("inf"), float("inf")))
+    t_out = torch.where(d_x != 0, torch.maximum(t_x0, t_x1), torch.where(in_col, float("inf"), -float("inf")))
+    t_in = torch.maximum(t_in, t_enter)
+    t_out = torch.minimum(t_out, t_exit)
+    crossed = t_in <= t_out
+    z_in = o_z + torch.where(d_z != 0, torch.where(crossed, t_in, 0.0) * d_z, 0.0)
+    z_out = o_z + torch.where(d_z != 0, torch.where(crossed, t_out, 0.0) * d_z, 0.0)
+    iz_first = cell_index(torch.minimum(z_in, z_out), ray_min_z, ray_cell_z)
+    iz_last = cell_index(torch.maximum(z_in, z_out), ray_min_z, ray_cell_z)
+
+    # the boxes of a run of cells are a contiguous range of the CSR list, a box in several cells is kept once
+    visit_ray, visit_col = torch.nonzero(crossed, as_tuple=True)
+    first_cell = ray_set[visit_ray] * n_cells + visit_col * grid_size + iz_first[visit_ray, visit_col]
+    last_cell = first_cell + iz_last[visit_ray, visit_col] - iz_first[visit_ray, visit_col]
+    visit_start = cell_start[first_cell]
+    visit_count = cell_start[last_cell] + cell_count[last_cell] - visit_start
+    pair_ray = torch.repeat_interleave(visit_ray, visit_count)
+    visit_offset = visit_start - (torch.cumsum(visit_count, dim=0) - visit_count)
+    pair_entry = torch.repeat_interleave(visit_offset, visit_count) + torch.arange(pair_ray.shape[0], device=device)
+    candidates = torch.zeros(N_rays, N_obj, dtype=torch.bool, device=device)
+    candidates[pair_ray, cell_obj[pair_entry]] = True
+    ray_ids, obj_ids = torch.nonzero(candidates, as_tuple=True)
+    return ray_ids, obj_ids
+
+
+def ray_box_grid_test(rays_o, rays_d, pose, theta_y, dim, grid_size: Optional[int] = None):
+    """Ray-box intersections of ray_box_slab_test, testing only the candidate pairs of get_box_grid_candidates
+
+    Returns:
+        same as ray_box_slab_test
+    """
+    ray_ids, obj_ids = get_box_grid_candidates(rays_o, rays_d, pose, theta_y, dim, grid_size)
+    intersection_map, z_ray_in_o, z_ray_out_o, rays_o_o, dirs_o, dirs_o_norm = ray_box_slab_test(
+        rays_o[ray_ids],
+        rays_d[ray_ids],
+        pose[ray_ids, obj_ids].unsqueeze(1),
+        theta_y[ray_ids, obj_ids].unsqueeze(1),
+        dim[ray_ids, obj_ids].unsqueeze(1),
+    )
+    pair_ids = intersection_map[:, 0]
+    intersection_map = torch.stack([ray_ids[pair_ids], obj_ids[pair_ids]], dim=-1)
+    return intersection_map, z_ray_in_o, z_ray_out_o, rays_o_o, dirs_o, dirs_o_norm
+
+
+def box_pts(rays, pose, theta_y, dim=None, one_intersec_per_ray=False, grid_min_objects=BOX_GRID_MIN_OBJECTS):
     """gets ray-box intersection points in world and object frames in a sparse notation
 
     Args:
@@ -719,6 +1013,8 @@ def box_pts(rays, pose, theta_y, dim=None, one_intersec_per_ray=False):
         dim: object bounding box dimensions [N_rays, N_obj, 3]
         one_intersec_per_ray: If True only the first interesection along a ray will lead to an
         intersection point output
+        grid_min_objects: number of objects per ray from which the rays are tested against a uniform grid over the
+        boxes instead of every box
 
     Returns:
         pts_box_w: box-ray intersection points given in the world frame
@@ -728,49 +1024,26 @@ def box_pts(rays, pose, theta_y, dim=None, one_intersec_per_ray=False):
         z_vals_w: integration step in the world frame
         z_vals_o: integration step for scaled rays in the object frame
         intersection_map: mapping of points, viewdirs and z_vals to the specific rays and objects at the intersection
-        rays_o_o: rays_o in object frame
+        rays_o_o: rays_o in object frame of each intersection
 
     """
     rays_o, rays_d = rays
     pose = pose.to(rays_o.device)
     theta_y = theta_y.to(rays_o.device)
-    if dim is not None:
-        dim = dim.to(rays_o.device)
-    # Transform each ray into each object frame
-    rays_o_o, dirs_o = world2object(rays_o, rays_d, pose, theta_y, dim)
-    rays_o_o = torch.squeeze(rays_o_o)
-    dirs_o = torch.squeeze(dirs_o)
+    dim = dim.to(rays_o.device)
 
     # Get the intersection with each Bounding Box
-    z_ray_in_o, z_ray_out_o, intersection_map = ray_box_intersection(rays_o_o, dirs_o)
+    ray_box_test = ray_box_grid_test if theta_y.shape[1] >= grid_min_objects else ray_box_slab_test
+    intersection_map, z_ray_in_o, z_ray_out_o, rays_o_o, viewdirs_box_o, dirs_o_norm = ray_box_test(
+        rays_o, rays_d, pose, theta_y, dim
+    )
 
-    if z_ray_in_o is not None:
-        # Calculate the intersection points for each box in each object frame
-        pts_box_in_o = (
-            rays_o_o[intersection_map[:, 0], intersection_map[:, 1], :]
-            + z_ray_in_o.unsqueeze(-1) * dirs_o[intersection_map[:, 0], intersection_map[:, 1], :]
-        )
-        # Transform the intersection points for each box in world frame
-        pts_box_in_w, _ = object2world(
-            pts_box_in_o,
-            None,
-            pose[intersection_map[:, 0], intersection_map[:, 1], :],
-            theta_y[intersection_map[:, 0], intersection_map[:, 1]],
-            dim[intersection_map[:, 0], intersection_map[:, 1], :],
-        )
-        pts_box_in_w = torch.squeeze(pts_box_in_w)
-
-        # Get all intersecting rays in unit length and the corresponding z_vals
-        rays_o_in_w = rays_o.unsqueeze(-2).repeat_interleave(pose.shape[1], dim=1)[
-            intersection_map[:, 0], intersection_map[:, 1], :
-        ]
-        rays_d_in_w = rays_d.unsqueeze(-2).repeat_interleave(pose.shape[1], dim=1)[
-            intersection_map[:, 0], intersection_map[:, 1], :
-        ]
-        # rays_o_in_w = tf.gather_nd(tf.repeat(rays_o[:, tf.newaxis, :], pose.shape[1], axis=1), intersection_map)
-        # rays_d_in_w = tf.gather_nd(tf.repeat(rays_d[:, tf.newaxis, :], pose.shape[1], axis=1), intersection_map)
-        # Account for non-unit length rays direction
-        z_vals_in_w = torch.linalg.norm(pts_box_in_w - rays_o_in_w, dim=1) / torch.linalg.norm(rays_d_in_w, dim=-1)
+    if intersection_map.shape[0] > 0:
+        # the object frame is an affine transform of the world frame, a distance t along the unit object ray is
+        # the world ray parameter t / dirs_o_norm
+        rays_o_in_w = rays_o[intersection_map[:, 0]]
+        rays_d_in_w = rays_d[intersection_map[:, 0]]
+        z_vals_in_w = torch.abs(z_ray_in_o / dirs_o_norm)
 
         if one_intersec_per_ray:
             # Get just nearest object point on a single ray
@@ -780,33 +1053,23 @@ def box_pts(rays, pose, theta_y, dim=None, one_intersec_per_ray=False):
             # Get previous calculated values just for first intersections
             z_ray_in_o = z_ray_in_o[first_in_only]
             z_ray_out_o = z_ray_out_o[first_in_only]
-            pts_box_in_o = pts_box_in_o[first_in_only]
-            pts_box_in_w = pts_box_in_w[first_in_only]
+            rays_o_o = rays_o_o[first_in_only]
+            viewdirs_box_o = viewdirs_box_o[first_in_only]
+            dirs_o_norm = dirs_o_norm[first_in_only]
             rays_o_in_w = rays_o_in_w[first_in_only]
             rays_d_in_w = rays_d_in_w[first_in_only]
 
-        # Get the far intersection points and integration steps for each ray-box intersection in world and object frames
-        pts_box_out_o = (
-            rays_o_o[intersection_map[:, 0], intersection_map[:, 1], :]
-            + z_ray_out_o.unsqueeze(-1) * dirs_o[intersection_map[:, 0], intersection_map[:, 1], :]
-        )
-
-        pts_box_out_w, _ = object2world(
-            pts_box_out_o,
-            None,
-            pose[intersection_map[:, 0], intersection_map[:, 1], :],
-            theta_y[intersection_map[:, 0], intersection_map[:, 1]],
-            dim[intersection_map[:, 0], intersection_map[:, 1], :],
-        )
-        pts_box_out_w = torch.squeeze(pts_box_out_w)
-        z_vals_out_w = torch.linalg.norm(pts_box_out_w - rays_o_in_w, dim=1) / torch.linalg.norm(rays_d_in_w, dim=-1)
+        # Get the near and far intersection points and integration steps in world and object frames
+        pts_box_in_o = rays_o_o + z_ray_in_o.unsqueeze(-1) * viewdirs_box_o
+        pts_box_in_w = rays_o_in_w + (z_ray_in_o / dirs_o_norm).unsqueeze(-1) * rays_d_in_w
+        z_vals_out_w = torch.abs(z_ray_out_o / dirs_o_norm)
 
         # Get viewing directions for each ray-box intersection
-        viewdirs_box_o = dirs_o[intersection_map[:, 0], intersection_map[:, 1], :]
         viewdirs_box_w = 1 / torch.linalg.norm(rays_d_in_w, dim=1)[:, None] * rays_d_in_w
 
     else:
         # In case no ray intersects with any object return empty lists
+        intersection_map = None
         z_vals_in_w = z_vals_out_w = []
         pts_box_in_w = pts_box_in_o = []
         viewdirs_box_w = viewdirs_box_o = []
@@ -901,6 +1164,11 @@ def get_closest_intersections(z_vals_w, intersection_map, N_rays, N_obj):
 def combine_z(z_vals_bckg, z_vals_obj_w, intersection_map, N_rays, N_samples, N_obj, N_samples_obj=1):
     """Combines and sorts background node and all object node intersections along a ray
 
+    The background samples and the samples of every ray-box intersection are each sorted along the ray already,
+    so they are merged instead of sorted: the position of a sample is its index in its own list plus the number
+    of samples in front of it in the other lists of the same ray. Object slots without an intersection hold zero
+    depths at the front of every ray. Equal depths are ordered background first, then objects in slot order.
+
     Args:
         z_vals_bckg: integration step along each ray [N_rays, N_samples]
         z_vals_obj_w:  integration step of ray-box intersection in the world frame [n_intersects, N_samples_obj
@@ -911,62 +1179,69 @@ def combine_z(z_vals_bckg, z_vals_obj_w, intersection_map, N_rays, N_samples, N_
         N_samples_obj: Number of samples per object
 
     Returns:
-        z_vals:  [N_rays, N_samples + N_samples_obj*N_obj, 4]
-        id_z_vals_bckg:
-        id_z_vals_obj:
+        z_vals:  [N_rays, N_samples + N_samples_obj*N_obj]
+        id_z_vals_bckg: position of every background sample in z_vals [N_rays, N_samples, 2]
+        id_z_vals_obj: position of every object sample in z_vals [N_rays, N_obj, N_samples_obj, 2]
     """
+    if z_vals_bckg is not None and len(z_vals_bckg.shape) < 2:
+        z_vals_bckg = z_vals_bckg.unsqueeze(0)
+    device = intersection_map.device if intersection_map is not None else z_vals_bckg.device
+    dtype = z_vals_bckg.dtype if z_vals_bckg is not None else torch.float32
     if z_vals_obj_w is None or z_vals_obj_w.shape == torch.Size([1]):
-        z_vals_obj_w_sparse = torch.zeros([N_rays, N_obj * N_samples_obj])
-    else:
-        intersection_map = intersection_map[:, 0] * N_obj + intersection_map[:, 1]
-        z_vals_obj_w_sparse = (
-            torch.zeros([N_rays * N_obj, N_samples_obj])
-            .to(intersection_map.device)
-            .index_add_(0, intersection_map, z_vals_obj_w)
-            .reshape(N_rays, N_obj, N_samples_obj)
-        )
-        # z_vals_obj_w_sparse = tf.scatter_nd(intersection_map, z_vals_obj_w, [N_rays, N_obj, N_samples_obj])    #TODO
-        z_vals_obj_w_sparse = torch.reshape(z_vals_obj_w_sparse, [N_rays, N_samples_obj * N_obj])
-
-    sample_range = torch.arange(0, N_rays).to(intersection_map.device)
-    obj_range = (sample_range.unsqueeze(-1).unsqueeze(-1).repeat_interleave(N_obj, dim=1)).repeat_interleave(
-        N_samples_obj, dim=2
-    )
-    # obj_range = tf.repeat(tf.repeat(sample_range[:, tf.newaxis, tf.newaxis], N_obj, axis=1), N_samples_obj, axis=2)
-
-    # Get ids to assign z_vals to each model
+        intersection_map = torch.zeros((0, 2), dtype=torch.int64, device=device)
+        z_vals_obj_w = torch.zeros((0, N_samples_obj), dtype=dtype, device=device)
+    ray_ids, slot_ids = intersection_map[:, 0], intersection_map[:, 1]
+    z_vals_obj_w = z_vals_obj_w.to(dtype).contiguous()
+    n_intersects = ray_ids.shape[0]
+
+    # rank of every sample among all samples of its ray
+    rank_obj = torch.arange(N_samples_obj, device=device).expand(n_intersects, N_samples_obj).clone()
     if z_vals_bckg is not None:
-        if len(z_vals_bckg.shape) < 2:
-            # z_vals_bckg = z_vals_bckg[tf.newaxis]
-            z_vals_bckg = z_vals_bckg.unsqueeze()
-        # Combine and sort z_vals along each ray
-        z_vals, z_vals_indices = torch.sort(torch.cat((z_vals_obj_w_sparse, z_vals_bckg), dim=1), dim=1)
-
-        bckg_range = sample_range.unsqueeze(-1).unsqueeze(-1).repeat_interleave(N_samples, dim=1)
-        id_z_vals_bckg = torch.cat(
-            (bckg_range, torch.searchsorted(z_vals, z_vals_bckg.contiguous()).unsqueeze(-1)), dim=2
+        z_vals_bckg_insec = z_vals_bckg[ray_ids].contiguous()
+        rank_obj += torch.searchsorted(z_vals_bckg_insec, z_vals_obj_w, right=True)
+        rank_bckg = torch.arange(N_samples, device=device).expand(N_rays, N_samples).clone()
+        rank_bckg.index_add_(0, ray_ids, torch.searchsorted(z_vals_obj_w, z_vals_bckg_insec))
+
+    # pairs of intersections on the same ray
+    n_insec_per_ray = torch.bincount(ray_ids, minlength=N_rays)
+    n_partners = n_insec_per_ray[ray_ids]
+    if n_intersects > 0 and int(n_partners.max()) > 1:
+        insec_by_ray = torch.sort(ray_ids, stable=True)[1]
+        first_insec_of_ray = torch.cumsum(n_insec_per_ray, dim=0) - n_insec_per_ray
+        insec_a = torch.repeat_interleave(torch.arange(n_intersects, device=device), n_partners)
+        partner = torch.arange(insec_a.shape[0], device=device) - torch.repeat_interleave(
+            torch.cumsum(n_partners, dim=0) - n_partners, n_partners
+        )
+        insec_b = insec_by_ray[first_insec_of_ray[ray_ids[insec_a]] + partner]
+        distinct = insec_a != insec_b
+        insec_a, insec_b = insec_a[distinct], insec_b[distinct]
+        b_first = (slot_ids[insec_b] < slot_ids[insec_a]).unsqueeze(-1)
+        n_in_front = torch.where(
+            b_first,
+            torch.searchsorted(z_vals_obj_w[insec_b], z_vals_obj_w[insec_a], right=True),
+            torch.searchsorted(z_vals_obj_w[insec_b], z_vals_obj_w[insec_a]),
         )
-        # bckg_range = tf.repeat(sample_range[:, tf.newaxis, tf.newaxis], N_samples, axis=1)
-        # id_z_vals_bckg = tf.concat([bckg_range, tf.searchsorted(z_vals, z_vals_bckg)[..., tf.newaxis]], axis=2)
+        rank_obj.index_add_(0, insec_a, n_in_front)
+
+    # the empty object slots fill the front of every ray
+    n_empty = (N_obj - n_insec_per_ray) * N_samples_obj
+    empty_slots = torch.ones((N_rays, N_obj), dtype=torch.int64, device=device)
+    empty_slots[ray_ids, slot_ids] = 0
+    empty_rank = torch.cumsum(empty_slots, dim=1) - empty_slots
+    pos_obj = empty_rank.unsqueeze(-1) * N_samples_obj + torch.arange(N_samples_obj, device=device)
+    pos_obj[ray_ids, slot_ids] = n_empty[ray_ids].unsqueeze(-1) + rank_obj
+
+    n_z_vals = N_obj * N_samples_obj + (N_samples if z_vals_bckg is not None else 0)
+    z_vals = torch.zeros((N_rays, n_z_vals), dtype=dtype, device=device)
+    z_vals[ray_ids.unsqueeze(-1), pos_obj[ray_ids, slot_ids]] = z_vals_obj_w
+    ray_range = torch.arange(N_rays, device=device)
+    if z_vals_bckg is not None:
+        pos_bckg = n_empty.unsqueeze(-1) + rank_bckg
+        z_vals.scatter_(1, pos_bckg, z_vals_bckg)
+        id_z_vals_bckg = torch.stack([ray_range.unsqueeze(-1).expand(N_rays, N_samples), pos_bckg], dim=-1)
     else:
-        z_vals, z_vals_indices = torch.sort(z_vals_obj_w_sparse, dim=1)
         id_z_vals_bckg = None
-
-    # id_z_vals_obj = tf.concat([obj_range, tf.searchsorted(z_vals, z_vals_obj_w_sparse)], axis=2)
-    id_z_vals_obj = torch.cat(
-        [
-            obj_range.unsqueeze(-1),
-            torch.reshape(torch.searchsorted(z_vals, z_vals_obj_w_sparse), (N_rays, N_obj, N_samples_obj)).unsqueeze(
-                -1
-            ),
-        ],
-        dim=-1,
-    )
-
-    # id_z_vals_obj = tf.concat([obj_range[..., tf.newaxis],
-    #                            tf.reshape(tf.searchsorted(z_vals, z_vals_obj_w_sparse), [N_rays, N_obj, N_samples_obj])[..., tf.newaxis]
-    #                            ], axis=-1)
-
+    id_z_vals_obj = torch.stack([ray_range[:, None, None].expand(N_rays, N_obj, N_samples_obj), pos_obj], dim=-1)
     return z_vals, id_z_vals_bckg, id_z_vals_obj
 
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the ray-box tests of box_pts: brute force slab test against the uniform grid, for growing numbers of
+objects per frame. Prints the time of both tests and the object count from which the grid is faster, which is what
+BOX_GRID_MIN_OBJECTS in mars/utils/neural_scene_graph_helper.py should be set to.
+"""
+import argparse
+import time
+
+import torch
+
+from mars.utils.neural_scene_graph_helper import ray_box_grid_test, ray_box_slab_test
+
+
+def get_scene(args, num_objects, generator):
+    """Cars on a road along z seen from cameras on the road, the rays of each frame share the objects of the frame"""
+    image_idx = torch.randint(0, args.num_images, (args.num_rays,), generator=generator)
+    pose = torch.rand(args.num_images, num_objects, 3, generator=generator)
+    pose[..., 0] = (pose[..., 0] - 0.5) * 15
+    pose[..., 1] = 1.5
+    pose[..., 2] = pose[..., 2] * args.road_length
+    theta_y = (torch.rand(args.num_images, num_objects, generator=generator) - 0.5) * 0.4
+    dim = torch.tensor([1.8, 1.5, 4.2]) * (0.8 + 0.4 * torch.rand(args.num_images, num_objects, 3, generator=generator))
+
+    rays_o = torch.zeros(args.num_rays, 3)
+    rays_o[:, 2] = image_idx.float() * args.road_length / (4 * args.num_images)
+    rays_d = torch.randn(args.num_rays, 3, generator=generator) * torch.tensor([0.4, 0.1, 0.0])
+    rays_d[:, 2] = 1.0
+    rays_d = rays_d / torch.linalg.norm(rays_d, dim=-1, keepdim=True)
+
+    scene = [rays_o, rays_d, pose[image_idx], theta_y[image_idx], dim[image_idx]]
+    return [x.to(args.device) for x in scene]
+
+
+def get_time(args, ray_box_test, scene):
+    """Mean time of a ray-box test in ms"""
+    ray_box_test(*scene)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        ray_box_test(*scene)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeats * 1e3
+
+
+def main():
+    parsers = argparse.ArgumentParser(description="Ray-box test microbenchmark")
+    parsers.add_argument("--num_rays", type=int, default=4096)
+    parsers.add_argument("--num_images", type=int, default=8, help="number of frames the rays of a batch come from")
+    parsers.add_argument("--num_objects", type=int, nargs="+", default=[4, 8, 16, 32, 64, 96, 128, 192, 256, 512])
+    parsers.add_argument("--road_length", type=float, default=200.0, help="length of the road the objects are spread on")
+    parsers.add_argument("--repeats", type=int, default=20)
+    parsers.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parsers.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    crossover = None
+    print(f"{args.num_rays} rays from {args.num_images} frames on {args.device}")
+    print(f"{'objects':>8} {'hits':>8} {'slab [ms]':>10} {'grid [ms]':>10} {'speedup':>8}")
+    for num_objects in args.num_objects:
+        scene = get_scene(args, num_objects, generator)
+        intersection_map = ray_box_slab_test(*scene)[0]
+        assert torch.equal(ray_box_grid_test(*scene)[0], intersection_map)
+        num_hits = intersection_map.shape[0]
+        slab_time = get_time(args, ray_box_slab_test, scene)
+        grid_time = get_time(args, ray_box_grid_test, scene)
+        if grid_time < slab_time and crossover is None:
+            crossover = num_objects
+        elif grid_time >= slab_time:
+            crossover = None
+        print(f"{num_objects:>8} {num_hits:>8} {slab_time:>10.2f} {grid_time:>10.2f} {slab_time / grid_time:>8.2f}")
+
+    if crossover is None:
+        print("the grid is not faster from any of the tested object counts on")
+    else:
+        print(f"the grid is faster from {crossover} objects on")
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,7 @@ from nerfstudio.utils.eval_utils import eval_setup
 from nerfstudio.utils.rich_utils import ItersPerSecColumn
 from nerfstudio.viewer.server.utils import three_js_perspective_camera_focal_length
 
+from mars.data.mars_dataparser_utils import OBJECT_RECORD_SIZE, gather_object_records
 from safety_critical_manoeuvres import *
 from hard_coded_configs import configs 
 
@@ -141,38 +142,14 @@ def _render_trajectory_video(
 
         with progress:
             for frame_number, camera_idx in enumerate(progress.track(range(cameras.size), description="")):
-                # objdata = pipeline.datamanager.train_dataset.metadata["obj_info"][camera_idx].to(pipeline.device)
-                objdata = pipeline.datamanager.train_dataset.metadata["obj_info"][camera_idx].to(
-                    pipeline.model.object_meta["obj_metadata"].device
-                )
-                # obj_metadata = pipeline.datamanager.eval_dataset.metadata["obj_metadata"].to(pipeline.device)
-                obj_metadata = pipeline.datamanager.eval_dataset.metadata["obj_metadata"].to(
-                    pipeline.model.object_meta["obj_metadata"].device
-                )
+                # object records of the frame from the ragged object table, [1, 1, n_obj, 5]: [x,y,z,yaw,obj_id]
+                train_metadata = pipeline.datamanager.train_dataset.metadata
+                objdata = gather_object_records(
+                    train_metadata["obj_offsets"], train_metadata["obj_records"], torch.tensor(camera_idx)
+                ).to(pipeline.model.object_meta["obj_metadata"].device)
                 camera_ray_bundle = cameras.generate_rays(camera_indices=camera_idx)
-                camera_ray_bundle.metadata["object_rays_info"] = objdata
-
-                # camera_ray_bundle.metadata["object_rays_metadata"] = obj_metadata
-                # camera_ray_bundle = cameras.generate_rays(
-                #     camera_indices=camera_idx,
-                #     keep_shape=True,
-                #     objdata=objdata,
-                #     objmetadata=obj_metadata,
-                # )
-
-                # batch_obj_rays = camera_ray_bundle.metadata["object_rays_info"].reshape(
-                #     camera_ray_bundle.metadata["object_rays_info"].shape[0],
-                #     camera_ray_bundle.metadata["object_rays_info"].shape[1],
-                #     int(camera_ray_bundle.metadata["object_rays_info"].shape[2] / 3),
-                #     3,
-                # )
-
-                batch_obj_dyn = camera_ray_bundle.metadata["object_rays_info"].view(
-                    camera_ray_bundle.metadata["object_rays_info"].shape[0],
-                    camera_ray_bundle.metadata["object_rays_info"].shape[1],
-                    pipeline.model.config.max_num_obj,
-                    pipeline.model.config.ray_add_input_rows * 3,
-                )
+
+                batch_obj_dyn = objdata.view(1, 1, objdata.shape[0], OBJECT_RECORD_SIZE)
                 norm_sh = camera_ray_bundle.metadata["directions_norm"].shape
                 camera_ray_bundle.metadata["directions_norm"] = camera_ray_bundle.metadata["directions_norm"].reshape(
                     norm_sh[0] * norm_sh[1], norm_sh[2]
@@ -275,8 +252,9 @@ def _render_trajectory_video(
                                                             "maneuver_ending_frame": frame_number+ maneuver_ending_frame}
                 
                     
-                camera_ray_bundle.metadata["object_rays_info"] = batch_obj_dyn.reshape(
-                    batch_obj_dyn.shape[0] * batch_obj_dyn.shape[1], batch_obj_dyn.shape[2] * batch_obj_dyn.shape[3]
+                # all rays of the frame share the records of the modified actors
+                camera_ray_bundle.metadata["object_rays_info"] = batch_obj_dyn.reshape(-1).expand(
+                    *camera_ray_bundle.shape, -1
                 )
                 #####-----#####
 
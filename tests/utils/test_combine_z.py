@@ -0,0 +1,70 @@
+"""
+Test the merge of background and object samples in combine_z
+"""
+import torch
+
+from mars.utils.neural_scene_graph_helper import box_pts, combine_z
+
+
+def sort_combine_z(z_vals_bckg, z_vals_obj_w, intersection_map, N_rays, N_samples, N_obj, N_samples_obj):
+    """Reference: place the object samples in their slots and sort all samples of a ray"""
+    z_vals_obj = torch.zeros(N_rays, N_obj, N_samples_obj)
+    z_vals_obj[intersection_map[:, 0], intersection_map[:, 1]] = z_vals_obj_w
+    z_vals = torch.cat([z_vals_bckg, z_vals_obj.reshape(N_rays, -1)], dim=1)
+    return torch.sort(z_vals, dim=1)[0], z_vals_obj
+
+
+def check_combine_z(z_vals_bckg, z_vals_obj_w, intersection_map, N_obj):
+    N_rays, N_samples = z_vals_bckg.shape
+    N_samples_obj = z_vals_obj_w.shape[1]
+    z_vals, id_z_vals_bckg, id_z_vals_obj = combine_z(
+        z_vals_bckg, z_vals_obj_w, intersection_map, N_rays, N_samples, N_obj, N_samples_obj
+    )
+    z_vals_ref, z_vals_obj = sort_combine_z(
+        z_vals_bckg, z_vals_obj_w, intersection_map, N_rays, N_samples, N_obj, N_samples_obj
+    )
+    assert torch.equal(z_vals, z_vals_ref)
+    assert torch.equal(z_vals[id_z_vals_bckg[..., 0], id_z_vals_bckg[..., 1]], z_vals_bckg)
+    assert torch.equal(z_vals[id_z_vals_obj[..., 0], id_z_vals_obj[..., 1]], z_vals_obj)
+
+    # every position of the merged samples is written exactly once
+    positions = torch.cat([id_z_vals_bckg[..., 1].reshape(N_rays, -1), id_z_vals_obj[..., 1].reshape(N_rays, -1)], 1)
+    assert torch.equal(torch.sort(positions, dim=1)[0], torch.arange(positions.shape[1]).expand_as(positions))
+
+
+def test_combine_z_ties():
+    """Background and object samples at equal depths, several boxes on a ray and empty object slots"""
+    N_rays, N_samples, N_obj, N_samples_obj = 64, 16, 4, 8
+    generator = torch.Generator().manual_seed(0)
+    # depths on a coarse grid so that many samples tie
+    z_vals_bckg = torch.sort(torch.randint(0, 20, (N_rays, N_samples), generator=generator).float(), dim=1)[0]
+    intersection_map = torch.nonzero(torch.rand(N_rays, N_obj, generator=generator) > 0.4)
+    z_vals_obj_w = torch.randint(0, 20, (intersection_map.shape[0], N_samples_obj), generator=generator).float()
+    z_vals_obj_w = torch.sort(z_vals_obj_w, dim=1)[0]
+    check_combine_z(z_vals_bckg, z_vals_obj_w, intersection_map, N_obj)
+
+
+def test_combine_z_origin_inside_box():
+    """Rays starting inside a box sample it from their origin on, so the object samples stay sorted"""
+    N_rays, N_samples, N_samples_obj = 32, 16, 8
+    generator = torch.Generator().manual_seed(0)
+    rays_o = (torch.rand(N_rays, 3, generator=generator) - 0.5) * torch.tensor([1.0, 0.5, 2.0])
+    rays_d = torch.nn.functional.normalize(torch.randn(N_rays, 3, generator=generator), dim=-1)
+    pose = torch.tensor([[[0.0, 1.0, 0.0], [0.5, 1.0, 6.0]]]).expand(N_rays, -1, -1)
+    theta_y = torch.tensor([[0.3, -0.2]]).expand(N_rays, -1)
+    dim = torch.tensor([[[2.0, 2.0, 4.0], [2.0, 2.0, 4.0]]]).expand(N_rays, -1, -1)
+
+    _, _, z_vals_in_w, z_vals_out_w, _, _, z_vals_in_o, z_vals_out_o, intersection_map, _ = box_pts(
+        [rays_o, rays_d], pose, theta_y, dim
+    )
+    # every ray starts inside the first box
+    inside = intersection_map[:, 1] == 0
+    assert int(inside.sum()) == N_rays
+
+    # samples along the object rays, mapped to world depths like the object models of the scene graph
+    t_box_samples_o = z_vals_in_o[:, None] + (z_vals_out_o - z_vals_in_o)[:, None] * torch.linspace(
+        0.05, 0.95, N_samples_obj
+    )
+    z_vals_obj_w = torch.abs(t_box_samples_o) * (z_vals_out_w / z_vals_out_o)[:, None]
+    z_vals_bckg = torch.linspace(0.0, 10.0, N_samples).expand(N_rays, -1).contiguous()
+    check_combine_z(z_vals_bckg, z_vals_obj_w, intersection_map, N_obj=2)